@@ -0,0 +1,38 @@
+# backend/calculator/management/commands/bench_pdf.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from calculator.utils.pdf_generator import render_pdf_to_bytes
+
+SAMPLE_PAYLOAD = {
+    "product": "money_back_10",
+    "input": {"dob": "1990-01-01", "ageNextBirthday": 36, "gender": "female", "mode": "monthly", "term": 10},
+    "results": {
+        "basic_premium": 4321.5,
+        "estimated_sum_assured": 500000,
+        "dab": 250,
+        "wp": 120,
+        "benefits": {"Year 4": 100000, "Year 7": 100000, "Maturity": 300000},
+    },
+}
+
+
+class Command(BaseCommand):
+    help = "Measure quotation PDF rendering throughput (bypasses the PDF cache)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=200, help="PDFs to render per round")
+        parser.add_argument("--rounds", type=int, default=3)
+
+    def handle(self, *args, **options):
+        render_pdf_to_bytes(SAMPLE_PAYLOAD)  # warm up imports, fonts and module-level setup
+        best = 0.0
+        for n in range(options["rounds"]):
+            started = time.perf_counter()
+            for i in range(options["count"]):
+                size = len(render_pdf_to_bytes({**SAMPLE_PAYLOAD, "customerName": f"Client {i}"}))
+            rate = options["count"] / (time.perf_counter() - started)
+            best = max(best, rate)
+            self.stdout.write(f"round {n + 1}: {rate:.1f} PDFs/s ({size} bytes each)")
+        self.stdout.write(self.style.SUCCESS(f"best: {best:.1f} PDFs/s"))
@@ -0,0 +1,27 @@
+# backend/calculator/management/commands/compile_rates.py
+from django.core.management.base import BaseCommand
+
+from calculator.utils.rates_loader import COMPILED_RATES_PATH, RateTable
+
+
+class Command(BaseCommand):
+    help = "Parse the Excel rate workbooks once and write the binary artifact RateTable loads at startup."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            default=str(COMPILED_RATES_PATH),
+            help=f"Where to write the compiled rates (default: {COMPILED_RATES_PATH})",
+        )
+
+    def handle(self, *args, **options):
+        # Always re-parse the workbooks; never trust an existing artifact here.
+        table = RateTable(compiled_path=None)
+        if not table.load_all():
+            self.stderr.write(self.style.ERROR("No rate tables could be parsed; nothing written."))
+            return
+
+        meta = table.save_compiled(options["output"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Compiled {len(meta['products'])} rate tables to {options['output']}"
+        ))
@@ -0,0 +1,126 @@
+# backend/calculator/management/commands/consume_callbacks.py
+import json
+import logging
+import socket
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError
+
+from calculator.tasks import parse_callback, settle_payments
+from calculator.utils.callback_queue import (
+    CALLBACK_DEAD_KEY, CALLBACK_QUEUE_KEY, CALLBACK_STATS_KEY, ack, dead_letter, next_batch, queue_depth, requeue,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply queued M-Pesa callbacks in batches (MPESA_CALLBACK_BATCHING): one locked query and "
+        "one bulk_update per batch, PDFs enqueued as a Celery group."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.MPESA_CALLBACK_BATCH_SIZE)
+        parser.add_argument("--wait-ms", type=int, default=settings.MPESA_CALLBACK_BATCH_WAIT_MS,
+                            help="Max milliseconds to keep filling a batch after its first callback")
+        parser.add_argument("--report-interval", type=float, default=30.0,
+                            help="Seconds between throughput/batch-size reports")
+        parser.add_argument("--consumer", default=socket.gethostname(),
+                            help="Name of this consumer's processing list; keep it stable across restarts")
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS(
+            f"Consuming {CALLBACK_QUEUE_KEY} in batches of <= {options['batch_size']} / {options['wait_ms']} ms"
+        ))
+        consumer = options["consumer"]
+        recovered = requeue(consumer)
+        if recovered:
+            logger.warning(f"Requeued {recovered} callbacks left unacknowledged by consumer {consumer}")
+        window = self._new_window()
+        try:
+            while True:
+                batch = next_batch(consumer, options["batch_size"], options["wait_ms"] / 1000)
+                if batch:
+                    started = time.monotonic()
+                    try:
+                        paid = self.apply(batch)
+                    except Exception as e:
+                        logger.error(f"Callback batch of {len(batch)} failed, requeued: {e}")
+                        requeue(consumer)
+                        time.sleep(1)
+                        continue
+                    ack(consumer)
+                    window["callbacks"] += len(batch)
+                    window["batches"] += 1
+                    window["paid"] += len(paid)
+                    window["max_batch"] = max(window["max_batch"], len(batch))
+                    window["apply_seconds"] += time.monotonic() - started
+
+                if time.monotonic() - window["started"] >= options["report_interval"]:
+                    self.report(window)
+                    window = self._new_window()
+        except KeyboardInterrupt:
+            self.report(window)
+
+    @staticmethod
+    def apply(batch):
+        """
+        Apply a batch of raw callbacks; returns the ids of calculations it marked paid.
+
+        Malformed callbacks, and any callback that fails on its own when the batch as
+        a whole does not apply, go to the dead-letter list. A database that is down
+        raises instead, so the whole batch is requeued and retried.
+        """
+        callbacks, failures = [], []
+        for raw in batch:
+            try:
+                callbacks.append((raw, parse_callback(*json.loads(raw))))
+            except (TypeError, ValueError) as e:
+                failures.append((raw, e))
+
+        try:
+            paid = settle_payments([callback for _, callback in callbacks])
+        except (InterfaceError, OperationalError):
+            raise
+        except Exception as e:
+            logger.warning(f"Callback batch of {len(callbacks)} failed ({e}), applying one at a time")
+            paid = []
+            for raw, callback in callbacks:
+                try:
+                    paid += settle_payments([callback])
+                except (InterfaceError, OperationalError):
+                    raise
+                except Exception as e:
+                    failures.append((raw, e))
+
+        if failures:
+            logger.error(f"Moved {len(failures)} callbacks to {CALLBACK_DEAD_KEY}: {failures[0][1]}")
+            dead_letter(failures)
+        return paid
+
+    @staticmethod
+    def _new_window():
+        return {"started": time.monotonic(), "callbacks": 0, "batches": 0, "paid": 0,
+                "max_batch": 0, "apply_seconds": 0.0}
+
+    def report(self, window):
+        elapsed = max(time.monotonic() - window["started"], 1e-9)
+        batches = window["batches"]
+        stats = {
+            "callbacks_per_second": round(window["callbacks"] / elapsed, 2),
+            "batches": batches,
+            "mean_batch_size": round(window["callbacks"] / batches, 1) if batches else 0,
+            "max_batch_size": window["max_batch"],
+            "mean_apply_ms": round(1000 * window["apply_seconds"] / batches, 1) if batches else 0,
+            "payments_confirmed": window["paid"],
+            "queue_depth": queue_depth(),
+        }
+        logger.info(f"Callback consumer: {stats}")
+        try:
+            cache.set(CALLBACK_STATS_KEY, stats, timeout=None)
+        except Exception:
+            pass
@@ -0,0 +1,48 @@
+# backend/calculator/management/commands/mpesa_simulator.py
+from django.core.management.base import BaseCommand
+
+from calculator.utils.daraja_simulator import DarajaSimulator, SimulatorConfig
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a fake Daraja API (OAuth, STK push, STK query, callbacks) for offline and load "
+        "testing. Point MPESA_BASE_URL at it."
+    )
+
+    def add_arguments(self, parser):
+        defaults = SimulatorConfig()
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8089)
+        parser.add_argument("--latency", type=float, default=defaults.latency, help="Mean API response time (s)")
+        parser.add_argument("--jitter", type=float, default=defaults.jitter, help="+/- spread of the response time (s)")
+        parser.add_argument("--failure-rate", type=float, default=defaults.failure_rate,
+                            help="Fraction of STK pushes rejected with HTTP 500")
+        parser.add_argument("--decline-rate", type=float, default=defaults.decline_rate,
+                            help="Fraction of accepted pushes the customer cancels")
+        parser.add_argument("--callback-delay", type=float, default=defaults.callback_delay,
+                            help="Mean seconds from push to callback")
+        parser.add_argument("--callback-jitter", type=float, default=defaults.callback_jitter)
+        parser.add_argument("--callback-url", help="Send callbacks here instead of each push's CallBackURL")
+
+    def handle(self, *args, **options):
+        config = SimulatorConfig(
+            latency=options["latency"],
+            jitter=options["jitter"],
+            failure_rate=options["failure_rate"],
+            decline_rate=options["decline_rate"],
+            callback_delay=options["callback_delay"],
+            callback_jitter=options["callback_jitter"],
+            callback_url=options["callback_url"],
+        )
+        server = DarajaSimulator(config).make_server(options["host"], options["port"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Daraja simulator on http://{options['host']}:{options['port']} "
+            f"(set MPESA_BASE_URL to this)"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
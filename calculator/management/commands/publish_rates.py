@@ -0,0 +1,37 @@
+# backend/calculator/management/commands/publish_rates.py
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from calculator.utils.rate_store import publish
+from calculator.utils.rates_loader import RateTable
+
+
+class Command(BaseCommand):
+    help = (
+        "Compile the rate workbooks and publish them to the shared cache. Running web and "
+        "Celery workers pick the new version up within RATES_CHECK_INTERVAL seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--artifact",
+            help="Publish an existing compiled .npz (from compile_rates) instead of re-parsing the workbooks",
+        )
+
+    def handle(self, *args, **options):
+        if options["artifact"]:
+            path = Path(options["artifact"])
+            if not path.exists():
+                raise CommandError(f"No such artifact: {path}")
+            table = RateTable.from_artifact(path.read_bytes())
+        else:
+            table = RateTable(compiled_path=None)
+            table.load_all()
+        if not table.tables:
+            raise CommandError("No rate tables could be loaded; nothing published.")
+
+        meta = publish(table)
+        self.stdout.write(self.style.SUCCESS(
+            f"Published rates {meta['version']} ({len(meta['products'])} tables)"
+        ))
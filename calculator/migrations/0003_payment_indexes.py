@@ -0,0 +1,22 @@
+# Generated by Django 5.2.7 on 2026-10-17 00:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calculator', '0002_calculationresult_rate_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='calculationresult',
+            index=models.Index(condition=models.Q(('paid', False)), fields=['expires_at'], name='calc_unpaid_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-17 01:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calculator', '0003_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(condition=models.Q(('status', 'Pending')), fields=['id'], name='mpesa_pending_idx'),
+        ),
+    ]
@@ -3,6 +3,9 @@ from django.db import models
 from django.utils import timezone
 from datetime import timedelta
 
+# How long an unpaid calculation stays payable
+CALCULATION_TTL = timedelta(seconds=60)
+
 
 class MpesaTransaction(models.Model):
     name = models.CharField(max_length=100, blank=True, null=True)
@@ -18,11 +21,17 @@ class MpesaTransaction(models.Model):
     )
     status = models.CharField(max_length=50, default='Pending')
     merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
-    checkout_request_id = models.CharField(max_length=100, blank=True, null=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True, unique=True)  # callback lookup
     mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True)
     transaction_date = models.DateTimeField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # reconcile_pending_payments pages through pending rows in id order
+            models.Index(fields=["id"], condition=models.Q(status="Pending"), name="mpesa_pending_idx"),
+        ]
+
     def __str__(self):
         return f"{self.phone_number} - {self.amount} ({self.status})"
 
@@ -36,13 +45,20 @@ class CalculationResult(models.Model):
     paid = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     pdf_file = models.FileField(upload_to='pdfs/', null=True, blank=True)
+    rate_version = models.CharField(max_length=64, blank=True, default='')  # rate tables it was priced with
 
     # 60-SECOND EXPIRY — SET ON SAVE (NO LAMBDA!)
     expires_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            # cleanup_expired_calculations: unpaid rows past expiry
+            models.Index(fields=["expires_at"], condition=models.Q(paid=False), name="calc_unpaid_expires_idx"),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.pk:  # Only on creation
-            self.expires_at = timezone.now() + timedelta(seconds=60)
+            self.expires_at = timezone.now() + CALCULATION_TTL
         super().save(*args, **kwargs)
 
     def is_expired(self):
@@ -1,76 +1,357 @@
 # backend/calculator/tasks.py
-from celery import shared_task
+from celery import chord, group, shared_task
 from .models import CalculationResult, MpesaTransaction
-from .utils.pdf_generator import create_pdf  # use create_pdf(filename) from pdf_generator
+from .utils.payment_events import publish_payment_status
+from .utils.pdf_cache import pdf_cache
 import logging
 import os
+import shutil
+import time
+import uuid
+import zipfile
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.utils import timezone
 from .models import CalculationResult
 
 logger = logging.getLogger(__name__)
 
-@shared_task(bind=True, max_retries=3, default_retry_delay=60)
-def process_mpesa_callback(self, checkout_id, result_code, metadata):
-    """Async: Process M-Pesa callback"""
+
+def parse_callback(checkout_id, result_code, metadata):
+    """
+    Validate a raw (checkout_id, result_code, metadata) callback. Returns it with
+    result_code as an int; raises ValueError for anything that cannot be applied.
+    """
+    if not checkout_id or not isinstance(checkout_id, str):
+        raise ValueError(f"Bad CheckoutRequestID {checkout_id!r}")
     try:
-        if int(result_code) == 0:
-            receipt = next((x["Value"] for x in metadata if x["Name"] == "MpesaReceiptNumber"), None)
-            amount = next((x["Value"] for x in metadata if x["Name"] == "Amount"), None)
+        result_code = int(result_code)
+    except (TypeError, ValueError):
+        raise ValueError(f"Bad ResultCode {result_code!r}") from None
+    if not isinstance(metadata, list):
+        raise ValueError(f"Bad CallbackMetadata {metadata!r}")
+    return checkout_id, result_code, metadata
+
+
+def _receipt(metadata):
+    return next(
+        (x.get("Value") for x in metadata if isinstance(x, dict) and x.get("Name") == "MpesaReceiptNumber"), None
+    )
+
 
-            tx = MpesaTransaction.objects.filter(checkout_request_id=checkout_id).first()
-            if tx and tx.calculation:
+def apply_payment_result(checkout_id, result_code, metadata):
+    """
+    Record an STK result exactly once. The conditional UPDATE ... WHERE status='Pending'
+    lets only the first delivery of a result through; returns the paid calculation's
+    id when this call confirmed a payment, else None.
+    """
+    pending = MpesaTransaction.objects.filter(checkout_request_id=checkout_id, status="Pending")
+    if int(result_code) != 0:
+        pending.update(status="Failed")
+        return None
+
+    receipt = _receipt(metadata)
+    with transaction.atomic():
+        if not pending.filter(calculation__isnull=False).update(status="Success", mpesa_receipt_number=receipt):
+            return None  # duplicate delivery, already failed, or no calculation attached
+        calc_id = MpesaTransaction.objects.values_list("calculation_id", flat=True).get(checkout_request_id=checkout_id)
+        CalculationResult.objects.filter(pk=calc_id).update(paid=True)
+    return calc_id
+
+
+def apply_payment_results(callbacks):
+    """
+    Batch form of apply_payment_result() for the callback consumer.
+
+    ``callbacks`` are (checkout_id, result_code, metadata) tuples. All pending
+    transactions are resolved with one locked query and updated with bulk_update;
+    returns the ids of calculations this batch marked paid.
+    """
+    results = {}
+    for checkout_id, result_code, metadata in callbacks:
+        results.setdefault(checkout_id, (result_code, metadata))  # first delivery wins
+
+    with transaction.atomic():
+        # Locked rows belong to a concurrent consumer; it will apply them.
+        pending = list(
+            MpesaTransaction.objects.select_for_update(skip_locked=True)
+            .filter(checkout_request_id__in=list(results), status="Pending")
+            .only("id", "checkout_request_id", "calculation_id", "status", "mpesa_receipt_number")
+        )
+        paid_calc_ids = []
+        for tx in pending:
+            result_code, metadata = results[tx.checkout_request_id]
+            if int(result_code) != 0:
+                tx.status = "Failed"
+            elif tx.calculation_id:
                 tx.status = "Success"
-                tx.mpesa_receipt_number = receipt
-                tx.amount_paid = amount
-                tx.save()
+                tx.mpesa_receipt_number = _receipt(metadata)
+                paid_calc_ids.append(tx.calculation_id)
+        changed = [tx for tx in pending if tx.status != "Pending"]
+        MpesaTransaction.objects.bulk_update(changed, ["status", "mpesa_receipt_number"])
+        CalculationResult.objects.filter(pk__in=paid_calc_ids).update(paid=True)
+    return paid_calc_ids
+
 
-                calc = tx.calculation
-                calc.paid = True
-                calc.save()
+def settle_payments(callbacks):
+    """apply_payment_results() plus the follow-up for each newly paid calculation."""
+    paid = apply_payment_results(callbacks)
+    for calc_id in paid:
+        publish_payment_status(calc_id, {"paid": True})
+    if paid:
+        group(generate_pdf_task.s(calc_id) for calc_id in paid).apply_async()
+    return paid
 
-                # Generate PDF in background (Celery worker will create and attach a PDF)
-                generate_pdf_task.delay(calc.id)
 
-                logger.info(f"Payment confirmed: {checkout_id}")
-        else:
-            MpesaTransaction.objects.filter(checkout_request_id=checkout_id).update(status="Failed")
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def process_mpesa_callback(self, checkout_id, result_code, metadata):
+    """Async: Process M-Pesa callback"""
+    try:
+        calc_id = apply_payment_result(checkout_id, result_code, metadata)
+        if calc_id is None:
+            return
+
+        publish_payment_status(calc_id, {"paid": True})
+        # Generate PDF in background (Celery worker will create and attach a PDF)
+        generate_pdf_task.delay(calc_id)
+        logger.info(f"Payment confirmed: {checkout_id}")
     except Exception as exc:
         logger.error(f"Callback failed: {exc}")
         raise self.retry(exc=exc)
 
 
+@shared_task(bind=True, max_retries=5, default_retry_delay=10)
+def send_stk_push(self, tx_id):
+    """STK push for a transaction queued by stk_push_view (MPESA_STK_QUEUE); routed to the "mpesa" queue."""
+    from .utils.mpesa import initiate_stk_push
+    from .utils.circuit_breaker import CircuitOpenError
+    import requests
+
+    tx = MpesaTransaction.objects.filter(pk=tx_id, status="Queued").first()
+    if tx is None:
+        return
+
+    try:
+        response = initiate_stk_push(tx.phone_number, tx.amount)
+    except (CircuitOpenError, requests.ConnectionError) as exc:
+        # Nothing reached Safaricom, so retrying can't double-prompt the customer
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=getattr(exc, "retry_after", self.default_retry_delay))
+        logger.error(f"STK push for tx {tx_id} abandoned: {exc}")
+        response = {}
+    except Exception as exc:
+        logger.error(f"STK push for tx {tx_id} failed: {exc}")
+        response = {}
+
+    tx.merchant_request_id = response.get("MerchantRequestID")
+    tx.checkout_request_id = response.get("CheckoutRequestID")
+    tx.status = "Pending" if tx.checkout_request_id else "Failed"
+    tx.save(update_fields=["merchant_request_id", "checkout_request_id", "status"])
+
+
+@shared_task
+def expire_queued_stk_pushes():
+    """
+    Fail transactions left Queued for longer than MPESA_STK_QUEUE_TTL: their
+    send_stk_push task was lost or gave up without recording a result, so no
+    prompt will ever reach the customer.
+    """
+    from datetime import timedelta
+
+    cutoff = timezone.now() - timedelta(seconds=settings.MPESA_STK_QUEUE_TTL)
+    expired = MpesaTransaction.objects.filter(status="Queued", created_at__lt=cutoff).update(status="Failed")
+    if expired:
+        logger.warning(f"Expired {expired} queued STK pushes older than {settings.MPESA_STK_QUEUE_TTL}s")
+    return expired
+
+
+def quotation_payload(calc):
+    """The PDF generator's payload for a stored calculation."""
+    return {
+        "product": calc.product,
+        "input": calc.input_data or {},
+        "results": calc.result_data or {},
+        "customerName": (calc.input_data or {}).get("customerName") if isinstance(calc.input_data, dict) else None,
+    }
+
+
 @shared_task
 def generate_pdf_task(calc_id):
     """Generate PDF for paid calculation"""
     try:
         calc = CalculationResult.objects.get(id=calc_id, paid=True)
-        pdf_dir = "media/pdfs"
-        os.makedirs(pdf_dir, exist_ok=True)
-        pdf_path = f"{pdf_dir}/quotation_{calc_id}.pdf"
+        pdf_name = f"pdfs/quotation_{calc_id}.pdf"
+        pdf_path = os.path.join(settings.MEDIA_ROOT, pdf_name)
+        if calc.pdf_file and os.path.exists(pdf_path):
+            return pdf_name  # redelivered task or bundle export; already rendered
 
-        # Build a payload matching the PDF generator's expected shape
-        payload = {
-            "product": calc.product,
-            "input": calc.input_data or {},
-            "results": calc.result_data or {},
-            "customerName": (calc.input_data or {}).get("customerName") if isinstance(calc.input_data, dict) else None,
-        }
-
-        # Create PDF file on disk
-        create_pdf(payload, filename=pdf_path)
+        # Identical quotes are rendered once and copied from the PDF cache
+        os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+        shutil.copyfile(pdf_cache.get_or_render(quotation_payload(calc)), pdf_path)
 
         # Attach relative path to the model's FileField (relative to MEDIA_ROOT)
-        calc.pdf_file = f"pdfs/quotation_{calc_id}.pdf"
-        calc.save()
+        calc.pdf_file = pdf_name
+        calc.save(update_fields=["pdf_file"])
+        return pdf_name
     except Exception as e:
         logger.error(f"PDF generation failed: {e}")
 
 
+PDF_BUNDLE_DIR = "bundles"  # under MEDIA_ROOT
+
+
+def pdf_bundle_path(bundle_id):
+    return os.path.join(settings.MEDIA_ROOT, PDF_BUNDLE_DIR, f"{bundle_id}.zip")
+
+
+def export_pdf_bundle(calc_ids):
+    """
+    Start a bundle export of paid calculations and return its id.
+
+    Each PDF renders as its own generate_pdf_task on the "pdf" queue, so the work
+    spreads over every pdf worker process; once all are done build_pdf_bundle zips
+    them into pdf_bundle_path(bundle_id). The chord callback runs under the bundle
+    id, so AsyncResult(bundle_id) reports the export's state.
+    """
+    bundle_id = uuid.uuid4().hex
+    chord(generate_pdf_task.si(calc_id) for calc_id in calc_ids)(
+        build_pdf_bundle.s(bundle_id).set(task_id=bundle_id)
+    )
+    return bundle_id
+
+
+@shared_task
+def build_pdf_bundle(pdf_names, bundle_id):
+    """Chord callback: stream the rendered PDFs from disk into one ZIP (stored, PDFs are already compressed)."""
+    path = pdf_bundle_path(bundle_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_STORED) as bundle:
+        for pdf_name in pdf_names:
+            if pdf_name:  # None when that PDF failed to render
+                bundle.write(os.path.join(settings.MEDIA_ROOT, pdf_name), arcname=os.path.basename(pdf_name))
+    os.replace(tmp, path)
+    logger.info(f"PDF bundle {bundle_id}: {sum(1 for n in pdf_names if n)} of {len(pdf_names)} quotations")
+    return bundle_id
+
+
+@shared_task
+def cleanup_pdf_bundles():
+    """Delete bundle exports older than PDF_BUNDLE_TTL seconds."""
+    directory = os.path.join(settings.MEDIA_ROOT, PDF_BUNDLE_DIR)
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - settings.PDF_BUNDLE_TTL
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.unlink(entry.path)
+            removed += 1
+    return removed
+
+
+
+
+
+
+
+
+
+@shared_task
+def flush_calculation_results():
+    """Drain write-behind CalculationResult rows into the database."""
+    from .utils import write_behind
+    if not write_behind.enabled():
+        return 0
+    total = 0
+    while True:
+        flushed = write_behind.flush()
+        total += flushed
+        if flushed < settings.CALCULATION_FLUSH_BATCH:
+            break
+    if total:
+        logger.info(f"Flushed {total} calculation results")
+    return total
+
+
+RECONCILE_CURSOR_KEY = "mpesa:reconcile-cursor"
+RECONCILE_LOCK_KEY = "mpesa:reconcile-lock"
+
+
+@shared_task
+def reconcile_pending_payments():
+    """
+    Resolve transactions stuck in Pending because their callback never arrived.
+
+    Pages through stale Pending rows in id order (keyset pagination on the partial
+    index), asks STK Query about each page concurrently with a bounded pool at no
+    more than MPESA_RECONCILE_RATE queries/s, and applies each page's results in one
+    short bulk transaction. At most MPESA_RECONCILE_MAX_ROWS rows per run; the cursor
+    is kept in the cache so the next run resumes where this one stopped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import timedelta
+    from .utils.mpesa import query_stk_status
+    from .utils.circuit_breaker import CircuitOpenError
+
+    if not cache.add(RECONCILE_LOCK_KEY, 1, timeout=settings.MPESA_RECONCILE_LOCK_TIMEOUT):
+        return 0  # previous run still going
+    try:
+        now = timezone.now()
+        stale_before = now - timedelta(seconds=settings.MPESA_RECONCILE_STALE_AFTER)
+        give_up_before = now - timedelta(seconds=settings.MPESA_RECONCILE_MAX_AGE)
+        page_size = settings.MPESA_RECONCILE_PAGE_SIZE
+        max_rows = settings.MPESA_RECONCILE_MAX_ROWS
+        cursor = cache.get(RECONCILE_CURSOR_KEY, 0)
+        checked = settled = 0
+
+        def query(tx):
+            try:
+                return query_stk_status(tx[1])
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                logger.warning(f"STK query for {tx[1]} failed: {e}")
+                return None
 
+        with ThreadPoolExecutor(max_workers=settings.MPESA_RECONCILE_CONCURRENCY) as pool:
+            while checked < max_rows:
+                page = list(
+                    MpesaTransaction.objects
+                    .filter(status="Pending", id__gt=cursor, created_at__lt=stale_before,
+                            checkout_request_id__isnull=False)
+                    .order_by("id")
+                    .values_list("id", "checkout_request_id", "created_at")[:min(page_size, max_rows - checked)]
+                )
+                if not page:
+                    cursor = 0  # reached the end; start over next run
+                    break
 
+                started = time.monotonic()
+                try:
+                    codes = list(pool.map(query, page))
+                except CircuitOpenError as e:
+                    logger.warning(f"Reconciliation paused at id {cursor}: {e}")
+                    break
 
+                results = [(tx[1], code, []) for tx, code in zip(page, codes) if code is not None]
+                settled += len(settle_payments(results)) if results else 0
+                abandoned = [tx[0] for tx, code in zip(page, codes) if code is None and tx[2] < give_up_before]
+                if abandoned:
+                    MpesaTransaction.objects.filter(id__in=abandoned, status="Pending").update(status="Failed")
 
+                cursor = page[-1][0]
+                checked += len(page)
+                # Rate limit: a page of N queries takes at least N / rate seconds
+                time.sleep(max(0.0, len(page) / settings.MPESA_RECONCILE_RATE - (time.monotonic() - started)))
 
+        cache.set(RECONCILE_CURSOR_KEY, cursor, timeout=None)
+        if checked:
+            logger.info(f"Reconciled {checked} pending payments ({settled} paid), cursor at {cursor}")
+        return checked
+    finally:
+        cache.delete(RECONCILE_LOCK_KEY)
 
 
 @shared_task
@@ -79,6 +360,5 @@ def cleanup_expired_calculations():
         paid=False,
         expires_at__lt=timezone.now()
     )
-    count = expired.count()
-    expired.delete()
-    print(f"Cleaned {count} expired calculations")
\ No newline at end of file
+    count, _ = expired.delete()
+    logger.info(f"Cleaned {count} expired calculations")
\ No newline at end of file
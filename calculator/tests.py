@@ -1,3 +1,1421 @@
-from django.test import TestCase
+import asyncio
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from kenindia_core.celery import app as celery_app
+
+from .models import CalculationResult, MpesaTransaction
+from .management.commands import consume_callbacks
+from .tasks import (
+    RECONCILE_CURSOR_KEY, RECONCILE_LOCK_KEY, apply_payment_results, expire_queued_stk_pushes, parse_callback,
+    process_mpesa_callback, reconcile_pending_payments, settle_payments,
+)
+from .utils.calculations import MAX_GRID_POINTS, quote
+from .utils import callback_queue, pdf_pool, rate_store, rates_loader, write_behind
+from .utils.circuit_breaker import CircuitOpenError
+from .utils.payment_events import subscribe_payment_status
+from .utils.pdf_cache import PdfCache
+from .utils.products import PRODUCTS, get_product
+from .utils.quote_cache import QuoteCache, quote_key
+from .utils.rate_store import RateStore
+from .utils.rates_loader import DenseRates, RateTable
+
+
+def _client_quote(**overrides):
+    return {"product": "education_endowment", "dob": "1990-05-15", "term": 15, "mode": "monthly",
+            "gender": "female", "sumAssured": 500000, **overrides}
+
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class PricingKernelRegressionTests(SimpleTestCase):
+    # Values produced by the per-product functions before they shared quote_kernel():
+    # (product, term, age next birthday, gender, mode, DAB,
+    #  rate per 1000, annual and installment premium for SA 500,000, SA for a 5,000 installment).
+    # Covers the youngest and oldest rated ages and the shortest and longest terms.
+    LEGACY = [
+        ("education_endowment", 10, 20, "male", "yearly", True, 142.01, 71683.76, 71683.76, 34875.4),
+        ("education_endowment", 18, 50, "female", "monthly", False, 84.9, 42556.12, 3766.22, 663796.05),
+        ("education_endowment", 20, 19, "female", "quarterly", True, 66.01, 33588.76, 8817.05, 283541.54),
+        ("education_endowment", 10, 62, "male", "half-yearly", False, 172.12, 86275.15, 44431.7, 56266.13),
+        ("academic_advantage", 20, 54, "female", "quarterly", True, 63.87, 33156.38, 8703.55, 287239.09),
+        ("academic_advantage", 10, 17, "male", "monthly", True, 122.05, 62902.36, 5566.86, 449086.26),
+        ("academic_advantage", 15, 35, "female", "yearly", False, 76.81, 39271.03, 39271.03, 63660.15),
+        ("money_back_15", 15, 19, "female", "half-yearly", True, 119.2, 60847.74, 31336.59, 79778.95),
+        ("money_back_15", 15, 47, "male", "monthly", False, 124.6, 63080.31, 5582.61, 447819.43),
+        ("money_back_10", 10, 20, "male", "quarterly", True, 135.65, 69175.76, 18158.64, 137675.54),
+        ("money_back_10", 10, 54, "female", "yearly", False, 143.4, 72598.04, 72598.04, 34436.19),
+    ]
+
+    def test_matches_legacy_values(self):
+        for product, term, age, gender, mode, dab, rate, annual, installment, sum_assured in self.LEGACY:
+            with self.subTest(product=product, term=term, age=age, gender=gender, mode=mode, dab=dab):
+                forward = quote(product, "premium", term, mode, 500000, age, gender, dab)
+                self.assertEqual(
+                    (forward["rate_per_1000"], forward["annual_premium"], forward["installment_premium"]),
+                    (rate, annual, installment),
+                )
+                reverse = quote(product, "sum_assured", term, mode, 5000, age, gender, dab)
+                self.assertEqual(reverse["estimated_sum_assured"], sum_assured)
+
+    def test_ages_outside_the_table_have_no_rate(self):
+        for product, term, age, gender in (("education_endowment", 10, 63, "male"), ("money_back_15", 15, 18, "female"),
+                                           ("money_back_10", 10, 55, "female"), ("money_back_10", 10, 19, "male")):
+            with self.subTest(product=product, age=age), self.assertRaisesRegex(ValueError, "No rate found"):
+                quote(product, "premium", term, "yearly", 500000, age, gender, False)
+
+
+def _dob(actual_age):
+    return date(date.today().year - actual_age, 1, 1).isoformat()
+
+
+class ProductRegistryTests(TestCase):
+    def test_get_product(self):
+        self.assertIs(get_product("money_back_10"), PRODUCTS["money_back_10"])
+        self.assertIs(get_product("Money_Back_10"), PRODUCTS["money_back_10"])
+        for key in (None, "", "annuity"):
+            self.assertIsNone(get_product(key))
+
+    def test_eligibility_rules(self):
+        cases = [
+            # product, direction, amount, actual age, error
+            ("money_back_15", "premium", 49999, 30, "Min SA: KES 50,000"),
+            ("money_back_15", "premium", 50000, 17, "Age 18–45 required"),
+            ("money_back_15", "sum_assured", 1000, 46, "Age 18–45"),
+            ("money_back_15", "premium", 50000, 45, None),
+            ("money_back_10", "premium", 50000, 16, "Age Next Birthday 18–50"),  # ANB 17
+            ("money_back_10", "sum_assured", 1000, 49, None),  # ANB 50
+            ("money_back_10", "sum_assured", 1000, 50, "Age Next Birthday 18–50"),
+            ("academic_advantage", "premium", 99999, 30, "Min SA: KES 100,000"),
+            ("academic_advantage", "sum_assured", 1000, 30, None),  # no minimum premium
+            ("education_endowment", "premium", 1000, 70, None),  # no age rule; the rate table decides
+        ]
+        for key, direction, amount, age, error in cases:
+            with self.subTest(key=key, direction=direction, age=age):
+                self.assertEqual(PRODUCTS[key].eligibility_error(direction, amount, age, age + 1), error)
+
+    def test_endpoint_error_messages(self):
+        client = APIClient()
+        cases = [
+            ("premium", {"product": "money_back_10", "term": 10}, "Missing required fields."),
+            ("sum-assured", {"product": "money_back_10", "term": 10}, "Missing fields."),
+            ("premium", {"product": "money_back_10", "term": 10, "dob": "1990-02-30", "sumAssured": 1}, "Invalid date or number."),
+            ("sum-assured", {"product": "money_back_10", "term": 10, "dob": "1990-02-30", "premium": 1}, "Invalid input."),
+            ("premium", {"product": "money_back_15", "term": 15, "dob": _dob(50), "sumAssured": 50000}, "Age 18–45 required"),
+            ("sum-assured", {"product": "money_back_15", "term": 15, "dob": _dob(50), "premium": 1000}, "Age 18–45"),
+        ]
+        for endpoint, data, error in cases:
+            with self.subTest(endpoint=endpoint, error=error):
+                response = client.post(f"/api/calculate/{endpoint}/", data, format="json")
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"error": error})
+
+
+class RateArtifactTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.directory)
+        cls.path = f"{cls.directory}/rates.npz"
+        cls.source = RateTable(compiled_path=None)  # parse the workbooks once for the whole class
+        cls.source.load_all()
+        cls.source.save_compiled(cls.path)
+
+    def assertSameRates(self, loaded, expected):
+        np.testing.assert_array_equal(loaded.rates, expected.rates)  # NaN == NaN here
+        self.assertEqual(loaded.min_age, expected.min_age)
+        np.testing.assert_array_equal(loaded.terms, expected.terms)
+
+    def test_npz_round_trip(self):
+        table = RateTable(self.path)
+        for key, expected in self.source.tables.items():
+            self.assertSameRates(table.table(key), expected)
+            self.assertEqual(table.sources[key], "compiled")
+        self.assertEqual(table.version, self.source.version)
+
+    def test_vectorized_lookup_matches_get_rate(self):
+        ages, terms = np.meshgrid(np.arange(10, 70), np.arange(8, 22))
+        for key in self.source.tables:
+            rates = self.source.get_rates(key, ages, terms)
+            expected = [self.source.get_rate(key, a, t) for a, t in zip(ages.ravel(), terms.ravel())]
+            np.testing.assert_array_equal(rates.ravel(), [np.nan if r is None else r for r in expected])
+
+    def test_master_blocks_match_standalone_workbooks(self):
+        keys = [key for key in rates_loader.RATE_BLOCKS
+                if rates_loader.rate_source(key) != rates_loader.DATA_DIR / rates_loader.MASTER_RATE_FILE]
+        self.assertTrue(keys)
+        master = rates_loader.read_master_workbook(keys)
+        for key in keys:
+            with self.subTest(key=key):
+                block, standalone = master[key], self.source.tables[key]
+                self.assertEqual(block.min_age, standalone.min_age)
+                # The master sheet may list more terms and the standalone one trailing blank ages
+                columns = [list(block.terms).index(t) for t in standalone.terms] or [0]
+                rows = len(block.rates)
+                np.testing.assert_array_equal(block.rates[:, columns], standalone.rates[:rows])
+                self.assertTrue(np.isnan(standalone.rates[rows:]).all())
+
+    def test_stale_table_is_reparsed_from_its_workbook(self):
+        real_hash = rates_loader.source_hash
+
+        def edited(key):
+            return "edited" if key == "money_back_10" else real_hash(key)
+
+        table = RateTable(self.path)
+        with mock.patch.object(rates_loader, "source_hash", edited), self.assertWarnsRegex(UserWarning, "stale"):
+            self.assertSameRates(table.table("money_back_10"), self.source.tables["money_back_10"])
+        self.assertEqual(table.sources["money_back_10"], "excel")
+        table.table("money_back_15")
+        self.assertEqual(table.sources["money_back_15"], "compiled")
+
+
+def _publish_doubled_rates(version):
+    """Publish the local rates as ``version`` with every money_back_10 rate doubled."""
+    table = RateTable()
+    table.load_all()
+    old = table.tables["money_back_10"]
+    table.tables["money_back_10"] = DenseRates(old.rates * 2, old.min_age, old.terms)
+    table._version = version
+    rate_store.publish(table)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RateStoreTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.store = RateStore(check_interval=0)
+        self.before = self.store.current()
+
+    def test_new_version_swaps_in_and_old_snapshot_is_kept(self):
+        args = ("money_back_10", "premium", 10, "yearly", 500000, 30, "male", False)
+        _publish_doubled_rates("test-v2")
+        after = self.store.current()
+        self.assertEqual(after.version, "test-v2")
+        self.assertEqual(after.sources["money_back_10"], "published")
+        self.assertEqual(quote(*args, rate_table=after)["rate_per_1000"],
+                         2 * quote(*args, rate_table=self.before)["rate_per_1000"])
+        self.assertIs(self.store.current(), after)  # same version: no reload
+
+    def test_missing_artifact_keeps_current_table(self):
+        cache.set(rate_store.RATES_VERSION_KEY, "test-v3")
+        with self.assertLogs("calculator.utils.rate_store", "ERROR"):
+            self.assertIs(self.store.current(), self.before)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class QuoteCacheTests(TestCase):
+    PARAMS = {"product": "money_back_10", "direction": "premium", "term": 10, "mode": "yearly", "amount": 500000,
+              "age_next_birthday": 30, "gender": "male", "dab_included": True}
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def price(self):
+        return quote(*(self.PARAMS[k] for k in ("product", "direction", "term", "mode", "amount",
+                                                 "age_next_birthday", "gender", "dab_included")))
+
+    def test_hit_returns_the_same_quote(self):
+        compute = mock.Mock(side_effect=self.price)
+        quotes = QuoteCache()
+        first = quotes.get_or_compute(self.PARAMS, "v1", compute)
+        same_inputs = {**self.PARAMS, "mode": "Yearly", "amount": "500000.00", "gender": "Male", "dab_included": 1}
+        self.assertEqual(quotes.get_or_compute(same_inputs, "v1", compute), first)
+        self.assertEqual(QuoteCache().get_or_compute(self.PARAMS, "v1", compute), first)  # shared level
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(first, self.price())
+
+    def test_new_rate_version_makes_old_entries_unreachable(self):
+        quotes = QuoteCache()
+        quotes.set_many({quote_key(self.PARAMS, "v1"): {"stale": True}}, "v1")
+        found, missing = quotes.get_many([self.PARAMS], "v2")
+        self.assertEqual((found, list(missing.values())), ({}, [quote_key(self.PARAMS, "v2")]))
+        self.assertEqual(quotes.stats()["size"], 0)
+
+    def test_published_rates_reprice_cached_quotes(self):
+        patcher = mock.patch.object(rate_store, "rate_store", RateStore(check_interval=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("calculator.views.quote_cache", QuoteCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        body = _client_quote(product="money_back_10", term=10, dob="1996-01-01")
+
+        def priced():
+            response = APIClient().post("/api/calculate/premium/", body, format="json")
+            return CalculationResult.objects.get(pk=response.json()["calculation_id"])
+
+        before = priced()
+        self.assertEqual(priced().result_data, before.result_data)
+        _publish_doubled_rates("test-v2")
+        after = priced()
+        self.assertEqual(after.rate_version, "test-v2")
+        self.assertEqual(after.result_data["rate_per_1000"], 2 * before.result_data["rate_per_1000"])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class QuoteBatchTests(TestCase):
+    def test_bad_items_fail_alone_and_results_keep_order(self):
+        items = [
+            _client_quote(sumAssured=400000),
+            _client_quote(sumAssured="nan"),
+            _client_quote(sumAssured="inf"),
+            _client_quote(sumAssured="1e400"),
+            _client_quote(sumAssured=-5000),
+            _client_quote(direction="sideways"),
+            "not an object",
+            _client_quote(direction="sum_assured", sumAssured=None, premium=2500),
+            _client_quote(sumAssured=600000),
+        ]
+        response = APIClient().post("/api/calculate/batch/", {"quotes": items}, format="json")
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body["count"], body["succeeded"], body["failed"]), (9, 3, 6))
+        self.assertEqual([r["index"] for r in body["results"]], list(range(9)))
+        self.assertEqual([i for i, r in enumerate(body["results"]) if "calculation_id" in r], [0, 7, 8])
+
+        for index in (0, 8):
+            calc = CalculationResult.objects.get(pk=body["results"][index]["calculation_id"])
+            self.assertEqual(calc.input_data["sumAssured"], items[index]["sumAssured"])
+            single = APIClient().post("/api/calculate/premium/", items[index], format="json").json()
+            self.assertEqual(calc.result_data, CalculationResult.objects.get(pk=single["calculation_id"]).result_data)
+
+    def test_rejects_non_finite_amount_on_single_quote(self):
+        response = APIClient().post("/api/calculate/premium/", _client_quote(sumAssured="nan"), format="json")
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch("calculator.views.MAX_BATCH_QUOTES", 2)
+    def test_batch_size_limit(self):
+        client = APIClient()
+        response = client.post("/api/calculate/batch/", {"quotes": [_client_quote()] * 3}, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = client.post("/api/calculate/batch/", {"quotes": [_client_quote()] * 2}, format="json")
+        self.assertEqual(response.json()["succeeded"], 2)
+        self.assertEqual(client.post("/api/calculate/batch/", {"quotes": []}, format="json").status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class QuoteGridTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def grid(self, **data):
+        return self.client.post("/api/calculate/grid/", {"product": "education_endowment", "dob": "1990-05-15",
+                                                         "gender": "female", **data}, format="json")
+
+    def test_premium_grid_matches_single_quotes(self):
+        response = self.grid(saMin=100000, saMax=500000, saStep=100000, terms=[12, 15], modes=["yearly", "monthly"])
+        self.assertEqual(response.status_code, 200)
+        grid = response.json()
+        self.assertEqual(grid["shape"], [2, 2, 5])
+        self.assertEqual(grid["axes"]["sum_assured"], [100000, 200000, 300000, 400000, 500000])
+        self.assertEqual(len(grid["installment_premium"]), 20)
+
+        values = np.array(grid["installment_premium"], dtype=float).reshape(grid["shape"])
+        for (t, term), (m, mode), (s, sa) in itertools.product(
+            enumerate(grid["axes"]["term"]), enumerate(grid["axes"]["mode"]), [(0, 100000), (4, 500000)],
+        ):
+            expected = quote("education_endowment", "premium", term, mode, sa, grid["age_next_birthday"], "female", True)
+            self.assertAlmostEqual(values[t, m, s], expected["installment_premium"], places=2)
+
+    def test_age_grid_nulls_ineligible_cells(self):
+        response = self.grid(product="money_back_15", kind="age", sumAssured=100000, mode="yearly")
+        grid = response.json()
+        values = np.array(grid["installment_premium"], dtype=float).reshape(grid["shape"])
+        for age, row in zip(grid["axes"]["age_next_birthday"], values):
+            with self.subTest(age=age):
+                # money_back_15 is sold at actual ages 18-45
+                self.assertEqual(bool(np.isnan(row).all()), not 18 <= age - 1 <= 45)
+
+        response = self.grid(product="money_back_15", kind="age", sumAssured=10000, mode="yearly")  # below min SA
+        self.assertTrue(all(v is None for v in response.json()["installment_premium"]))
+
+    def test_size_limit_checked_before_allocating(self):
+        for data in ({"saMax": 1e13, "saStep": 1}, {"saMax": 1e6, "saStep": 1e-300},
+                     {"saMin": 100000, "saMax": 100000 + MAX_GRID_POINTS, "saStep": 1}):
+            response = self.grid(**data)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Grid too large", response.json()["error"])
+
+    def test_rejects_non_finite_range(self):
+        for data in ({"saMax": "nan"}, {"saMin": "inf"}, {"saStep": "-inf"}, {"saMin": -1000, "saMax": 1000}):
+            self.assertEqual(self.grid(**data).status_code, 400)
+
+
+class _KeyValueRedis:
+    """The handful of Redis commands write-behind uses, in memory (bytes in, bytes out)."""
+
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value).encode()
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(str(v).encode() for v in values)
+
+    def lrange(self, key, start, end):
+        return self.data.get(key, [])[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self.data.get(key, [])[start:]
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.data.setdefault(key, []).insert(0, str(value).encode())
+
+    def llen(self, key):
+        return len(self.data.get(key, []))
+
+    def lmove(self, source, destination, src="LEFT", dest="RIGHT"):
+        if not self.data.get(source):
+            return None
+        value = self.data[source].pop(0 if src == "LEFT" else -1)
+        self.data.setdefault(destination, []).insert(0 if dest == "LEFT" else len(self.data[destination]), value)
+        return value
+
+    def blmove(self, source, destination, timeout, src="LEFT", dest="RIGHT"):
+        return self.lmove(source, destination, src, dest)
+
+    def pipeline(self, transaction=True):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+            def execute(self):
+                return [getattr(redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+        return Pipeline()
+
+
+@override_settings(CALCULATION_WRITE_BEHIND=True)
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.redis = _KeyValueRedis()
+        for target, value in (("_redis", lambda: self.redis), ("cache", mock.MagicMock())):
+            patcher = mock.patch.object(write_behind, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(write_behind, "id_generator", write_behind.IdGenerator())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def calcs(self, n):
+        return [CalculationResult(product="money_back_10", input_data={"n": i}, result_data={"premium": i},
+                                  expires_at=timezone.now() + timedelta(minutes=1)) for i in range(n)]
+
+    def test_ids_unique_and_increasing_across_workers(self):
+        first, second = write_behind.IdGenerator(), write_behind.IdGenerator()
+        self.assertNotEqual(first.worker_id, second.worker_id)
+        ids = [first.next_id() for _ in range(1000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertFalse(set(ids) & {second.next_id() for _ in range(1000)})
+
+    def test_lost_lease_moves_to_another_worker_id(self):
+        generator = write_behind.IdGenerator()
+        old = generator.worker_id
+        self.redis.data[write_behind.WORKER_LEASE_KEY.format(id=old)] = b"another-process"
+        generator._renew_at = 0  # renewal is due
+        self.assertNotEqual(generator.worker_id, old)
+
+    def test_no_lease_means_direct_insert(self):
+        for worker_id in range(1 << write_behind.WORKER_BITS):
+            self.redis.set(write_behind.WORKER_LEASE_KEY.format(id=worker_id), "taken")
+        with self.assertRaises(write_behind.WorkerIdUnavailable):
+            write_behind.IdGenerator().next_id()
+        saved = write_behind.save_calculations(self.calcs(3))
+        self.assertEqual(CalculationResult.objects.filter(pk__in=[c.id for c in saved]).count(), 3)
+        self.assertNotIn(write_behind.PENDING_QUEUE_KEY, self.redis.data)
+
+    def test_flush_and_persist_round_trip(self):
+        saved = write_behind.save_calculations(self.calcs(5))
+        self.assertFalse(CalculationResult.objects.exists())
+
+        fetched = write_behind.get_calculation(saved[2].id)  # inserted on demand
+        self.assertEqual(fetched.input_data, {"n": 2})
+        self.assertEqual(write_behind.flush(), 5)
+        self.assertEqual(
+            sorted(CalculationResult.objects.values_list("id", "input_data")),
+            [(c.id, {"n": i}) for i, c in enumerate(saved)],
+        )
+        self.assertEqual(self.redis.lrange(write_behind.PENDING_QUEUE_KEY, 0, -1), [])
+
+    def test_flush_reports_id_collision(self):
+        queued, = write_behind.save_calculations(self.calcs(1))
+        CalculationResult.objects.bulk_create([CalculationResult(
+            id=queued.id, product="education_endowment", input_data={"other": True}, result_data={},
+        )])
+        with self.assertLogs("calculator.utils.write_behind", "ERROR") as logs:
+            write_behind.flush()
+        self.assertIn(f"collision on {queued.id}", logs.output[0])
+        self.assertEqual(CalculationResult.objects.get(pk=queued.id).input_data, {"other": True})
+
+
+class PaymentPathQueryBudgetTests(TestCase):
+    """Fail if a payment-path endpoint starts issuing more queries than it needs."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.calc = CalculationResult.objects.create(
+            product="money_back_10", input_data={}, result_data={}, amount_due=5,
+        )
+
+    def test_status_poll(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f"/api/calculate/status/{self.calc.id}/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_status_poll_rejects_unsafe_methods(self):
+        with self.assertNumQueries(0):
+            response = self.client.post(f"/api/calculate/status/{self.calc.id}/")
+        self.assertEqual(response.status_code, 405)
+
+    def test_download(self):
+        with self.assertNumQueries(1):
+            self.client.get(f"/api/calculate/download/{self.calc.id}/")
+
+    @mock.patch("calculator.utils.mpesa_async.initiate_stk_push", new_callable=mock.AsyncMock)
+    def test_stk_push(self, initiate_stk_push):
+        initiate_stk_push.return_value = {"MerchantRequestID": "m-1", "CheckoutRequestID": "ws_CO_1"}
+        with self.assertNumQueries(2):  # calculation lookup + transaction insert
+            response = self.client.post(
+                "/api/mpesa/stk_push/",
+                {"phone_number": "0712345678", "amount": 5, "calculation_id": self.calc.id},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id="ws_CO_1").calculation_id, self.calc.id)
+
+    def test_stk_push_fails_fast_when_circuit_open(self):
+        from .utils.mpesa import breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        self.addCleanup(breaker.record_success)
+        with self.assertNumQueries(1):  # calculation lookup only; nothing is sent
+            response = self.client.post(
+                "/api/mpesa/stk_push/",
+                {"phone_number": "0712345678", "amount": 5, "calculation_id": self.calc.id},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+    @mock.patch("calculator.views.process_mpesa_callback.delay")
+    def test_callback_view(self, delay):
+        body = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_1", "ResultCode": 0}}}
+        with self.assertNumQueries(0):
+            self.client.post("/api/mpesa/callback/", body, format="json")
+        delay.assert_called_once()
+
+    @mock.patch("calculator.tasks.generate_pdf_task.delay")
+    def test_callback_processing(self, delay):
+        MpesaTransaction.objects.create(
+            phone_number="254712345678", amount=5, checkout_request_id="ws_CO_1", calculation=self.calc,
+        )
+        metadata = [{"Name": "MpesaReceiptNumber", "Value": "QK1"}, {"Name": "Amount", "Value": 5}]
+        # conditional update, calculation id, paid update (+ savepoint/release under TestCase)
+        with self.assertNumQueries(5):
+            process_mpesa_callback.apply(args=("ws_CO_1", 0, metadata))
+        self.calc.refresh_from_db()
+        self.assertTrue(self.calc.paid)
+
+        # A redelivered callback stops at the conditional update and triggers nothing
+        with self.assertNumQueries(3):
+            process_mpesa_callback.apply(args=("ws_CO_1", 0, metadata))
+        delay.assert_called_once_with(self.calc.id)
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    @mock.patch("calculator.views.process_mpesa_callback.delay")
+    def test_callback_view_enqueues_each_checkout_once(self, delay):
+        body = {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_9", "ResultCode": 0}}}
+        for _ in range(3):
+            response = self.client.post("/api/mpesa/callback/", body, format="json")
+            self.assertEqual(response.json()["ResultCode"], 0)
+        delay.assert_called_once()
+
+
+    @override_settings(CACHES=LOCMEM_CACHE)
+    @mock.patch("calculator.views.process_mpesa_callback.delay")
+    def test_callback_without_checkout_id_is_logged_not_deduped(self, delay):
+        body = {"Body": {"stkCallback": {"ResultCode": 0}}}
+        with self.assertLogs("calculator.views", "WARNING"):
+            response = self.client.post("/api/mpesa/callback/", body, format="json")
+        self.assertEqual(response.json()["ResultCode"], 0)
+        self.assertIsNone(cache.get("mpesa:callback-seen:None"))
+        delay.assert_not_called()
+
+@override_settings(CACHES=LOCMEM_CACHE, PAYMENT_EVENTS_BROKER="memory")
+class DarajaSimulatorTests(TestCase):
+    """A payment end to end through the real views, against the local Daraja simulator."""
+
+    def setUp(self):
+        from .utils import mpesa
+        from .utils.daraja_simulator import CallbackDispatcher, DarajaSimulator, SimulatorConfig
+
+        self.simulator = DarajaSimulator(SimulatorConfig(latency=0, jitter=0, decline_rate=0,
+                                                         callback_delay=0, callback_jitter=0))
+        server = self.simulator.make_server(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.callbacks = []  # what the simulator would POST to the CallBackURL
+        for target, attribute, value in (
+            (mpesa, "MPESA_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}"),
+            (mpesa, "_token", {"token": None, "refresh_at": 0.0}),
+            (mpesa, "cache", _StubTokenCache(None)),
+            (CallbackDispatcher, "_send", staticmethod(lambda url, body: self.callbacks.append(body))),
+            (process_mpesa_callback, "delay", lambda *args: process_mpesa_callback.apply(args=args)),
+        ):
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("calculator.tasks.generate_pdf_task.delay")
+        self.generate_pdf = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = APIClient()
+        self.calc = CalculationResult.objects.create(
+            product="money_back_10", input_data={}, result_data={}, amount_due=5,
+        )
+
+    def push(self):
+        response = self.client.post("/api/mpesa/stk_push/", {
+            "phone_number": "0712345678", "amount": 5, "calculation_id": self.calc.id,
+        }, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()["CheckoutRequestID"]
+
+    def next_callback(self):
+        deadline = time.monotonic() + 5
+        while not self.callbacks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.callbacks.pop(0)
+
+    def test_paid(self):
+        checkout_id = self.push()
+        callback = self.next_callback()
+        for _ in range(2):  # Safaricom redelivers
+            response = self.client.post("/api/mpesa/callback/", callback, format="json")
+            self.assertEqual(response.json()["ResultCode"], 0)
+
+        tx = MpesaTransaction.objects.get(checkout_request_id=checkout_id)
+        receipt = next(i["Value"] for i in callback["Body"]["stkCallback"]["CallbackMetadata"]["Item"]
+                       if i["Name"] == "MpesaReceiptNumber")
+        self.assertEqual((tx.status, tx.mpesa_receipt_number), ("Success", receipt))
+        self.assertEqual(self.client.get(f"/api/calculate/status/{self.calc.id}/").json(),
+                         {"paid": True, "expired": False})
+        self.generate_pdf.assert_called_once_with(self.calc.id)
+
+    def test_declined(self):
+        self.simulator.config.decline_rate = 1
+        checkout_id = self.push()
+        self.client.post("/api/mpesa/callback/", self.next_callback(), format="json")
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id=checkout_id).status, "Failed")
+        self.assertFalse(CalculationResult.objects.get(pk=self.calc.id).paid)
+
+    @override_settings(MPESA_RECONCILE_STALE_AFTER=-60, MPESA_RECONCILE_RATE=1000)
+    @mock.patch("calculator.tasks.group")
+    def test_lost_callback_settled_by_reconciliation(self, group):
+        checkout_id = self.push()
+        self.next_callback()  # never delivered
+        self.assertEqual(reconcile_pending_payments(), 1)
+        self.assertEqual(MpesaTransaction.objects.get(checkout_request_id=checkout_id).status, "Success")
+        self.assertTrue(CalculationResult.objects.get(pk=self.calc.id).paid)
+        self.assertEqual([sig.args for sig in group.call_args.args[0]], [(self.calc.id,)])
+
+
+@override_settings(MPESA_STK_QUEUE=True, MPESA_STK_QUEUE_MAX=1, MPESA_STK_QUEUE_TTL=300)
+class QueuedStkPushTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def push(self):
+        return self.client.post("/api/mpesa/stk_push/", {"phone_number": "0712345678", "amount": 5}, format="json")
+
+    def queued(self, age):
+        tx = MpesaTransaction.objects.create(phone_number="254712345678", amount=5, status="Queued")
+        MpesaTransaction.objects.filter(pk=tx.pk).update(created_at=timezone.now() - timedelta(seconds=age))
+        return tx
+
+    @mock.patch("calculator.views.send_stk_push.delay")
+    def test_only_queued_rows_inside_ttl_count_toward_max(self, delay):
+        self.queued(age=600)
+        self.assertEqual(self.push().status_code, 202)
+        delay.assert_called_once()
+        self.assertEqual(self.push().status_code, 503)
+
+    def test_expire_fails_stale_queued_rows_only(self):
+        stale, fresh = self.queued(age=600), self.queued(age=10)
+        with self.assertLogs("calculator.tasks", "WARNING"):
+            self.assertEqual(expire_queued_stk_pushes(), 1)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, fresh.status), ("Failed", "Queued"))
+
+    @override_settings(MPESA_STK_QUEUE=False)
+    @mock.patch("calculator.utils.mpesa_async.initiate_stk_push", new_callable=mock.AsyncMock)
+    def test_push_failure_does_not_leak_exception_text(self, initiate_stk_push):
+        initiate_stk_push.side_effect = RuntimeError("401 for url https://sandbox.safaricom.co.ke/?secret=x")
+        with self.assertLogs("calculator.views", "ERROR"):
+            response = self.push()
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.json(), {"error": "M-Pesa request failed. Please try again."})
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHE, MPESA_RECONCILE_STALE_AFTER=120, MPESA_RECONCILE_MAX_AGE=3600, MPESA_RECONCILE_PAGE_SIZE=2,
+    MPESA_RECONCILE_MAX_ROWS=3, MPESA_RECONCILE_CONCURRENCY=2, MPESA_RECONCILE_RATE=1000,
+)
+class ReconcilePendingPaymentsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.txs = [self.pending(f"ws_CO_{i}", age=600) for i in range(5)]
+        self.pending("ws_CO_fresh", age=10)  # its callback may still arrive
+        self.queried = []
+        self.results = {}
+        patcher = mock.patch("calculator.utils.mpesa.query_stk_status", side_effect=self.query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for target in ("calculator.tasks.group", "calculator.tasks.publish_payment_status"):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def pending(self, checkout_id, age):
+        tx = MpesaTransaction.objects.create(
+            phone_number="254712345678", amount=5, checkout_request_id=checkout_id,
+            calculation=CalculationResult.objects.create(
+                product="money_back_10", input_data={}, result_data={}, amount_due=5,
+            ),
+        )
+        MpesaTransaction.objects.filter(pk=tx.pk).update(created_at=timezone.now() - timedelta(seconds=age))
+        return tx
+
+    def query(self, checkout_id):
+        self.queried.append(checkout_id)
+        result = self.results.get(checkout_id)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def status(self, tx):
+        tx.refresh_from_db()
+        return tx.status
+
+    def test_pages_in_id_order_and_resumes_from_saved_cursor(self):
+        self.assertEqual(reconcile_pending_payments(), 3)  # MPESA_RECONCILE_MAX_ROWS
+        self.assertEqual(self.queried, ["ws_CO_0", "ws_CO_1", "ws_CO_2"])
+        self.assertEqual(cache.get(RECONCILE_CURSOR_KEY), self.txs[2].id)
+
+        self.queried.clear()
+        self.assertEqual(reconcile_pending_payments(), 2)
+        self.assertEqual(self.queried, ["ws_CO_3", "ws_CO_4"])
+        self.assertEqual(cache.get(RECONCILE_CURSOR_KEY), 0)  # reached the end: start over next run
+        self.assertIsNone(cache.get(RECONCILE_LOCK_KEY))
+
+    def test_settles_answered_queries(self):
+        self.results = {"ws_CO_0": 0, "ws_CO_1": 1032}
+        reconcile_pending_payments()
+        self.assertEqual([self.status(tx) for tx in self.txs[:3]], ["Success", "Failed", "Pending"])
+        self.assertTrue(CalculationResult.objects.get(pk=self.txs[0].calculation_id).paid)
+
+    def test_skips_run_while_another_holds_the_lock(self):
+        cache.add(RECONCILE_LOCK_KEY, 1)
+        self.assertEqual(reconcile_pending_payments(), 0)
+        self.assertEqual(self.queried, [])
+
+    def test_gives_up_on_unanswered_rows_past_max_age(self):
+        MpesaTransaction.objects.filter(pk=self.txs[0].pk).update(created_at=timezone.now() - timedelta(hours=2))
+        self.results = {"ws_CO_1": RuntimeError("timeout")}
+        with self.assertLogs("calculator.tasks", "WARNING"):
+            reconcile_pending_payments()
+        self.assertEqual([self.status(tx) for tx in self.txs[:3]], ["Failed", "Pending", "Pending"])
+
+    def test_pauses_when_circuit_opens(self):
+        self.results = {"ws_CO_2": CircuitOpenError("M-Pesa", 30)}
+        with self.assertLogs("calculator.tasks", "WARNING") as logs:
+            self.assertEqual(reconcile_pending_payments(), 2)
+        self.assertIn("paused", logs.output[0])
+        self.assertEqual(cache.get(RECONCILE_CURSOR_KEY), self.txs[1].id)  # the failed page is retried next run
+        self.assertEqual(self.status(self.txs[2]), "Pending")
+
+    @override_settings(MPESA_RECONCILE_RATE=4)
+    def test_paces_queries_to_rate(self):
+        with mock.patch("calculator.tasks.time.sleep") as sleep:
+            reconcile_pending_payments()
+        pauses = [c.args[0] for c in sleep.call_args_list]
+        self.assertEqual(len(pauses), 2)
+        self.assertAlmostEqual(pauses[0], 2 / 4, delta=0.1)  # page of 2 at 4 queries/s
+        self.assertAlmostEqual(pauses[1], 1 / 4, delta=0.1)
+
+
+class QueryStkStatusTests(SimpleTestCase):
+    def setUp(self):
+        from .utils import mpesa
+        self.mpesa = mpesa
+        for target, value in (("get_access_token", mock.Mock(return_value="token")),
+                              ("_request", mock.Mock())):
+            patcher = mock.patch.object(mpesa, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def respond(self, status_code, body=None):
+        self.mpesa._request.return_value = mock.Mock(status_code=status_code, json=mock.Mock(return_value=body or {}))
+
+    def test_result_code(self):
+        self.respond(200, {"ResultCode": "1032", "ResultDesc": "Request cancelled by user"})
+        self.assertEqual(self.mpesa.query_stk_status("ws_CO_1"), 1032)
+        payload = self.mpesa._request.call_args.kwargs["json"]
+        self.assertEqual(payload["CheckoutRequestID"], "ws_CO_1")
+        self.assertEqual(self.mpesa._request.call_args.args[2], "stk_query")
+
+    def test_still_processing(self):
+        self.respond(500, {"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"})
+        self.assertIsNone(self.mpesa.query_stk_status("ws_CO_1"))
+
+    def test_rejected_token_is_dropped(self):
+        self.respond(401)
+        with mock.patch.object(self.mpesa, "invalidate_access_token") as invalidate:
+            self.assertIsNone(self.mpesa.query_stk_status("ws_CO_1"))
+        invalidate.assert_called_once_with()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CallbackBatchingTests(TestCase):
+    def setUp(self):
+        self.redis = _KeyValueRedis()
+        patcher = mock.patch.object(callback_queue, "_redis", lambda: self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calcs = [
+            CalculationResult.objects.create(product="money_back_10", input_data={}, result_data={}, amount_due=5)
+            for _ in range(3)
+        ]
+        for i, calc in enumerate(self.calcs):
+            MpesaTransaction.objects.create(
+                phone_number="254712345678", amount=5, checkout_request_id=f"ws_CO_{i}", calculation=calc,
+            )
+
+    def queued(self, key=callback_queue.CALLBACK_QUEUE_KEY):
+        return [json.loads(raw) for raw in self.redis.data.get(key, [])]
+
+    def status(self, checkout_id):
+        return MpesaTransaction.objects.get(checkout_request_id=checkout_id).status
+
+    def test_next_batch_moves_callbacks_to_processing_until_ack(self):
+        for i in range(5):
+            callback_queue.enqueue_callback(f"ws_CO_{i}", 0, [])
+        batch = callback_queue.next_batch("c1", max_size=3, max_wait=0)
+        self.assertEqual([json.loads(raw)[0] for raw in batch], ["ws_CO_0", "ws_CO_1", "ws_CO_2"])
+        processing = callback_queue.CALLBACK_PROCESSING_KEY.format(consumer="c1")
+        self.assertEqual(self.redis.data[processing], batch)
+        self.assertEqual(callback_queue.queue_depth(), 2)
+
+        callback_queue.ack("c1")
+        self.assertEqual(self.redis.llen(processing), 0)
+        self.assertEqual(len(callback_queue.next_batch("c1", max_size=3, max_wait=0)), 2)
+        self.assertEqual(callback_queue.next_batch("c1", max_size=3, max_wait=0), [])
+
+    def test_requeue_puts_processing_list_back_in_order(self):
+        for i in range(4):
+            callback_queue.enqueue_callback(f"ws_CO_{i}", 0, [])
+        callback_queue.next_batch("c1", max_size=2, max_wait=0)
+        self.assertEqual(callback_queue.requeue("c1"), 2)
+        self.assertEqual([c[0] for c in self.queued()], ["ws_CO_0", "ws_CO_1", "ws_CO_2", "ws_CO_3"])
+        self.assertEqual(callback_queue.requeue("c1"), 0)
+
+    def test_parse_callback_rejects_poison(self):
+        self.assertEqual(parse_callback("ws_CO_0", "0", []), ("ws_CO_0", 0, []))
+        for bad in ((None, 0, []), ("ws_CO_0", "oops", []), ("ws_CO_0", None, []), ("ws_CO_0", 0, {})):
+            with self.assertRaises(ValueError):
+                parse_callback(*bad)
+
+    def test_apply_payment_results(self):
+        receipt = [{"Name": "Amount", "Value": 5}, {"Value": "no name"}, {"Name": "MpesaReceiptNumber", "Value": "QK1"}]
+        paid = apply_payment_results([
+            ("ws_CO_0", 0, receipt),
+            ("ws_CO_0", 1, []),  # redelivery: the first result wins
+            ("ws_CO_1", 1032, []),
+            ("ws_CO_unknown", 0, []),
+        ])
+        self.assertEqual(paid, [self.calcs[0].id])
+        tx = MpesaTransaction.objects.get(checkout_request_id="ws_CO_0")
+        self.assertEqual((tx.status, tx.mpesa_receipt_number), ("Success", "QK1"))
+        self.assertEqual(self.status("ws_CO_1"), "Failed")
+        self.assertEqual(self.status("ws_CO_2"), "Pending")
+        self.assertEqual(list(CalculationResult.objects.filter(paid=True).values_list("id", flat=True)),
+                         [self.calcs[0].id])
+        self.assertEqual(apply_payment_results([("ws_CO_0", 0, receipt)]), [])  # already applied
+
+    @mock.patch("calculator.tasks.publish_payment_status")
+    @mock.patch("calculator.tasks.group")
+    def test_settle_payments_follows_up_paid_calculations_only(self, group, publish):
+        paid = settle_payments([("ws_CO_0", 0, []), ("ws_CO_1", 0, []), ("ws_CO_2", 1, [])])
+        self.assertEqual(paid, [self.calcs[0].id, self.calcs[1].id])
+        self.assertEqual([c.args for c in publish.call_args_list], [(calc_id, {"paid": True}) for calc_id in paid])
+        self.assertEqual([sig.args for sig in group.call_args.args[0]], [(calc_id,) for calc_id in paid])
+        group.return_value.apply_async.assert_called_once_with()
+
+        group.reset_mock()
+        self.assertEqual(settle_payments([("ws_CO_0", 0, [])]), [])
+        group.assert_not_called()
+
+    def run_consumer(self):
+        real_next_batch = consume_callbacks.next_batch
+
+        def next_batch(*args):
+            batch = real_next_batch(*args)
+            if not batch:
+                raise KeyboardInterrupt  # queue drained: stop the consumer
+            return batch
+
+        with mock.patch.object(consume_callbacks, "next_batch", next_batch), \
+                mock.patch.object(consume_callbacks.time, "sleep"), \
+                mock.patch("calculator.tasks.group"), mock.patch("calculator.tasks.publish_payment_status"):
+            call_command("consume_callbacks", consumer="c1", stdout=io.StringIO())
+
+    def test_command_recovers_crashed_batch_and_dead_letters_poison(self):
+        # A batch the previous run took but never acknowledged
+        self.redis.rpush(callback_queue.CALLBACK_PROCESSING_KEY.format(consumer="c1"), json.dumps(["ws_CO_0", 0, []]))
+        callback_queue.enqueue_callback("ws_CO_1", "not-a-code", [])
+        self.redis.rpush(callback_queue.CALLBACK_QUEUE_KEY, "{not json")
+        callback_queue.enqueue_callback("ws_CO_2", 0, [{"Value": "no name"}])
+        with self.assertLogs(consume_callbacks.logger, "WARNING"):
+            self.run_consumer()
+
+        self.assertEqual([self.status(f"ws_CO_{i}") for i in range(3)], ["Success", "Pending", "Success"])
+        dead = self.queued(callback_queue.CALLBACK_DEAD_KEY)
+        self.assertEqual([d["callback"] for d in dead], [json.dumps(["ws_CO_1", "not-a-code", []]), "{not json"])
+        self.assertEqual(self.redis.llen(callback_queue.CALLBACK_QUEUE_KEY), 0)
+        self.assertEqual(self.redis.llen(callback_queue.CALLBACK_PROCESSING_KEY.format(consumer="c1")), 0)
+        self.assertEqual(cache.get(callback_queue.CALLBACK_STATS_KEY)["payments_confirmed"], 2)
+
+    def test_command_applies_one_at_a_time_when_batch_fails(self):
+        for i in range(3):
+            callback_queue.enqueue_callback(f"ws_CO_{i}", 0, [])
+        real_settle = consume_callbacks.settle_payments
+
+        def settle_payments(callbacks):
+            if any(c[0] == "ws_CO_1" for c in callbacks):
+                raise ValueError("value too long for type character varying(100)")
+            return real_settle(callbacks)
+
+        with mock.patch.object(consume_callbacks, "settle_payments", settle_payments), self.assertLogs(consume_callbacks.logger):
+            self.run_consumer()
+        self.assertEqual([self.status(f"ws_CO_{i}") for i in range(3)], ["Success", "Pending", "Success"])
+        self.assertEqual([json.loads(d["callback"])[0] for d in self.queued(callback_queue.CALLBACK_DEAD_KEY)],
+                         ["ws_CO_1"])
+
+    def test_command_requeues_batch_when_database_is_down(self):
+        for i in range(2):
+            callback_queue.enqueue_callback(f"ws_CO_{i}", 0, [])
+        real_settle = consume_callbacks.settle_payments
+        calls = iter([OperationalError("connection refused")])
+
+        def settle_payments(callbacks):
+            error = next(calls, None)
+            if error:
+                raise error
+            return real_settle(callbacks)
+
+        with mock.patch.object(consume_callbacks, "settle_payments", settle_payments), self.assertLogs(consume_callbacks.logger):
+            self.run_consumer()
+        self.assertEqual([self.status(f"ws_CO_{i}") for i in range(2)], ["Success", "Success"])
+        self.assertNotIn(callback_queue.CALLBACK_DEAD_KEY, self.redis.data)
+
+
+@skipUnlessDBFeature("has_select_for_update_skip_locked")
+class CallbackSkipLockedTests(TransactionTestCase):
+    def test_rows_locked_by_another_consumer_are_left_to_it(self):
+        for i in range(2):
+            MpesaTransaction.objects.create(
+                phone_number="254712345678", amount=5, checkout_request_id=f"ws_CO_{i}",
+                calculation=CalculationResult.objects.create(
+                    product="money_back_10", input_data={}, result_data={}, amount_due=5,
+                ),
+            )
+        locked, release = threading.Event(), threading.Event()
+
+        def other_consumer():
+            with transaction.atomic():
+                MpesaTransaction.objects.select_for_update().get(checkout_request_id="ws_CO_0")
+                locked.set()
+                release.wait(5)
+            connection.close()
+
+        thread = threading.Thread(target=other_consumer)
+        thread.start()
+        self.assertTrue(locked.wait(5))
+        try:
+            paid = apply_payment_results([("ws_CO_0", 0, []), ("ws_CO_1", 1, [])])
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(paid, [])
+        statuses = dict(MpesaTransaction.objects.values_list("checkout_request_id", "status"))
+        self.assertEqual(statuses, {"ws_CO_0": "Pending", "ws_CO_1": "Failed"})
+
+
+class _StubSession:
+    """requests.Session stand-in for Daraja: counts OAuth fetches and answers STK pushes from ``push_statuses``."""
+
+    def __init__(self, push_statuses=(200,)):
+        self.push_statuses = list(push_statuses)
+        self.oauth_calls = 0
+        self.push_tokens = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if "/oauth/" in url:
+            self.oauth_calls += 1
+            return mock.Mock(status_code=200, text="", json=lambda: {
+                "access_token": f"token-{self.oauth_calls}", "expires_in": "3599",
+            }, raise_for_status=lambda: None)
+        self.push_tokens.append(kwargs["headers"]["Authorization"])
+        status_code = self.push_statuses.pop(0) if len(self.push_statuses) > 1 else self.push_statuses[0]
+        return mock.Mock(status_code=status_code, text="", json=lambda: {"ResponseCode": str(status_code)})
+
+
+class _StubTokenCache:
+    """The cache calls the token code makes; ``stored`` lists what get() returns in turn."""
+
+    def __init__(self, *stored):
+        self.stored = list(stored)
+        self.sets = []
+        self.lock = mock.MagicMock()
+        self.lock.return_value.acquire.return_value = True
+
+    def get(self, key):
+        return self.stored.pop(0) if len(self.stored) > 1 else (self.stored or [None])[0]
+
+    def set(self, key, value, timeout=None):
+        self.sets.append((key, value, timeout))
+        self.stored = [value]
+
+    def delete(self, key):
+        self.stored = [None]
+
+
+class MpesaTokenCacheTests(SimpleTestCase):
+    def setUp(self):
+        from .utils import mpesa
+        self.mpesa = mpesa
+        self.session = _StubSession()
+        self.cache = _StubTokenCache(None)
+        for target, value in (("session", self.session), ("cache", self.cache),
+                              ("_token", {"token": None, "refresh_at": 0.0})):
+            patcher = mock.patch.object(mpesa, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_reused_until_refresh_margin(self):
+        self.assertEqual(self.mpesa.get_access_token(), "token-1")
+        self.assertEqual(self.mpesa.get_access_token(), "token-1")  # in-process hit
+        self.assertEqual(self.session.oauth_calls, 1)
+        key, entry, timeout = self.cache.sets[0]
+        self.assertEqual(key, self.mpesa.TOKEN_CACHE_KEY)
+        self.assertAlmostEqual(entry["refresh_at"] - time.time(), 3599 - self.mpesa.TOKEN_REFRESH_MARGIN, delta=5)
+
+        with mock.patch("calculator.utils.mpesa.time.time", return_value=entry["refresh_at"] + 1):
+            self.cache.stored = [None]  # the shared entry has expired with it
+            self.assertEqual(self.mpesa.get_access_token(), "token-2")
+        self.assertEqual(self.session.oauth_calls, 2)
+
+    def test_token_shared_through_cache(self):
+        self.cache.stored = [{"token": "from-redis", "refresh_at": time.time() + 600}]
+        self.assertEqual(self.mpesa.get_access_token(), "from-redis")
+        self.assertEqual(self.session.oauth_calls, 0)
+        self.cache.lock.assert_not_called()
+
+    def test_token_refreshed_by_another_process_while_waiting_for_lock(self):
+        self.cache.stored = [None, {"token": "from-redis", "refresh_at": time.time() + 600}]
+        self.assertEqual(self.mpesa.get_access_token(), "from-redis")
+        self.assertEqual(self.session.oauth_calls, 0)
+        self.cache.lock.assert_called_once_with(self.mpesa.TOKEN_LOCK_KEY, timeout=30, blocking_timeout=15)
+        self.cache.lock.return_value.release.assert_called_once_with()
+
+    def test_unauthorized_push_refreshes_token_once(self):
+        self.session.push_statuses = [401, 200]
+        self.assertEqual(self.mpesa.initiate_stk_push("254712345678", 5), {"ResponseCode": "200"})
+        self.assertEqual(self.session.push_tokens, ["Bearer token-1", "Bearer token-2"])
+        self.assertEqual(self.session.oauth_calls, 2)
+
+        self.session.push_statuses = [401]  # still rejected: no retry loop
+        self.session.push_tokens.clear()
+        self.assertEqual(self.mpesa.initiate_stk_push("254712345678", 5), {"ResponseCode": "401"})
+        self.assertEqual(self.session.push_tokens, ["Bearer token-2", "Bearer token-3"])
+
+
+class CircuitBreakerProbeTests(SimpleTestCase):
+    def setUp(self):
+        from .utils import mpesa
+        self.breaker = mpesa.breaker
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+        self.addCleanup(self.breaker.record_success)
+        patcher = mock.patch.object(self.breaker, "reset_timeout", 0)  # half-open straight away
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_cancelled_probe_frees_the_circuit(self):
+        from .utils import mpesa_async
+        async def hang(*args, **kwargs):
+            await asyncio.Event().wait()
+
+        client = mock.Mock(request=hang)
+        with mock.patch.object(mpesa_async, "get_client", return_value=client):
+            probe = asyncio.ensure_future(mpesa_async._request("POST", "http://daraja.test/", "stk_push"))
+            await asyncio.sleep(0.01)
+            with self.assertRaises(CircuitOpenError):  # the probe is in flight
+                self.breaker.before_call()
+            probe.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await probe
+        self.breaker.before_call()  # the next caller may probe
+
+    def test_interrupted_probe_frees_the_circuit(self):
+        from .utils import mpesa
+        with mock.patch.object(mpesa.session, "request", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                mpesa._request("POST", "http://daraja.test/", "stk_push")
+        self.breaker.before_call()
+
+
+@override_settings(PAYMENT_EVENTS_BROKER="memory")
+class PaymentStatusPushTests(TestCase):
+    def setUp(self):
+        self.calc = CalculationResult.objects.create(
+            product="money_back_10", input_data={}, result_data={}, amount_due=5,
+        )
+        MpesaTransaction.objects.create(
+            phone_number="254712345678", amount=5, checkout_request_id="ws_CO_2", calculation=self.calc,
+        )
+
+    async def _read_stream(self, response):
+        return "".join([chunk.decode() async for chunk in response.streaming_content])
+
+    @mock.patch("calculator.tasks.generate_pdf_task.delay")
+    async def test_pushes_paid_event(self, delay):
+        response = await self.async_client.get(f"/api/calculate/status/{self.calc.id}/stream/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        event = asyncio.ensure_future(self._read_stream(response))
+        await asyncio.sleep(0.05)  # let the stream subscribe
+        await sync_to_async(process_mpesa_callback.apply)(args=("ws_CO_2", 0, []))
+        self.assertIn('"paid": true', await asyncio.wait_for(event, 5))
+
+    async def test_expired(self):
+        await CalculationResult.objects.filter(pk=self.calc.id).aupdate(
+            expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        response = await self.async_client.get(f"/api/calculate/status/{self.calc.id}/stream/")
+        self.assertIn('"expired": true', await asyncio.wait_for(self._read_stream(response), 5))
+
+    @mock.patch("calculator.tasks.generate_pdf_task.delay")
+    async def test_long_poll_returns_on_payment(self, delay):
+        response = asyncio.ensure_future(self.async_client.get(f"/api/calculate/status/{self.calc.id}/?wait=25"))
+        await asyncio.sleep(0.05)
+        await sync_to_async(process_mpesa_callback.apply)(args=("ws_CO_2", 0, []))
+        response = await asyncio.wait_for(response, 5)
+        self.assertEqual(response.json(), {"paid": True, "expired": False})
+
+    async def test_long_poll_times_out(self):
+        response = await self.async_client.get(f"/api/calculate/status/{self.calc.id}/?wait=0.1")
+        self.assertEqual(response.json(), {"paid": False, "expired": False})
+
+
+class _StubPubSub:
+    """Behaves like redis.asyncio's PubSub: the subscribe confirmation is the first message read."""
+
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.channels = set()
+        self.closed = False
+
+    async def subscribe(self, channel):
+        self.channels.add(channel)
+        self.messages.put_nowait({"type": "subscribe", "channel": channel.encode(), "data": 1})
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            message = await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if isinstance(message, Exception):
+            raise message
+        if ignore_subscribe_messages and message["type"] == "subscribe":
+            return None
+        return message
+
+    def publish(self, data, channel=None):
+        channel = channel or next(iter(self.channels))
+        self.messages.put_nowait({"type": "message", "channel": channel.encode(), "data": json.dumps(data)})
+
+    async def unsubscribe(self, channel):
+        self.channels.discard(channel)
+
+    async def aclose(self):
+        self.closed = True
+
+
+class _StubRedis:
+    def __init__(self):
+        self.pubsub_ = _StubPubSub()
+
+    def pubsub(self):
+        return self.pubsub_
+
+    async def aclose(self):
+        pass
+
+
+@override_settings(PAYMENT_EVENTS_BROKER="redis")
+class RedisPaymentEventsTests(TestCase):
+    def setUp(self):
+        self.redis = _StubRedis()
+        patcher = mock.patch("redis.asyncio.Redis.from_url", return_value=self.redis)
+        self.from_url = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calc = CalculationResult.objects.create(
+            product="money_back_10", input_data={}, result_data={}, amount_due=5,
+        )
+
+    async def test_subscribers_share_one_connection(self):
+        other = await CalculationResult.objects.acreate(product="money_back_10", input_data={}, result_data={})
+        channel = f"payments:calc:{self.calc.id}"
+        async with subscribe_payment_status(self.calc.id) as first, \
+                subscribe_payment_status(self.calc.id) as second, \
+                subscribe_payment_status(other.id) as third:
+            self.assertEqual(self.from_url.call_count, 1)
+            self.assertEqual(self.redis.pubsub_.channels, {channel, f"payments:calc:{other.id}"})
+            self.redis.pubsub_.publish({"paid": True}, channel)
+            self.assertEqual(await first(5), {"paid": True})
+            self.assertEqual(await second(5), {"paid": True})
+            self.assertIsNone(await third(0.05))
+        self.assertTrue(self.redis.pubsub_.closed)  # last waiter gone
+
+        self.redis.pubsub_ = _StubPubSub()
+        async with subscribe_payment_status(self.calc.id):
+            self.assertEqual(self.from_url.call_count, 2)
+
+    async def test_lost_connection_reaches_waiters(self):
+        async with subscribe_payment_status(self.calc.id) as next_message:
+            with self.assertLogs("calculator.utils.payment_events", "WARNING"):
+                self.redis.pubsub_.messages.put_nowait(ConnectionError("Connection reset by peer"))
+                with self.assertRaises(ConnectionError):
+                    await next_message(5)
+
+    async def test_next_message_waits_past_subscribe_confirmation(self):
+        async with subscribe_payment_status(self.calc.id) as next_message:
+            started = time.monotonic()
+            self.assertIsNone(await next_message(0.3))
+            self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+            asyncio.get_running_loop().call_later(0.05, self.redis.pubsub_.publish, {"paid": True})
+            self.assertEqual(await next_message(5), {"paid": True})
+
+    @mock.patch("calculator.views.SSE_KEEPALIVE_SECONDS", 0.3)
+    async def test_stream_first_keepalive_after_full_interval(self):
+        response = await self.async_client.get(f"/api/calculate/status/{self.calc.id}/stream/")
+        stream = aiter(response.streaming_content)
+        started = time.monotonic()
+        self.assertEqual((await asyncio.wait_for(anext(stream), 5)).decode(), ": keep-alive\n\n")
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+        self.redis.pubsub_.publish({"paid": True})
+        self.assertIn('"paid": true', (await asyncio.wait_for(anext(stream), 5)).decode())
+        with self.assertRaises(StopAsyncIteration):  # run the stream's cleanup on this loop
+            await anext(stream)
+
+    async def test_long_poll_waits(self):
+        started = time.monotonic()
+        response = await self.async_client.get(f"/api/calculate/status/{self.calc.id}/?wait=0.3")
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(response.json(), {"paid": False, "expired": False})
+
+    async def test_long_poll_ignores_non_finite_wait(self):
+        for wait in ("nan", "inf", "-inf"):
+            response = await asyncio.wait_for(
+                self.async_client.get(f"/api/calculate/status/{self.calc.id}/?wait={wait}"), 1,
+            )
+            self.assertEqual(response.json(), {"paid": False, "expired": False})
+
+
+class PdfQuotationTests(TestCase):
+    payload = {
+        "product": "money_back_10",
+        "input": {"gender": "female", "mode": "monthly", "term": 10},
+        "results": {"basic_premium": 1000, "estimated_sum_assured": 100000},
+    }
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        patcher = mock.patch("calculator.utils.pdf_pool.pdf_cache", PdfCache(directory=cache_dir))
+        self.pdf_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def _read(self, response):
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    async def test_renders_in_pool_then_streams_from_cache(self):
+        for _ in range(2):
+            response = await self.async_client.post("/api/generate-pdf/", self.payload, content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue((await self._read(response)).startswith(b"%PDF"))
+        self.assertEqual(self.pdf_cache.stats()["stores"], 1)
+        self.assertEqual(self.pdf_cache.stats()["hits"], 1)
+
+    def test_wsgi_gets_file_response(self):
+        response = self.client.post("/api/generate-pdf/", self.payload, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.is_async)  # not buffered whole by the WSGI handler
+        body = b"".join(response.streaming_content)
+        self.assertTrue(body.startswith(b"%PDF"))
+        self.assertEqual(int(response["Content-Length"]), len(body))
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="kenindia_quotation.pdf"')
+        response.close()
+
+    async def test_download_revalidates_with_etag(self):
+        calc = await CalculationResult.objects.acreate(
+            product="money_back_10", input_data=self.payload["input"], result_data=self.payload["results"], paid=True,
+        )
+        response = await self.async_client.get(f"/api/calculate/download/{calc.id}/pdf/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response["Content-Length"]), len(await self._read(response)))
+
+        response = await self.async_client.get(f"/api/calculate/download/{calc.id}/pdf/",
+                                               headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.pdf_cache.stats()["hits"] + self.pdf_cache.stats()["misses"], 1)
+
+    @override_settings(PDF_ACCEL_REDIRECT_PREFIX="/protected/pdf-cache/")
+    async def test_accel_redirect(self):
+        response = await self.async_client.post("/api/generate-pdf/", self.payload, content_type="application/json")
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected/pdf-cache/{response['ETag'][1:3]}/{response['ETag'][1:-1]}.pdf")
+        self.assertEqual(response.content, b"")
+
+    @override_settings(PDF_RENDER_QUEUE_MAX=0)
+    def test_busy_pool_answers_503(self):
+        response = self.client.post("/api/generate-pdf/", self.payload, content_type="application/json")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+    async def test_cancelled_render_cleans_up_when_the_process_finishes(self):
+        started, release = threading.Event(), threading.Event()
+
+        def render(payload, tmp):
+            started.set()
+            release.wait(5)
+            with open(tmp, "wb") as f:
+                f.write(b"%PDF-late")
+
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        with mock.patch.object(pdf_pool, "get_executor", return_value=executor), \
+                mock.patch.object(pdf_pool.pdf_generator, "create_pdf", render):
+            task = asyncio.ensure_future(pdf_pool.render_pdf(self.payload))
+            await sync_to_async(started.wait)(5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(pdf_pool._in_flight, 1)  # the render is still running
+
+            release.set()
+            await sync_to_async(executor.shutdown)()  # wait for the render to finish
+        self.assertEqual(pdf_pool._in_flight, 0)
+        self.assertEqual(self.pdf_cache.stats()["stores"], 0)
+        self.assertEqual([name for _, _, names in os.walk(self.pdf_cache.directory) for name in names], [])
+
+    def test_eviction_sweeps_abandoned_temporary_files(self):
+        stale, fresh = self.pdf_cache.reserve("ab" * 32), self.pdf_cache.reserve("ab" * 32)
+        an_hour_ago = time.time() - self.pdf_cache.tmp_max_age - 1
+        os.utime(stale, (an_hour_ago, an_hour_ago))
+        self.pdf_cache.evict()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_bundle_export(self):
+        user = User.objects.create_user("agent")
+        client = APIClient()
+        client.force_authenticate(user)
+        paid = [
+            CalculationResult.objects.create(product="money_back_10", input_data=self.payload["input"],
+                                             result_data=self.payload["results"], paid=True)
+            for _ in range(3)
+        ]
+        unpaid = CalculationResult.objects.create(product="money_back_10", input_data={}, result_data={})
+
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        with override_settings(MEDIA_ROOT=media, CACHES=LOCMEM_CACHE), \
+                mock.patch("calculator.tasks.pdf_cache", self.pdf_cache):
+            response = client.post("/api/generate-pdf/bundle/",
+                                   {"calculation_ids": [c.id for c in paid] + [unpaid.id]}, format="json")
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data["skipped"], [unpaid.id])
+            status_url = response.data["status_url"]
+            response = client.get(status_url)
+            self.assertEqual(response["Content-Type"], "application/zip")
+            self.assertFalse(response.is_async)  # WSGI gets a plain file iterator
+            body = b"".join(response.streaming_content)
+            self.assertEqual(int(response["Content-Length"]), len(body))
+            with zipfile.ZipFile(io.BytesIO(body)) as bundle:
+                self.assertEqual(sorted(bundle.namelist()), sorted(f"quotation_{c.id}.pdf" for c in paid))
+
+            self.async_client.force_login(user)
+            response = async_to_sync(self.async_client.get)(status_url)
+            self.assertTrue(response.is_async)  # ASGI gets async chunks
+            self.assertEqual(async_to_sync(self._read)(response), body)
+        self.assertEqual(self.pdf_cache.stats()["stores"], 1)  # identical quotes render once
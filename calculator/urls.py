@@ -4,11 +4,19 @@ from . import views
 urlpatterns = [
     path('calculate/premium/', views.calculate_premium, name='calculate_premium'),
     path('calculate/sum-assured/', views.calculate_sum_assured, name='calculate_sum_assured'),
+    path('calculate/batch/', views.calculate_batch, name='calculate_batch'),
+    path('calculate/grid/', views.calculate_grid, name='calculate_grid'),
+    path('calculate/cache-stats/', views.quote_cache_stats, name='quote_cache_stats'),
     path("mpesa/stk_push/", views.stk_push_view, name="stk_push"),
     # legacy / external clients may call 'stkpush' without underscore — keep an alias for compatibility
     path("mpesa/stkpush/", views.stk_push_view, name="stk_push_alias"),
     path("mpesa/callback/", views.stk_callback_view, name="stk_callback"),
     path('calculate/status/<int:calc_id>/', views.check_calculation_status, name='check_calc_status'),
+    path('calculate/status/<int:calc_id>/stream/', views.payment_status_stream, name='payment_status_stream'),
     path('calculate/download/<int:calc_id>/', views.download_result, name='download_result'),
+    path('calculate/download/<int:calc_id>/pdf/', views.download_pdf, name='download_pdf'),
     path('generate-pdf/', views.generate_pdf_quotation, name='generate_pdf'),
+    path('generate-pdf/cache-stats/', views.pdf_cache_stats, name='pdf_cache_stats'),
+    path('generate-pdf/bundle/', views.create_pdf_bundle, name='create_pdf_bundle'),
+    path('generate-pdf/bundle/<str:bundle_id>/', views.download_pdf_bundle, name='pdf_bundle'),
 ]
@@ -1,279 +1,77 @@
 # backend/calculator/utils/calculations.py
-from .rates_loader import RateTable
+import numpy as np
 
-# Initialize rate loader
-rate_loader = RateTable()
+from .products import PRODUCTS
+from .rate_store import current_rates
+
+MODE_FACTORS = {"yearly": 1.0, "half-yearly": 0.5150, "quarterly": 0.2625, "monthly": 0.0885}
+PHCF_RATE = 0.0025  # Policy Holders' Compensation Fund levy on the annual premium
 
 # ===================== EDUCATION ENDOWMENT =====================
 
 def get_rate_for_education_endowment(discounted_age, term):
-    return rate_loader.get_rate("education_endowment", discounted_age, term)
+    return current_rates().get_rate("education_endowment", discounted_age, term)
 
 
 def get_education_endowment_benefits(sum_assured, term):
-    benefits = {
-        "Grade 9": round(0.15 * sum_assured, 2),
-        "Grade 10": round(0.15 * sum_assured, 2),
-        "Grade 11": round(0.15 * sum_assured, 2),
-        "Grade 12": round(0.15 * sum_assured, 2),
-    }
-    accrued_bonus = 0.10 * sum_assured * term
-    maturity = 0.50 * sum_assured + accrued_bonus
-    benefits["1st Year University/College (Maturity)"] = round(maturity, 2)
-    benefits["Accrued Bonus (included above)"] = round(accrued_bonus, 2)
-    return benefits
+    return product_benefits(PRODUCTS["education_endowment"], sum_assured, term)
 
 
 def calculate_premium_logic(product, term, mode, sum_assured, age_next_birthday, gender, smoker, dab_included):
-    if product.lower() != "education_endowment":
-        raise ValueError(f"Unsupported product '{product}'")
-
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
-    rate_per_1000 = get_rate_for_education_endowment(discounted_age, term)
-    if rate_per_1000 is None:
-        raise ValueError(f"No rate found for discounted age {discounted_age}, term {term}")
-
-    basic_premium = (sum_assured / 1000.0) * rate_per_1000
-    dab = sum_assured * 0.001 if dab_included else 0
-    wp = 0
-    total_before_phcf = basic_premium + dab + wp
-    phcf = total_before_phcf * 0.0025
-    annual_premium = total_before_phcf + phcf
-
-    mode_factors = {"yearly": 1.0, "half-yearly": 0.5150, "quarterly": 0.2625, "monthly": 0.0885}
-    factor = mode_factors.get(mode.lower())
-    installment_premium = annual_premium * factor
-
-    return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "basic_premium": round(basic_premium, 2),
-        "dab": round(dab, 2),
-        "wp": round(wp, 2),
-        "phcf": round(phcf, 2),
-        "annual_premium": round(annual_premium, 2),
-        "installment_premium": round(installment_premium, 2),
-        "benefits": get_education_endowment_benefits(sum_assured, term),
-    }
+    return _scalar_quote("education_endowment", "premium", product, term, mode, sum_assured, age_next_birthday, gender, dab_included)
 
 
 def calculate_sum_assured_logic(product, term, mode, premium, age_next_birthday, gender, smoker, dab_included):
-    if product.lower() != "education_endowment":
-        raise ValueError(f"Unsupported product '{product}'")
-
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
-    rate_per_1000 = get_rate_for_education_endowment(discounted_age, term)
-
-    mode_factors = {"yearly": 1.0, "half-yearly": 0.5150, "quarterly": 0.2625, "monthly": 0.0885}
-    factor = mode_factors.get(mode.lower())
-    annual_premium = premium / factor
-    total_before_phcf = annual_premium / 1.0025
-    dab_rate = 0.001 if dab_included else 0
-    sum_assured = total_before_phcf / (rate_per_1000 / 1000 + dab_rate)
-
-    return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "estimated_sum_assured": round(sum_assured, 2),
-        "benefits": get_education_endowment_benefits(sum_assured, term),
-    }
+    return _scalar_quote("education_endowment", "sum_assured", product, term, mode, premium, age_next_birthday, gender, dab_included)
 
 
 # ===================== ACADEMIC ADVANTAGE =====================
 
 def get_rate_for_academic_advantage(discounted_age, term):
-    return rate_loader.get_rate("academic_advantage", discounted_age, term)
+    return current_rates().get_rate("academic_advantage", discounted_age, term)
 
 
 def get_academic_advantage_benefits(sum_assured, term):
-    accrued_bonus = 0.10 * sum_assured * term
-    return {
-        f"Year {term - 3}": round(0.20 * sum_assured, 2),
-        f"Year {term - 2}": round(0.20 * sum_assured, 2),
-        f"Year {term - 1}": round(0.30 * sum_assured, 2),
-        f"Year {term} (Maturity)": round(0.30 * sum_assured + accrued_bonus, 2),
-        "Accrued Bonus (included above)": round(accrued_bonus, 2),
-    }
+    return product_benefits(PRODUCTS["academic_advantage"], sum_assured, term)
 
 
 def calculate_premium_logic_academic_advantage(product, term, mode, sum_assured, age_next_birthday, gender, smoker, dab_included):
-    if product.lower() != "academic_advantage":
-        raise ValueError(f"Unsupported product '{product}'")
-
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
-    rate_per_1000 = get_rate_for_academic_advantage(discounted_age, term)
-    basic_premium = (sum_assured / 1000.0) * rate_per_1000
-    dab = sum_assured * 0.001 if dab_included else 0
-    wp = 0.02 * basic_premium
-    total_before_phcf = basic_premium + dab + wp
-    phcf = total_before_phcf * 0.0025
-    annual_premium = total_before_phcf + phcf
-
-    mode_factors = {"yearly": 1.0, "half-yearly": 0.5150, "quarterly": 0.2625, "monthly": 0.0885}
-    factor = mode_factors.get(mode.lower())
-    installment_premium = annual_premium * factor
-
-    return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "basic_premium": round(basic_premium, 2),
-        "dab": round(dab, 2),
-        "wp": round(wp, 2),
-        "phcf": round(phcf, 2),
-        "annual_premium": round(annual_premium, 2),
-        "installment_premium": round(installment_premium, 2),
-        "benefits": get_academic_advantage_benefits(sum_assured, term),
-    }
+    return _scalar_quote("academic_advantage", "premium", product, term, mode, sum_assured, age_next_birthday, gender, dab_included)
 
 
 def calculate_sum_assured_logic_academic_advantage(product, term, mode, premium, age_next_birthday, gender, smoker, dab_included):
-    if product.lower() != "academic_advantage":
-        raise ValueError(f"Unsupported product '{product}'")
-
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
-    rate_per_1000 = get_rate_for_academic_advantage(discounted_age, term)
-    mode_factors = {"yearly": 1.0, "half-yearly": 0.5150, "quarterly": 0.2625, "monthly": 0.0885}
-    factor = mode_factors.get(mode.lower())
-    annual_premium = premium / factor
-    total_before_phcf = annual_premium / 1.0025
-    dab_rate = 0.001 if dab_included else 0
-    sum_assured = total_before_phcf / ((rate_per_1000 / 1000) * 1.02 + dab_rate)
-
-    return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "estimated_sum_assured": round(sum_assured, 2),
-        "benefits": get_academic_advantage_benefits(sum_assured, term),
-    }
+    return _scalar_quote("academic_advantage", "sum_assured", product, term, mode, premium, age_next_birthday, gender, dab_included)
 
 
 # ===================== 15-YEAR MONEY BACK PLAN =====================
 
 def get_rate_for_money_back_15(discounted_age, term):
-    return rate_loader.get_rate("money_back_15", discounted_age, term)
-
-
+    return current_rates().get_rate("money_back_15", discounted_age, term)
 
 
 def get_money_back_15_benefits(sum_assured, term):
     """
     Benefits for 15-Year Money Back Plan:
-      - 15% of Sum Assured at end of 3rd year
-      - 15% of Sum Assured at end of 6th year
-      - 15% of Sum Assured at end of 9th year
-      - 15% of Sum Assured at end of 12th year
+      - 15% of Sum Assured at end of 3rd, 6th, 9th and 12th year
       - 100% of Sum Assured + Accrued Bonus at maturity (end of 15th year)
       - Accrued Bonus = 10% × Sum Assured × Term
     """
-    # This plan is defined for a 15-year term; validate to avoid silent mistakes.
-    if int(term) != 15:
-        raise ValueError("15-Year Money Back Plan benefits are defined for a 15-year term.")
-
-    accrued_bonus = 0.10 * sum_assured * term
-
-    benefits = {
-        "End of 3rd Year": round(0.15 * sum_assured, 2),
-        "End of 6th Year": round(0.15 * sum_assured, 2),
-        "End of 9th Year": round(0.15 * sum_assured, 2),
-        "End of 12th Year": round(0.15 * sum_assured, 2),
-        "Maturity (15th Year)": round(1.00 * sum_assured + accrued_bonus, 2),
-        "Accrued Bonus (included above)": round(accrued_bonus, 2),
-    }
-    return benefits
+    return product_benefits(PRODUCTS["money_back_15"], sum_assured, term)
 
 
 def calculate_premium_logic_money_back_15(product, term, mode, sum_assured, age_next_birthday, gender, smoker, dab_included):
-    if product.lower() != "money_back_15":
-        raise ValueError(f"Unsupported product '{product}'")
-
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
-    rate_per_1000 = get_rate_for_money_back_15(discounted_age, term)
-    if rate_per_1000 is None:
-        raise ValueError(f"No rate found for discounted age {discounted_age}, term {term}")
-
-    basic_premium = (sum_assured / 1000.0) * rate_per_1000
-    dab = sum_assured * 0.001 if dab_included else 0
-    wp = 0.01 * basic_premium
-    total_before_phcf = basic_premium + dab + wp
-    phcf = total_before_phcf * 0.0025
-    annual_premium = total_before_phcf + phcf
-
-    mode_factors = {"yearly": 1.0, "half-yearly": 0.5150, "quarterly": 0.2625, "monthly": 0.0885}
-    factor = mode_factors.get(mode.lower())
-    installment_premium = annual_premium * factor
-
-    return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "basic_premium": round(basic_premium, 2),
-        "dab": round(dab, 2),
-        "wp": round(wp, 2),
-        "phcf": round(phcf, 2),
-        "annual_premium": round(annual_premium, 2),
-        "installment_premium": round(installment_premium, 2),
-        "benefits": get_money_back_15_benefits(sum_assured, term),
-    }
-
-
+    return _scalar_quote("money_back_15", "premium", product, term, mode, sum_assured, age_next_birthday, gender, dab_included)
 
 
 def calculate_sum_assured_logic_money_back_15(product, term, mode, premium, age_next_birthday, gender, smoker, dab_included):
-    if product.lower() != "money_back_15":
-        raise ValueError(f"Unsupported product '{product}'")
-
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
-    rate_per_1000 = get_rate_for_money_back_15(discounted_age, term)
-    if rate_per_1000 is None:
-        raise ValueError(f"No rate found for discounted age {discounted_age}, term {term}")
-
-    mode_factors = {"yearly": 1.0, "half-yearly": 0.5150, "quarterly": 0.2625, "monthly": 0.0885}
-    factor = mode_factors.get(mode.lower())
-    if factor is None:
-        raise ValueError(f"Invalid payment mode: {mode}")
-
-    # Step 1: Convert installment premium → annual
-    annual_premium = premium / factor
-
-    # Step 2: Remove PHCF (0.25%)
-    total_before_phcf = annual_premium / 1.0025
-
-    # Step 3: Remove DAB and WP (1% of basic premium)
-    dab_rate = 0.001 if dab_included else 0
-    basic_rate_per_1000 = rate_per_1000 / 1000.0
-    wp_factor = 1.01  # Because WP = 1% of basic premium → total risk = 1.01 × basic
-
-    # Final formula: total_before_phcf = (SA / 1000) × (basic_rate + DAB_rate) × 1.01
-    sum_assured = total_before_phcf / (basic_rate_per_1000 * wp_factor + dab_rate)
-
-    return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "estimated_sum_assured": round(sum_assured, 2),
-        "benefits": get_money_back_15_benefits(sum_assured, term),
-    }
-# === End of calculations.py ===
-
-
-
-
-
-
-
-
-
+    return _scalar_quote("money_back_15", "sum_assured", product, term, mode, premium, age_next_birthday, gender, dab_included)
 
 
 # === 10-YEAR MONEY BACK PLAN (KUMI BORA WITH PROFIT) ===
 
 def get_rate_for_money_back_10(discounted_age, term):
     """Fetch rate per 1,000 for the 10-Year Money Back plan (1D table)."""
-    return rate_loader.get_rate("money_back_10", discounted_age, term)  # term ignored
+    return current_rates().get_rate("money_back_10", discounted_age, term)  # term ignored
 
 
 def get_money_back_10_benefits(sum_assured, term):
@@ -283,18 +81,7 @@ def get_money_back_10_benefits(sum_assured, term):
       • 100% SA + Accrued Bonus at maturity (year 10)
       • Accrued Bonus = 10% × SA × 10 = 100% of SA
     """
-    if int(term) != 10:
-        raise ValueError("10-Year Money Back Plan is only for 10-year term.")
-
-    accrued_bonus = 0.10 * sum_assured * term  # = 1.0 × sum_assured
-
-    return {
-        "End of 4th Year": round(0.10 * sum_assured, 2),
-        "End of 6th Year": round(0.10 * sum_assured, 2),
-        "End of 8th Year": round(0.10 * sum_assured, 2),
-        "Maturity (10th Year)": round(1.00 * sum_assured + accrued_bonus, 2),
-        "Accrued Bonus (included above)": round(accrued_bonus, 2),
-    }
+    return product_benefits(PRODUCTS["money_back_10"], sum_assured, term)
 
 
 def calculate_premium_logic_money_back_10(
@@ -302,107 +89,279 @@ def calculate_premium_logic_money_back_10(
     gender, smoker, dab_included
 ):
     """SA → Premium (Forward Calculation)"""
-    if product.lower() != "money_back_10":
-        raise ValueError(f"Unsupported product '{product}'")
+    return _scalar_quote("money_back_10", "premium", product, term, mode, sum_assured, age_next_birthday, gender, dab_included)
 
-    if int(term) != 10:
-        raise ValueError("Term must be 10 for 10-Year Money Back Plan")
 
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
-
-    rate_per_1000 = get_rate_for_money_back_10(discounted_age, term)
-    if rate_per_1000 is None:
-        raise ValueError(f"No rate found for discounted age {discounted_age}")
+def calculate_sum_assured_logic_money_back_10(
+    product, term, mode, premium, age_next_birthday,
+    gender, smoker, dab_included
+):
+    """Premium → SA (Reverse Calculation)"""
+    return _scalar_quote("money_back_10", "sum_assured", product, term, mode, premium, age_next_birthday, gender, dab_included)
 
-    # Basic Premium
-    basic_premium = (sum_assured / 1000.0) * rate_per_1000
 
-    # Riders
-    dab = sum_assured * 0.001 if dab_included else 0        # 0.1% of SA
-    wp = basic_premium * 0.01                               # 1% of Basic
+# ===================== SHARED PRICING KERNEL =====================
 
-    # Total before PHCF
-    total_before_phcf = basic_premium + dab + wp
+def product_benefits(product, sum_assured, term):
+    """Benefit schedule for a registry product: survival payouts, maturity, accrued bonus."""
+    if product.fixed_term is not None and int(term) != product.fixed_term:
+        raise ValueError(f"{product.name} benefits are defined for a {product.fixed_term}-year term.")
 
-    # PHCF 0.25%
-    phcf = total_before_phcf * 0.0025
-    annual_premium = total_before_phcf + phcf
+    accrued_bonus = product.bonus_rate * sum_assured * term
+    benefits = {}
+    for payout in product.payouts:
+        label = payout.label.format(term=term, year=term - payout.years_before_maturity)
+        benefits[label] = round(payout.fraction * sum_assured, 2)
+    maturity_label = product.maturity_label.format(term=term)
+    benefits[maturity_label] = round(product.maturity_fraction * sum_assured + accrued_bonus, 2)
+    benefits["Accrued Bonus (included above)"] = round(accrued_bonus, 2)
+    return benefits
 
-    # Installment Premium
-    mode_factors = {
-        "yearly": 1.0000,
-        "half-yearly": 0.5150,
-        "quarterly": 0.2625,
-        "monthly": 0.0885,
-    }
-    factor = mode_factors.get(mode.lower())
-    if factor is None:
-        raise ValueError(f"Invalid mode: {mode}")
 
-    installment_premium = annual_premium * factor
+def quote_kernel(product, direction, amounts, terms, mode_factors, ages_next_birthday, female, dab_included, rate_table=None):
+    """
+    Price an array of quotes for one product.
 
-    return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "basic_premium": round(basic_premium, 2),
-        "dab": round(dab, 2),
-        "wp": round(wp, 2),
-        "phcf": round(phcf, 2),
-        "annual_premium": round(annual_premium, 2),
-        "installment_premium": round(installment_premium, 2),
-        "benefits": get_money_back_10_benefits(sum_assured, term),
-    }
+    ``direction`` is "premium" (amounts are sums assured) or "sum_assured" (amounts are
+    installment premiums). All other inputs are arrays or scalars broadcastable to
+    ``amounts``. Returns a dict of float arrays; rows with no rate or an unknown mode
+    come back as NaN.
 
+    Forward:  basic = SA/1000 × rate; DAB = SA × dab_rate; WP = basic × wp_rate
+              annual = (basic + DAB + WP) × (1 + PHCF); installment = annual × mode factor
+    Reverse:  solve the same equation for SA given the installment premium.
 
-def calculate_sum_assured_logic_money_back_10(
-    product, term, mode, premium, age_next_birthday,
-    gender, smoker, dab_included
-):
-    """Premium → SA (Reverse Calculation)"""
-    if product.lower() != "money_back_10":
-        raise ValueError(f"Unsupported product '{product}'")
+    ``rate_table`` is the RateTable snapshot to price with (default: the live one).
+    """
+    amounts = np.asarray(amounts, dtype=np.float64)
+    terms = np.broadcast_to(np.asarray(terms, dtype=np.int64), amounts.shape)
+    mode_factors = np.asarray(mode_factors, dtype=np.float64)
+    discounted_ages = np.asarray(ages_next_birthday, dtype=np.int64) - np.where(female, 4, 2)
+    discounted_ages = np.broadcast_to(discounted_ages, amounts.shape)
+    dab_rates = np.where(dab_included, product.dab_rate, 0.0)
+
+    rates = (rate_table or current_rates()).get_rates(product.key, discounted_ages, terms)
+
+    if direction == "premium":
+        sum_assured = amounts
+        basic_premium = (sum_assured / 1000.0) * rates
+        dab = sum_assured * dab_rates
+        wp = product.wp_rate * basic_premium
+        total_before_phcf = basic_premium + dab + wp
+        phcf = total_before_phcf * PHCF_RATE
+        annual_premium = total_before_phcf + phcf
+        installment_premium = annual_premium * mode_factors
+    elif direction == "sum_assured":
+        installment_premium = amounts
+        annual_premium = installment_premium / mode_factors
+        total_before_phcf = annual_premium / (1 + PHCF_RATE)
+        sum_assured = total_before_phcf / ((rates / 1000) * (1 + product.wp_rate) + dab_rates)
+        basic_premium = (sum_assured / 1000.0) * rates
+        dab = sum_assured * dab_rates
+        wp = product.wp_rate * basic_premium
+        phcf = total_before_phcf * PHCF_RATE
+    else:
+        raise ValueError(f"Unknown direction '{direction}'")
 
-    if int(term) != 10:
-        raise ValueError("Term must be 10 for 10-Year Money Back Plan")
+    return {
+        "discounted_age": discounted_ages,
+        "term": terms,
+        "rate_per_1000": rates,
+        "sum_assured": sum_assured,
+        "basic_premium": basic_premium,
+        "dab": dab,
+        "wp": wp,
+        "phcf": phcf,
+        "annual_premium": annual_premium,
+        "installment_premium": installment_premium,
+    }
 
-    discount = 4 if gender.lower() == "female" else 2
-    discounted_age = age_next_birthday - discount
 
-    rate_per_1000 = get_rate_for_money_back_10(discounted_age, term)
-    if rate_per_1000 is None:
-        raise ValueError(f"No rate found for age {discounted_age}")
+def kernel_result(product, direction, arrays, k):
+    """Build the response dict for row ``k`` of a quote_kernel() result."""
+    rate = arrays["rate_per_1000"][k]
+    if np.isnan(rate):
+        raise ValueError(
+            f"No rate found for discounted age {int(arrays['discounted_age'][k])}, term {int(arrays['term'][k])}"
+        )
 
-    mode_factors = {
-        "yearly": 1.0000,
-        "half-yearly": 0.5150,
-        "quarterly": 0.2625,
-        "monthly": 0.0885,
+    sum_assured = float(arrays["sum_assured"][k])
+    result = {
+        "discounted_age": int(arrays["discounted_age"][k]),
+        "rate_per_1000": float(rate),
     }
-    factor = mode_factors.get(mode.lower())
+    if direction == "premium":
+        for field in ("basic_premium", "dab", "wp", "phcf", "annual_premium", "installment_premium"):
+            result[field] = round(float(arrays[field][k]), 2)
+    else:
+        result["estimated_sum_assured"] = round(sum_assured, 2)
+    result["benefits"] = product_benefits(product, sum_assured, int(arrays["term"][k]))
+    return result
+
+
+def quote(product_key, direction, term, mode, amount, age_next_birthday, gender, dab_included, rate_table=None):
+    """Price a single quote for any registered product (O(1) registry dispatch)."""
+    product = PRODUCTS.get(str(product_key).lower())
+    if product is None:
+        raise ValueError(f"Unsupported product '{product_key}'")
+    if product.fixed_term is not None and int(term) != product.fixed_term:
+        raise ValueError(f"Term must be {product.fixed_term} for {product.name}")
+
+    factor = MODE_FACTORS.get(mode.lower())
     if factor is None:
         raise ValueError(f"Invalid mode: {mode}")
 
-    # 1. Installment → Annual
-    annual_premium = premium / factor
+    arrays = quote_kernel(
+        product, direction, [amount], [term], [factor],
+        [age_next_birthday], [gender.lower() == "female"], [bool(dab_included)], rate_table=rate_table,
+    )
+    return kernel_result(product, direction, arrays, 0)
 
-    # 2. Remove PHCF
-    total_before_phcf = annual_premium / 1.0025
 
-    # 3. Solve for SA
-    # total_before_phcf = (SA/1000 × rate) + (SA × 0.001) + (SA/1000 × rate × 0.01)
-    #                   = SA × (rate/1000 × 1.01 + 0.001)
+def _scalar_quote(key, direction, product, term, mode, amount, age_next_birthday, gender, dab_included):
+    """Adapter used by the legacy per-product functions, which check the product name."""
+    if product.lower() != key:
+        raise ValueError(f"Unsupported product '{product}'")
+    return quote(key, direction, term, mode, amount, age_next_birthday, gender, dab_included)
 
-    basic_rate_per_unit = rate_per_1000 / 1000.0
-    wp_multiplier = 1.01
-    dab_rate_per_unit = 0.001 if dab_included else 0
 
-    total_rate_per_unit = basic_rate_per_unit * wp_multiplier + dab_rate_per_unit
-    sum_assured = total_before_phcf / total_rate_per_unit
+# ===================== BATCH QUOTING =====================
+
+def quote_batch(quotes, rate_table=None):
+    """
+    Price many quotes in one pass over the rate tables.
+
+    Each quote is a dict with ``product``, ``direction`` ("premium" for SA → Premium,
+    "sum_assured" for Premium → SA), ``term``, ``mode``, ``amount`` (SA or installment
+    premium), ``age_next_birthday``, ``gender`` and ``dab_included``.
+    Quotes are grouped by product and direction and each group is one quote_kernel() call.
 
+    Returns a list of ``(result, error)`` tuples in input order; exactly one is None.
+    The whole batch is priced with one rate snapshot (``rate_table``, default: the live one).
+    """
+    rate_table = rate_table or current_rates()
+    out = [None] * len(quotes)
+    groups = {}
+    for i, q in enumerate(quotes):
+        groups.setdefault((q["product"], q["direction"]), []).append(i)
+
+    for (key, direction), idx in groups.items():
+        product = PRODUCTS.get(key)
+        if product is None:
+            for i in idx:
+                out[i] = (None, f"Unsupported product '{key}'")
+            continue
+
+        group = [quotes[i] for i in idx]
+        factors = np.array([MODE_FACTORS.get(q["mode"], np.nan) for q in group], dtype=np.float64)
+        arrays = quote_kernel(
+            product,
+            direction,
+            [q["amount"] for q in group],
+            [q["term"] for q in group],
+            factors,
+            [q["age_next_birthday"] for q in group],
+            [q["gender"] == "female" for q in group],
+            [bool(q["dab_included"]) for q in group],
+            rate_table=rate_table,
+        )
+
+        for k, i in enumerate(idx):
+            if np.isnan(factors[k]):
+                out[i] = (None, f"Invalid mode: {group[k]['mode']}")
+                continue
+            try:
+                out[i] = (kernel_result(product, direction, arrays, k), None)
+            except ValueError as e:
+                out[i] = (None, str(e))
+
+    return out
+
+
+# ===================== QUOTE GRIDS =====================
+
+MAX_GRID_POINTS = 20000
+
+
+def _grid_values(values):
+    """Float array -> JSON list rounded to cents, None where there is no rate."""
+    return [None if v != v else round(v, 2) for v in np.asarray(values, dtype=np.float64).ravel().tolist()]
+
+
+def offered_terms(product, discounted_age, rate_table=None):
+    """Terms the product is sold for at this discounted age."""
+    if product.fixed_term is not None:
+        return [product.fixed_term]
+    table = (rate_table or current_rates()).table(product.key)
+    if table is None:
+        return []
+    rates = table.lookup_many(discounted_age, table.terms)
+    return [int(t) for t, r in zip(table.terms, rates) if r == r]
+
+
+def premium_grid(product, age_next_birthday, gender, dab_included, sums_assured, terms, modes, rate_table=None):
+    """
+    Installment premiums for one client over a (term × mode × sum assured) grid,
+    priced in one quote_kernel() pass. Premiums are linear in SA, so the client
+    can interpolate exactly between SA steps.
+    """
+    terms = np.asarray(terms, dtype=np.int64)
+    factors = np.array([MODE_FACTORS[m] for m in modes], dtype=np.float64)
+    sums_assured = np.asarray(sums_assured, dtype=np.float64)
+    shape = (terms.size, factors.size, sums_assured.size)
+    if np.prod(shape) > MAX_GRID_POINTS:
+        raise ValueError(f"Grid too large: at most {MAX_GRID_POINTS} points.")
+
+    arrays = quote_kernel(
+        product, "premium",
+        np.broadcast_to(sums_assured, shape),
+        terms[:, None, None],
+        factors[None, :, None],
+        age_next_birthday, gender == "female", bool(dab_included),
+        rate_table=rate_table,
+    )
     return {
-        "discounted_age": discounted_age,
-        "rate_per_1000": rate_per_1000,
-        "estimated_sum_assured": round(sum_assured, 2),
-        "benefits": get_money_back_10_benefits(sum_assured, term),
-    }
\ No newline at end of file
+        "product": product.key,
+        "kind": "premium",
+        "axes": {"term": terms.tolist(), "mode": list(modes), "sum_assured": _grid_values(sums_assured)},
+        "shape": list(shape),
+        "installment_premium": _grid_values(arrays["installment_premium"]),
+    }
+
+
+def age_term_grid(product, gender, dab_included, sum_assured, mode, rate_table=None):
+    """
+    Installment premiums for one SA and mode over every (age next birthday × term)
+    the product's rate table covers. Cells the product's eligibility rules (age
+    limits, minimum SA) exclude are None, like those without a rate.
+    """
+    table = (rate_table or current_rates()).table(product.key)
+    if table is None:
+        raise ValueError(f"No rates available for {product.name}")
+    factor = MODE_FACTORS.get(mode)
+    if factor is None:
+        raise ValueError(f"Invalid mode: {mode}")
+
+    offset = 4 if gender == "female" else 2
+    ages = np.arange(table.min_age, table.max_age + 1) + offset
+    terms = table.terms if table.terms.size else np.array([product.fixed_term or 0])
+    shape = (ages.size, terms.size)
+
+    arrays = quote_kernel(
+        product, "premium",
+        np.full(shape, float(sum_assured)),
+        terms[None, :],
+        factor,
+        ages[:, None], gender == "female", bool(dab_included),
+        rate_table=rate_table,
+    )
+    eligible = np.array([
+        product.eligibility_error("premium", sum_assured, age - 1, age) is None for age in ages.tolist()
+    ])
+    return {
+        "product": product.key,
+        "kind": "age",
+        "axes": {"age_next_birthday": ages.tolist(), "term": terms.tolist()},
+        "shape": list(shape),
+        "installment_premium": _grid_values(np.where(eligible[:, None], arrays["installment_premium"], np.nan)),
+    }
@@ -0,0 +1,89 @@
+# backend/calculator/utils/callback_queue.py
+"""
+Redis list of raw STK callbacks for the batching consumer (MPESA_CALLBACK_BATCHING).
+
+stk_callback_view pushes each callback here instead of sending a Celery task;
+`manage.py consume_callbacks` drains the list in batches of up to
+MPESA_CALLBACK_BATCH_SIZE callbacks or MPESA_CALLBACK_BATCH_WAIT_MS milliseconds,
+whichever comes first.
+
+A batch is moved (LMOVE) into the consumer's own processing list rather than
+popped, and only dropped from there by ack() once it has been applied, so a
+consumer that dies mid-batch loses nothing: requeue() puts its processing list
+back at the head of the queue when it starts again. Callbacks that cannot be
+applied go to a dead-letter list instead of blocking the queue.
+"""
+import json
+import time
+
+CALLBACK_QUEUE_KEY = "mpesa:callbacks"
+CALLBACK_PROCESSING_KEY = "mpesa:callbacks:processing:{consumer}"
+CALLBACK_DEAD_KEY = "mpesa:callbacks:dead"
+CALLBACK_STATS_KEY = "mpesa:callback-stats"
+
+
+def _redis():
+    from django_redis import get_redis_connection
+    return get_redis_connection("default")
+
+
+def enqueue_callback(checkout_id, result_code, metadata):
+    _redis().rpush(CALLBACK_QUEUE_KEY, json.dumps([checkout_id, result_code, metadata]))
+
+
+def next_batch(consumer, max_size, max_wait, idle_timeout=1):
+    """
+    Block up to ``idle_timeout`` s for a first callback, then keep collecting until
+    ``max_size`` callbacks or ``max_wait`` s after the first. Each callback is moved
+    into ``consumer``'s processing list; returns them raw (JSON), oldest first.
+    """
+    redis = _redis()
+    processing = CALLBACK_PROCESSING_KEY.format(consumer=consumer)
+    first = redis.blmove(CALLBACK_QUEUE_KEY, processing, idle_timeout, "LEFT", "RIGHT")
+    if first is None:
+        return []
+    raw = [first]
+    deadline = time.monotonic() + max_wait
+    while len(raw) < max_size:
+        item = redis.lmove(CALLBACK_QUEUE_KEY, processing, "LEFT", "RIGHT")
+        if item is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            item = redis.blmove(CALLBACK_QUEUE_KEY, processing, remaining, "LEFT", "RIGHT")
+            if item is None:
+                break
+        raw.append(item)
+    return raw
+
+
+def ack(consumer):
+    """Drop ``consumer``'s processing list once its batch has been applied."""
+    _redis().delete(CALLBACK_PROCESSING_KEY.format(consumer=consumer))
+
+
+def requeue(consumer):
+    """
+    Put ``consumer``'s unacknowledged callbacks back at the head of the queue, in
+    order: after a batch fails to apply, and at start-up after a crash. Returns
+    how many were requeued.
+    """
+    redis = _redis()
+    processing = CALLBACK_PROCESSING_KEY.format(consumer=consumer)
+    count = 0
+    while redis.lmove(processing, CALLBACK_QUEUE_KEY, "RIGHT", "LEFT") is not None:
+        count += 1
+    return count
+
+
+def dead_letter(failures):
+    """Park ``(raw_callback, error)`` pairs that cannot be applied on CALLBACK_DEAD_KEY."""
+    if failures:
+        _redis().rpush(CALLBACK_DEAD_KEY, *[
+            json.dumps({"callback": raw.decode() if isinstance(raw, bytes) else raw, "error": str(error)})
+            for raw, error in failures
+        ])
+
+
+def queue_depth():
+    return _redis().llen(CALLBACK_QUEUE_KEY)
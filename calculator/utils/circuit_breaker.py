@@ -0,0 +1,70 @@
+# backend/calculator/utils/circuit_breaker.py
+"""
+Per-process circuit breaker for calls to an external provider.
+
+closed     calls go through; ``failure_threshold`` consecutive failures open it
+open       calls fail fast with CircuitOpenError for ``reset_timeout`` seconds
+half-open  one probe call is let through; success closes, failure re-opens
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go out now."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            waited = time.monotonic() - self._opened_at
+            if waited < self.reset_timeout or self._probing:
+                raise CircuitOpenError(self.name, max(self.reset_timeout - waited, 1))
+            self._probing = True  # this caller is the half-open probe
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuit {self.name} closed")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def abandon(self):
+        """The call ended without an outcome (cancelled or interrupted): let the next caller probe."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning(f"Circuit {self.name} opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+                self._probing = False
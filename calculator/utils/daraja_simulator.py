@@ -0,0 +1,204 @@
+# backend/calculator/utils/daraja_simulator.py
+"""
+Fake Safaricom Daraja API for offline integration and load testing.
+
+Implements the calls this app makes (OAuth, STK push, STK query) and sends the
+STK callback to the app after a configurable delay, with configurable response
+latency, API failure rate and customer decline rate. Run it with
+`manage.py mpesa_simulator` and point MPESA_BASE_URL at it.
+"""
+import heapq
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SimulatorConfig:
+    latency: float = 0.2            # mean seconds before each API response
+    jitter: float = 0.1             # +/- uniform spread around ``latency``
+    failure_rate: float = 0.0       # fraction of STK pushes answered with HTTP 500
+    decline_rate: float = 0.1       # fraction of accepted pushes the customer cancels (1032)
+    callback_delay: float = 5.0     # mean seconds from push to callback
+    callback_jitter: float = 2.0
+    callback_url: str = None        # override the CallBackURL sent in each push
+    token_ttl: int = 3599
+
+
+class CallbackDispatcher:
+    """Sends due callbacks from a small thread pool instead of a thread per payment."""
+
+    def __init__(self, workers=16):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._seq = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, delay, url, body):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, url, body))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, url, body = heapq.heappop(self._heap)
+            self._pool.submit(self._send, url, body)
+
+    @staticmethod
+    def _send(url, body):
+        try:
+            requests.post(url, json=body, timeout=10)
+        except requests.RequestException as e:
+            logger.warning(f"Callback to {url} failed: {e}")
+
+
+class DarajaSimulator:
+    def __init__(self, config=None):
+        self.config = config or SimulatorConfig()
+        self.tokens = set()
+        self.payments = {}  # CheckoutRequestID -> merchant ID, result code and when it settles
+        self.lock = threading.Lock()
+        self.dispatcher = CallbackDispatcher()
+
+    def _sleep(self):
+        time.sleep(max(0.0, random.uniform(self.config.latency - self.config.jitter,
+                                           self.config.latency + self.config.jitter)))
+
+    def oauth(self, headers):
+        if not headers.get("Authorization", "").startswith("Basic "):
+            return 400, {"errorCode": "400.008.01", "errorMessage": "Invalid Authentication passed"}
+        token = secrets.token_urlsafe(21)
+        with self.lock:
+            self.tokens.add(token)
+        return 200, {"access_token": token, "expires_in": str(self.config.token_ttl)}
+
+    def _authorized(self, headers):
+        token = headers.get("Authorization", "").removeprefix("Bearer ")
+        return token in self.tokens
+
+    def stk_push(self, headers, body):
+        if not self._authorized(headers):
+            return 401, {"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"}
+        if random.random() < self.config.failure_rate:
+            return 500, {"requestId": secrets.token_hex(8), "errorCode": "500.001.1001",
+                         "errorMessage": "Unable to lock subscriber, a transaction is already in process for the current subscriber"}
+
+        merchant_id = f"{random.randint(10000, 99999)}-{random.randint(10**7, 10**8 - 1)}-1"
+        checkout_id = f"ws_CO_{datetime.now():%d%m%Y%H%M%S}{secrets.token_hex(5)}"
+        declined = random.random() < self.config.decline_rate
+        delay = max(0.0, random.uniform(self.config.callback_delay - self.config.callback_jitter,
+                                        self.config.callback_delay + self.config.callback_jitter))
+        with self.lock:
+            self.payments[checkout_id] = {
+                "merchant_id": merchant_id,
+                "result": 1032 if declined else 0,
+                "settles_at": time.monotonic() + delay,
+            }
+
+        callback = self._callback_body(merchant_id, checkout_id, body, declined)
+        self.dispatcher.schedule(delay, self.config.callback_url or body.get("CallBackURL"), callback)
+
+        return 200, {
+            "MerchantRequestID": merchant_id,
+            "CheckoutRequestID": checkout_id,
+            "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing",
+            "CustomerMessage": "Success. Request accepted for processing",
+        }
+
+    @staticmethod
+    def _callback_body(merchant_id, checkout_id, push, declined):
+        callback = {
+            "MerchantRequestID": merchant_id,
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": 1032 if declined else 0,
+            "ResultDesc": "Request cancelled by user" if declined else "The service request is processed successfully.",
+        }
+        if not declined:
+            callback["CallbackMetadata"] = {"Item": [
+                {"Name": "Amount", "Value": push.get("Amount")},
+                {"Name": "MpesaReceiptNumber", "Value": "S" + secrets.token_hex(5).upper()[:9]},
+                {"Name": "TransactionDate", "Value": int(datetime.now().strftime("%Y%m%d%H%M%S"))},
+                {"Name": "PhoneNumber", "Value": int(push.get("PhoneNumber") or 0)},
+            ]}
+        return {"Body": {"stkCallback": callback}}
+
+    def stk_query(self, headers, body):
+        if not self._authorized(headers):
+            return 401, {"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"}
+        with self.lock:
+            payment = self.payments.get(body.get("CheckoutRequestID"))
+        if payment is None:
+            return 500, {"errorCode": "500.001.1001", "errorMessage": "No transaction found"}
+        if time.monotonic() < payment["settles_at"]:
+            return 500, {"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"}
+        return 200, {
+            "ResponseCode": "0",
+            "ResponseDescription": "The service request has been accepted successsfully",
+            "MerchantRequestID": payment["merchant_id"],
+            "CheckoutRequestID": body.get("CheckoutRequestID"),
+            "ResultCode": str(payment["result"]),
+            "ResultDesc": "Request cancelled by user" if payment["result"] else "The service request is processed successfully.",
+        }
+
+    def handle(self, method, path, headers, body):
+        self._sleep()
+        if method == "GET" and path == "/oauth/v1/generate":
+            return self.oauth(headers)
+        if method == "POST" and path == "/mpesa/stkpush/v1/processrequest":
+            return self.stk_push(headers, body)
+        if method == "POST" and path == "/mpesa/stkpushquery/v1/query":
+            return self.stk_query(headers, body)
+        return 404, {"errorCode": "404.001.01", "errorMessage": "Resource not found"}
+
+    def make_server(self, host="127.0.0.1", port=8089):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+            def _dispatch(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    body = {}
+                status, payload = simulator.handle(method, urlparse(self.path).path, self.headers, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024  # the default backlog of 5 resets connections under load
+
+        return Server((host, port), Handler)
@@ -1,16 +1,26 @@
 # backend/calculator/utils/mpesa.py
 import os
 import re
+import time
 import base64
+import logging
+import threading
 import requests
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from decouple import config
 from django.conf import settings
+from django.core.cache import cache
+
+from .circuit_breaker import CircuitBreaker
+
+logger = logging.getLogger(__name__)
 
 
 # === MPESA CONFIG (LOADED FROM .env) ===
-MPESA_BASE_URL = "https://sandbox.safaricom.co.ke"
+# Point at `manage.py mpesa_simulator` (e.g. http://localhost:8089) for offline/load testing
+MPESA_BASE_URL = config('MPESA_BASE_URL', default="https://sandbox.safaricom.co.ke").rstrip("/")
 
 CONSUMER_KEY = config('MPESA_CONSUMER_KEY')
 CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET')
@@ -19,12 +29,130 @@ PASSKEY = config('MPESA_PASSKEY')
 CALLBACK_URL = config('MPESA_CALLBACK_URL')
 
 
-def get_access_token():
-    """Fetch OAuth access token from Safaricom."""
+# === HTTP SESSION (keep-alive, pooled per process) ===
+# (connect, read) timeouts per Daraja endpoint
+CONNECT_TIMEOUT = config('MPESA_CONNECT_TIMEOUT', default=3.05, cast=float)
+TIMEOUTS = {
+    "oauth": (CONNECT_TIMEOUT, config('MPESA_OAUTH_TIMEOUT', default=10, cast=float)),
+    "stk_push": (CONNECT_TIMEOUT, config('MPESA_READ_TIMEOUT', default=15, cast=float)),
+    "stk_query": (CONNECT_TIMEOUT, config('MPESA_QUERY_TIMEOUT', default=10, cast=float)),
+}
+
+session = requests.Session()
+for _scheme in ("https://", "http://"):  # http:// for the local simulator
+    session.mount(_scheme, HTTPAdapter(pool_connections=4, pool_maxsize=config('MPESA_POOL_SIZE', default=20, cast=int)))
+
+
+# === CIRCUIT BREAKER ===
+# Trips after consecutive timeouts, connection errors or gateway errors so a
+# Safaricom outage fails fast instead of tying up workers.
+breaker = CircuitBreaker(
+    "M-Pesa",
+    failure_threshold=settings.MPESA_BREAKER_THRESHOLD,
+    reset_timeout=settings.MPESA_BREAKER_RESET,
+)
+
+
+def provider_failed(status_code, body_text):
+    """Whether a response means Safaricom itself is unhealthy (vs. a business error)."""
+    if status_code in (502, 503, 504):
+        return True
+    # Daraja reports request-level errors as 500 with a JSON errorCode
+    return status_code >= 500 and '"errorCode"' not in body_text
+
+
+def _request(method, url, endpoint, **kwargs):
+    """session.request() with the endpoint's timeout, behind the circuit breaker."""
+    breaker.before_call()
+    try:
+        response = session.request(method, url, timeout=TIMEOUTS[endpoint], **kwargs)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+    except BaseException:
+        breaker.abandon()
+        raise
+    if provider_failed(response.status_code, response.text):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+# === OAUTH TOKEN CACHE ===
+# Tokens are shared through Redis and refreshed TOKEN_REFRESH_MARGIN seconds
+# before they expire; one process refreshes while holding TOKEN_LOCK_KEY.
+TOKEN_CACHE_KEY = "mpesa:access-token"
+TOKEN_LOCK_KEY = "mpesa:access-token-lock"
+TOKEN_REFRESH_MARGIN = 60
+
+_token = {"token": None, "refresh_at": 0.0}
+_token_lock = threading.Lock()
+
+
+def _fetch_access_token():
+    """OAuth round-trip to Safaricom; returns {"token", "refresh_at"} (epoch seconds)."""
     url = f"{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
-    response = requests.get(url, auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET))
+    response = _request("GET", url, "oauth", auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET))
     response.raise_for_status()
-    return response.json().get('access_token')
+    body = response.json()
+    expires_in = int(body.get("expires_in", 3599))
+    return {
+        "token": body.get("access_token"),
+        "refresh_at": time.time() + max(expires_in - TOKEN_REFRESH_MARGIN, 1),
+    }
+
+
+def _fresh(entry):
+    return bool(entry and entry.get("token") and time.time() < entry["refresh_at"])
+
+
+def _shared_access_token():
+    """Token from Redis, or fetch and publish one under a cross-process lock."""
+    try:
+        entry = cache.get(TOKEN_CACHE_KEY)
+        if _fresh(entry):
+            return entry
+        lock = cache.lock(TOKEN_LOCK_KEY, timeout=30, blocking_timeout=15)
+        locked = lock.acquire()
+    except Exception as e:
+        logger.warning(f"M-Pesa token cache unavailable, fetching directly: {e}")
+        return _fetch_access_token()
+
+    try:
+        entry = cache.get(TOKEN_CACHE_KEY)  # refreshed by another process while we waited
+        if _fresh(entry):
+            return entry
+        entry = _fetch_access_token()
+        cache.set(TOKEN_CACHE_KEY, entry, timeout=max(int(entry["refresh_at"] - time.time()), 1))
+        return entry
+    finally:
+        if locked:
+            try:
+                lock.release()
+            except Exception:
+                pass
+
+
+def get_access_token():
+    """OAuth access token, cached in-process and in Redis until shortly before it expires."""
+    global _token
+    if _fresh(_token):
+        return _token["token"]
+    with _token_lock:
+        if not _fresh(_token):
+            _token = _shared_access_token()
+        return _token["token"]
+
+
+def invalidate_access_token():
+    """Drop a token Safaricom rejected so the next call fetches a new one."""
+    global _token
+    _token = {"token": None, "refresh_at": 0.0}
+    try:
+        cache.delete(TOKEN_CACHE_KEY)
+    except Exception:
+        pass
 
 
 def _normalize_phone(pn: str) -> str:
@@ -41,20 +169,16 @@ def _normalize_phone(pn: str) -> str:
     return s
 
 
-def initiate_stk_push(phone_number, amount, account_reference="Kenindia Premiums Calculator"):
-    """
-    Initiate STK Push to user's phone.
-    Phone should be in 254XXXXXXXXX format.
-    """
-    access_token = get_access_token()
+def _password():
+    """(Password, Timestamp) pair Daraja expects on STK push and query."""
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     password = base64.b64encode((BUSINESS_SHORTCODE + PASSKEY + timestamp).encode()).decode("utf-8")
+    return password, timestamp
 
-    stk_url = f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+
+def build_stk_payload(phone_number, amount, account_reference="Kenindia Premiums Calculator"):
+    """STK Push request body (shared by the sync and async clients)."""
+    password, timestamp = _password()
 
     pn = _normalize_phone(phone_number)
     try:
@@ -75,11 +199,53 @@ def initiate_stk_push(phone_number, amount, account_reference="Kenindia Premiums
         "AccountReference": account_reference,
         "TransactionDesc": "Premium Payment",
     }
+    return payload
+
+
+def initiate_stk_push(phone_number, amount, account_reference="Kenindia Premiums Calculator"):
+    """
+    Initiate STK Push to user's phone.
+    Phone should be in 254XXXXXXXXX format.
+    """
+    stk_url = f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest"
+    payload = build_stk_payload(phone_number, amount, account_reference)
 
-    response = requests.post(stk_url, json=payload, headers=headers)
+    for attempt in range(2):
+        headers = {
+            "Authorization": f"Bearer {get_access_token()}",
+            "Content-Type": "application/json"
+        }
+        response = _request("POST", stk_url, "stk_push", json=payload, headers=headers)
+        if response.status_code != 401 or attempt:
+            break
+        invalidate_access_token()  # revoked or expired early: retry once with a new token
     return response.json()
 
 
+def query_stk_status(checkout_request_id):
+    """
+    STK Query for a push whose callback never arrived.
+    Returns the ResultCode (0 = paid) once the payment has settled, None while it
+    is still being processed or the query itself failed.
+    """
+    password, timestamp = _password()
+    payload = {
+        "BusinessShortCode": BUSINESS_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id,
+    }
+    response = _request(
+        "POST", f"{MPESA_BASE_URL}/mpesa/stkpushquery/v1/query", "stk_query",
+        json=payload, headers={"Authorization": f"Bearer {get_access_token()}"},
+    )
+    if response.status_code == 401:
+        invalidate_access_token()
+        return None
+    result_code = response.json().get("ResultCode")
+    return int(result_code) if result_code not in (None, "") else None
+
+
 def parse_stk_callback(callback_data):
     """Parse M-Pesa STK Push callback and extract key fields."""
     result = callback_data.get("Body", {}).get("stkCallback", {})
@@ -0,0 +1,79 @@
+# backend/calculator/utils/mpesa_async.py
+"""
+asyncio M-Pesa client with the same surface as utils.mpesa.
+
+STK pushes go through one pooled httpx.AsyncClient per event loop, so an ASGI
+worker can hold many in-flight pushes without a thread each. OAuth tokens
+come from the same in-process/Redis cache as the sync client; the rare refresh
+runs the sync path in a thread.
+"""
+import asyncio
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from decouple import config
+
+from . import mpesa
+from .mpesa import parse_stk_callback  # noqa: F401  (same surface as utils.mpesa)
+
+LIMITS = httpx.Limits(
+    max_connections=config('MPESA_ASYNC_POOL_SIZE', default=200, cast=int),
+    max_keepalive_connections=config('MPESA_POOL_SIZE', default=20, cast=int),
+)
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    """The shared AsyncClient for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _clients[loop] = httpx.AsyncClient(limits=LIMITS)
+    return client
+
+
+async def _request(method, url, endpoint, **kwargs):
+    """Async twin of mpesa._request(): same per-endpoint timeouts and circuit breaker."""
+    mpesa.breaker.before_call()
+    connect, read = mpesa.TIMEOUTS[endpoint]
+    try:
+        response = await get_client().request(method, url, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+    except httpx.HTTPError:
+        mpesa.breaker.record_failure()
+        raise
+    except BaseException:  # e.g. CancelledError when the client disconnects mid-push
+        mpesa.breaker.abandon()
+        raise
+    if mpesa.provider_failed(response.status_code, response.text):
+        mpesa.breaker.record_failure()
+    else:
+        mpesa.breaker.record_success()
+    return response
+
+
+async def get_access_token():
+    if mpesa._fresh(mpesa._token):
+        return mpesa._token["token"]
+    return await sync_to_async(mpesa.get_access_token, thread_sensitive=False)()
+
+
+async def initiate_stk_push(phone_number, amount, account_reference="Kenindia Premiums Calculator"):
+    """
+    Initiate STK Push to user's phone.
+    Phone should be in 254XXXXXXXXX format.
+    """
+    stk_url = f"{mpesa.MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest"
+    payload = mpesa.build_stk_payload(phone_number, amount, account_reference)
+
+    for attempt in range(2):
+        headers = {
+            "Authorization": f"Bearer {await get_access_token()}",
+            "Content-Type": "application/json"
+        }
+        response = await _request("POST", stk_url, "stk_push", json=payload, headers=headers)
+        if response.status_code != 401 or attempt:
+            break
+        await sync_to_async(mpesa.invalidate_access_token, thread_sensitive=False)()
+    return response.json()
@@ -0,0 +1,195 @@
+# backend/calculator/utils/payment_events.py
+"""
+Payment status push: the callback task publishes, SSE streams subscribe.
+
+PAYMENT_EVENTS_BROKER selects the transport: "redis" (pub/sub on REDIS_URL,
+works across Celery workers and web processes) or "memory" (in-process, for
+tests and single-process development). With Redis, all of a process's streams
+share one pub/sub connection rather than opening one each.
+"""
+import asyncio
+import json
+import logging
+import threading
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_CHANNEL = "payments:calc:{calc_id}"
+
+
+class _SharedPubSub:
+    """
+    One Redis pub/sub connection shared by every subscriber on an event loop. A
+    single reader task fans each message out to the local waiters on its channel;
+    the connection is closed once the last waiter has left.
+    """
+
+    def __init__(self, url, on_close):
+        import redis.asyncio as aioredis
+        self.client = aioredis.Redis.from_url(url)
+        self.pubsub = self.client.pubsub()
+        self.on_close = on_close
+        self.waiters = {}  # channel -> set of asyncio.Queue
+        self.lock = asyncio.Lock()
+        self.reader = None
+        self.closed = False
+
+    async def add(self, channel):
+        queue = asyncio.Queue()
+        async with self.lock:
+            if channel not in self.waiters:
+                try:
+                    await self.pubsub.subscribe(channel)
+                except Exception:
+                    if not self.waiters:
+                        self._detach()
+                        await self._disconnect()
+                    raise
+                self.waiters[channel] = set()
+            self.waiters[channel].add(queue)
+            if self.reader is None:
+                self.reader = asyncio.ensure_future(self._read())
+        return queue
+
+    async def remove(self, channel, queue):
+        async with self.lock:
+            waiters = self.waiters.get(channel, set())
+            waiters.discard(queue)
+            if waiters or self.closed:
+                return
+            del self.waiters[channel]
+            if self.waiters:
+                await self.pubsub.unsubscribe(channel)
+                return
+            self._detach()
+            self.reader.cancel()
+            await self._disconnect()
+
+    async def _read(self):
+        try:
+            while True:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+                if not message:
+                    continue
+                channel = message["channel"]
+                channel = channel.decode() if isinstance(channel, bytes) else channel
+                data = json.loads(message["data"])
+                for queue in self.waiters.get(channel, ()):
+                    queue.put_nowait(data)
+        except Exception as e:
+            # Hand the error to every waiter and let the next subscriber reconnect
+            logger.warning(f"Payment event subscription lost: {e}")
+            self._detach()
+            for waiters in self.waiters.values():
+                for queue in waiters:
+                    queue.put_nowait(e)
+            await self._disconnect()
+
+    def _detach(self):
+        self.closed = True
+        self.on_close(self)
+
+    async def _disconnect(self):
+        try:
+            await self.pubsub.aclose()
+            await self.client.aclose()
+        except Exception:
+            pass
+
+
+class RedisBroker:
+    def __init__(self, url):
+        self.url = url
+        self._client = None
+        self._shared = {}  # event loop -> _SharedPubSub
+
+    def publish(self, channel, message):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        self._client.publish(channel, json.dumps(message))
+
+    def _closed(self, shared):
+        for loop, entry in list(self._shared.items()):
+            if entry is shared:
+                del self._shared[loop]
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        """Yields ``next_message(timeout)``: the next message, or None after ``timeout`` seconds."""
+        loop = asyncio.get_running_loop()
+        shared = self._shared.get(loop)
+        if shared is None:
+            shared = self._shared[loop] = _SharedPubSub(self.url, self._closed)
+        queue = await shared.add(channel)
+
+        async def next_message(timeout):
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            if isinstance(message, Exception):
+                raise message
+            return message
+
+        try:
+            yield next_message
+        finally:
+            await shared.remove(channel, queue)
+
+
+class InMemoryBroker:
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        entry = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(entry)
+
+        async def next_message(timeout):
+            try:
+                return await asyncio.wait_for(entry[1].get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+        try:
+            yield next_message
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(entry)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+
+_brokers = {}
+
+
+def get_broker():
+    kind = getattr(settings, "PAYMENT_EVENTS_BROKER", "redis")
+    if kind not in _brokers:
+        _brokers[kind] = InMemoryBroker() if kind == "memory" else RedisBroker(settings.REDIS_URL)
+    return _brokers[kind]
+
+
+def publish_payment_status(calc_id, status):
+    """Tell subscribers of a calculation about a status change; never raises."""
+    try:
+        get_broker().publish(PAYMENT_CHANNEL.format(calc_id=calc_id), status)
+    except Exception as e:
+        logger.warning(f"Payment event for calc {calc_id} not published: {e}")
+
+
+def subscribe_payment_status(calc_id):
+    return get_broker().subscribe(PAYMENT_CHANNEL.format(calc_id=calc_id))
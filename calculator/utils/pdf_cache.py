@@ -0,0 +1,192 @@
+# backend/calculator/utils/pdf_cache.py
+"""
+Content-addressed cache of rendered quotation PDFs.
+
+The key is a SHA-256 of the normalized payload (product, input, results,
+customer name), the template version and the issue date printed on the PDF,
+so identical quotes share one file no matter which calculation or request
+asked for it, and a template change or a new day renders afresh.
+
+PDFs live as ``<key[:2]>/<key>.pdf`` under PDF_CACHE_DIR, shared by every worker
+on the host (a stand-in for an object store). Files are written atomically and
+their mtime is bumped on every hit; once the directory grows past
+PDF_CACHE_MAX_BYTES the least recently used files are removed until it is back
+under PDF_CACHE_LOW_WATER of the cap. Eviction also sweeps up temporary files
+older than PDF_CACHE_TMP_MAX_AGE seconds, left behind by renders that died.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import date
+
+from django.conf import settings
+
+from . import pdf_generator
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(payload):
+    """Canonical form of a PDF payload: only what appears on the document."""
+    return {
+        "product": payload.get("product") or "",
+        "input": payload.get("input") or {},
+        "results": payload.get("results") or {},
+        "customerName": payload.get("customerName") or None,
+    }
+
+
+def pdf_key(payload, issued=None):
+    document = {
+        "payload": normalize(payload),
+        "template": pdf_generator.TEMPLATE_VERSION,
+        "issued": (issued or date.today()).isoformat(),
+    }
+    encoded = json.dumps(document, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class PdfCache:
+    def __init__(self, directory=None, max_bytes=None, low_water=None):
+        self.directory = directory or getattr(
+            settings, "PDF_CACHE_DIR", os.path.join(settings.MEDIA_ROOT, "pdf-cache"),
+        )
+        self.max_bytes = max_bytes if max_bytes is not None else getattr(settings, "PDF_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+        self.low_water = low_water if low_water is not None else getattr(settings, "PDF_CACHE_LOW_WATER", 0.9)
+        self.tmp_max_age = getattr(settings, "PDF_CACHE_TMP_MAX_AGE", 3600)
+        self._lock = threading.Lock()
+        self._bytes = None  # estimated size of the directory; None until first scanned
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pdf")
+
+    def get(self, key):
+        """Path of the cached PDF for ``key``, marked as recently used, or None."""
+        path = self.path(key)
+        try:
+            os.utime(path)  # LRU: mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def reserve(self, key):
+        """A temporary file beside ``key``'s slot to render into; pass it to commit() or discard()."""
+        directory = os.path.dirname(self.path(key))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        return tmp
+
+    def discard(self, tmp):
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+
+    def commit(self, key, tmp):
+        """Atomically move a finished render into the cache; returns its path."""
+        path = self.path(key)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        with self._lock:
+            self.stores += 1
+            if self._bytes is not None:
+                self._bytes += size
+            over = self._bytes is None or self._bytes > self.max_bytes
+        if over:
+            self.evict()
+        return path
+
+    def get_or_render(self, payload):
+        """Path of the PDF for ``payload``, rendered straight to disk on a miss."""
+        key = pdf_key(payload)
+        path = self.get(key)
+        if path is None:
+            tmp = self.reserve(key)
+            try:
+                pdf_generator.create_pdf(payload, filename=tmp)
+            except BaseException:
+                self.discard(tmp)
+                raise
+            path = self.commit(key, tmp)
+        return path
+
+    def _scan(self):
+        """Cached PDFs as (mtime, size, path), and temporary files older than tmp_max_age."""
+        files, stale = [], []
+        cutoff = time.time() - self.tmp_max_age
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith((".pdf", ".tmp")):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:  # evicted by another worker
+                    continue
+                if name.endswith(".pdf"):
+                    files.append((st.st_mtime, st.st_size, path))
+                elif st.st_mtime < cutoff:
+                    stale.append(path)
+        return files, stale
+
+    def evict(self):
+        """Rescan the directory, drop stale temporary files and least recently used PDFs while over the cap."""
+        files, stale = self._scan()
+        for path in stale:
+            self.discard(path)
+        if stale:
+            logger.info(f"PDF cache removed {len(stale)} abandoned temporary files")
+        total = sum(size for _, size, _ in files)
+        evicted = freed = 0
+        if total > self.max_bytes:
+            target = self.max_bytes * self.low_water
+            for _, size, path in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                else:
+                    evicted += 1
+                    freed += size
+                total -= size
+        with self._lock:
+            self._bytes = total
+            self.evictions += evicted
+            self.evicted_bytes += freed
+        if evicted:
+            logger.info(f"PDF cache evicted {evicted} files ({freed} bytes)")
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "template_version": pdf_generator.TEMPLATE_VERSION,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+pdf_cache = PdfCache()
@@ -3,20 +3,32 @@ from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import inch
 from reportlab.platypus import (
-    SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, PageBreak
+    BaseDocTemplate, Frame, PageTemplate, Paragraph, Spacer, Table, TableStyle
 )
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
+from reportlab.lib.utils import ImageReader, simpleSplit
 from datetime import datetime
+import logging
 import os
+import threading
 from io import BytesIO
 
+from .products import get_product
+
 # --- CONFIG ---
 COMPANY_NAME = "Kenindia Assurance Company Limited"
 ADDRESS = "Kenindia House, Loita Street, P.O. Box 44371-00100, Nairobi"
 PHONE = "+254 20 222 0000"
 EMAIL = "info@kenindia.com"
 LOGO_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "static", "logo.png")  # Update path
+# Bump whenever the layout or wording changes so cached PDFs (utils.pdf_cache) are re-rendered
+TEMPLATE_VERSION = 2
+LOGO_WIDTH, LOGO_HEIGHT = 1.2 * inch, 0.6 * inch
+LOGO_DPI = 200  # the logo is resampled once to this print resolution
+DISCLAIMER = "This quotation is indicative and subject to underwriting. For official confirmation contact Kenindia Assurance."
+
+logger = logging.getLogger(__name__)
 
 styles = getSampleStyleSheet()
 # Add custom styles if they don't already exist in the sample stylesheet.
@@ -43,143 +55,156 @@ except Exception:
 def format_currency(value):
     return f"KSh {value:,.2f}"
 
-def create_pdf(data, filename="quotation.pdf"):
-    """Create a PDF file at `filename` from the provided `data` dict.
 
-    For server-side streaming, prefer `render_pdf_to_bytes(data)` which returns bytes.
+CLIENT_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#003366")),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('BOX', (0, 0), (-1, -1), 1, colors.black),
+    ('LEFTPADDING', (0, 0), (-1, -1), 6),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+])
+
+AMOUNT_TABLE_STYLE = TableStyle([
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('BOX', (0, 0), (-1, -1), 1, colors.black),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f3f6fb')),
+    ('LEFTPADDING', (0, 0), (-1, -1), 6),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+])
+
+
+def _load_logo(path):
+    """Decode the logo once, resampled to LOGO_DPI at its printed size; None if missing."""
+    if not os.path.exists(path):
+        return None
+    try:
+        from PIL import Image as PILImage
+        with PILImage.open(path) as im:
+            im.load()
+            size = (round(LOGO_WIDTH / inch * LOGO_DPI), round(LOGO_HEIGHT / inch * LOGO_DPI))
+            reader = ImageReader(im.resize(size, PILImage.LANCZOS))
+        reader.getRGBData()  # decode now so renders (possibly in several threads) only read it
+        return reader
+    except Exception as e:
+        logger.warning(f"Could not load logo {path}: {e}")
+        return None
+
+
+class QuotationTemplate:
     """
-    doc = SimpleDocTemplate(filename, pagesize=A4, topMargin=0.5*inch, bottomMargin=0.5*inch)
-    story = []
-
-    # --- Header ---
-    if os.path.exists(LOGO_PATH):
-        logo = Image(LOGO_PATH, width=1.2*inch, height=0.6*inch)
-        logo.hAlign = 'LEFT'
-    else:
-        logo = Paragraph("[[ LOGO ]]", styles["Center"])
-
-    header_table = Table([
-        [logo, Paragraph(f"<font size=14><b>{COMPANY_NAME}</b></font><br/>{ADDRESS}<br/>Tel: {PHONE} | {EMAIL}", styles["Normal"])],
-    ], colWidths=[1.5*inch, 4.5*inch])
-    header_table.setStyle(TableStyle([
-        ('ALIGN', (0,0), (0,0), 'LEFT'),
-        ('ALIGN', (1,0), (1,0), 'RIGHT'),
-        ('VALIGN', (0,0), (-1,-1), 'TOP'),
-        ('LEFTPADDING', (0,0), (-1,-1), 0),
-        ('RIGHTPADDING', (0,0), (-1,-1), 0),
-    ]))
-    story.append(header_table)
-    story.append(Spacer(1, 0.3*inch))
-
-    # --- Title ---
-    story.append(Paragraph("LIFE INSURANCE QUOTATION", styles["Title"]))
-    story.append(Paragraph(f"Issued on: {datetime.now().strftime('%d %B %Y')}", styles["Italic"]))
-    story.append(Spacer(1, 0.2*inch))
-
-    # --- Client Details ---
-    client_data = [
-        ["Product", data["product"].replace("_", " ").title()],
-        ["Name", "Parent (Policyholder)"],
-        ["Date of Birth", data.get("dob", "N/A")],
-        ["Age Next Birthday", data.get("ageNextBirthday", "N/A")],
-        ["Gender", data["gender"].capitalize()],
-        ["Payment Mode", data["mode"].capitalize()],
-        ["Term", f"{data['term']} years"],
-    ]
-    if data["product"] in ["money_back_15", "money_back_10"]:
-        client_data.append(["Minimum Sum Assured", "KSh 50,000"])
-    elif data["product"] == "academic_advantage":
-        client_data.append(["Minimum Sum Assured", "KSh 100,000"])
-
-    client_table = Table(client_data, colWidths=[2*inch, 3.5*inch])
-    client_table.setStyle(TableStyle([
-        ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#003366")),
-        ('TEXTCOLOR', (0,0), (-1,0), colors.white),
-        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-        ('GRID', (0,0), (-1,-1), 0.5, colors.grey),
-        ('BOX', (0,0), (-1,-1), 1, colors.black),
-        ('LEFTPADDING', (0,0), (-1,-1), 6),
-        ('RIGHTPADDING', (0,0), (-1,-1), 6),
-    ]))
-    story.append(client_table)
-    story.append(Spacer(1, 0.3*inch))
-
-
-def render_pdf_to_bytes(data):
-    """Render the same PDF into bytes (BytesIO) so it can be returned from Django views.
-
-    This function builds the document into an in-memory buffer and returns the bytes.
+    The parts of a quotation that are the same on every PDF, built once per process:
+    the decoded logo, the letterhead and the disclaimer footer (drawn straight onto
+    each page), and the page geometry. Rendering a quote only lays out its tables.
     """
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=0.5 * inch, bottomMargin=0.5 * inch)
-    story = []
-
-    # --- Header ---
-    if os.path.exists(LOGO_PATH):
-        logo = Image(LOGO_PATH, width=1.2 * inch, height=0.6 * inch)
-        logo.hAlign = 'LEFT'
-    else:
-        logo = Paragraph("[[ LOGO ]]", styles["Center"])
-
-    header_table = Table([
-        [logo, Paragraph(f"<font size=14><b>{COMPANY_NAME}</b></font><br/>{ADDRESS}<br/>Tel: {PHONE} | {EMAIL}", styles["Normal"])],
-    ], colWidths=[1.5 * inch, 4.5 * inch])
-    header_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (0, 0), 'LEFT'),
-        ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 0),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 0),
-    ]))
-    story.append(header_table)
-    story.append(Spacer(1, 0.3 * inch))
-
-    # --- Title ---
-    story.append(Paragraph("LIFE INSURANCE QUOTATION", styles["Title"]))
-    story.append(Paragraph(f"Issued on: {datetime.now().strftime('%d %B %Y')}", styles["Italic"]))
-    story.append(Spacer(1, 0.2 * inch))
+    pagesize = A4
+    margin = 0.5 * inch
+    side_margin = inch
+
+    def __init__(self, logo_path=LOGO_PATH):
+        self.logo = _load_logo(logo_path)
+        width, height = self.pagesize
+        self.content_width = width - 2 * self.side_margin
+
+        # Letterhead: logo on the left, company block beside it
+        self.header_top = height - self.margin
+        self.header_lines = [
+            ("Helvetica-Bold", 14, COMPANY_NAME, 16),
+            ("Helvetica", 10, ADDRESS, 12),
+            ("Helvetica", 10, f"Tel: {PHONE} | {EMAIL}", 12),
+        ]
+        header_height = max(LOGO_HEIGHT, sum(leading for *_, leading in self.header_lines))
+
+        # Footer: the disclaimer, wrapped once
+        self.footer_lines = simpleSplit(DISCLAIMER, "Helvetica-Oblique", 9, self.content_width)
+        footer_height = len(self.footer_lines) * 11
+
+        self.frame_bottom = self.margin + footer_height + 0.2 * inch
+        self.frame_height = self.header_top - header_height - 0.3 * inch - self.frame_bottom
+
+    def draw_page(self, canvas, doc):
+        canvas.saveState()
+        x = self.side_margin
+        if self.logo is not None:
+            canvas.drawImage(self.logo, x, self.header_top - LOGO_HEIGHT, LOGO_WIDTH, LOGO_HEIGHT, mask="auto")
+        else:
+            canvas.setFont("Helvetica", 12)
+            canvas.drawCentredString(x + LOGO_WIDTH / 2, self.header_top - 14, "[[ LOGO ]]")
+
+        y = self.header_top
+        for font, size, text, leading in self.header_lines:
+            y -= leading
+            canvas.setFont(font, size)
+            canvas.drawString(x + 1.5 * inch, y, text)
+
+        canvas.setFont("Helvetica-Oblique", 9)
+        canvas.setFillColor(colors.grey)
+        y = self.margin + 11 * len(self.footer_lines)
+        for line in self.footer_lines:
+            y -= 11
+            canvas.drawString(x, y, line)
+        canvas.restoreState()
+
+    def build(self, output, story):
+        doc = BaseDocTemplate(
+            output, pagesize=self.pagesize,
+            leftMargin=self.side_margin, rightMargin=self.side_margin,
+            topMargin=self.margin, bottomMargin=self.margin,
+        )
+        frame = Frame(self.side_margin, self.frame_bottom, self.content_width, self.frame_height,
+                      leftPadding=0, rightPadding=0, topPadding=0, bottomPadding=0)
+        doc.addPageTemplates([PageTemplate(id="quotation", frames=[frame], onPage=self.draw_page)])
+        doc.build(story)
+
+
+_template = None
+_template_lock = threading.Lock()
+
+
+def get_template():
+    global _template
+    if _template is None:
+        with _template_lock:
+            if _template is None:
+                _template = QuotationTemplate()
+    return _template
+
+
+def build_story(data):
+    """The per-quote flowables: title, client details, premium breakdown and benefits."""
+    inputs = data.get("input") or {}
+    results = data.get("results") or {}
+    story = [
+        Paragraph("LIFE INSURANCE QUOTATION", styles["Title"]),
+        Paragraph(f"Issued on: {datetime.now().strftime('%d %B %Y')}", styles["Italic"]),
+        Spacer(1, 0.2 * inch),
+    ]
 
     # Client details
     client_data = [
-        ["Product", data.get("product", "").replace("_", " ").title()],
-        ["Name", data.get("customerName") or data.get("input", {}).get("name") or "Parent (Policyholder)"],
-        ["Date of Birth", data.get("input", {}).get("dob", "N/A")],
-        ["Age Next Birthday", data.get("input", {}).get("ageNextBirthday", "N/A")],
-        ["Gender", (data.get("input", {}).get("gender") or "").capitalize()],
-        ["Payment Mode", (data.get("input", {}).get("mode") or "").capitalize()],
-        ["Term", f"{data.get('input', {}).get('term', '')} years"],
+        ["Product", (data.get("product") or "").replace("_", " ").title()],
+        ["Name", data.get("customerName") or inputs.get("name") or "Parent (Policyholder)"],
+        ["Date of Birth", inputs.get("dob", "N/A")],
+        ["Age Next Birthday", inputs.get("ageNextBirthday", "N/A")],
+        ["Gender", (inputs.get("gender") or "").capitalize()],
+        ["Payment Mode", (inputs.get("mode") or "").capitalize()],
+        ["Term", f"{inputs.get('term', '')} years"],
     ]
-    client_table = Table(client_data, colWidths=[2 * inch, 3.5 * inch])
-    client_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#003366")),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('BOX', (0, 0), (-1, -1), 1, colors.black),
-        ('LEFTPADDING', (0, 0), (-1, -1), 6),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-    ]))
-    story.append(client_table)
+    product = get_product(data.get("product"))
+    if product and product.min_sum_assured:
+        client_data.append(["Minimum Sum Assured", f"KSh {product.min_sum_assured:,}"])
+    story.append(Table(client_data, colWidths=[2 * inch, 3.5 * inch], style=CLIENT_TABLE_STYLE))
     story.append(Spacer(1, 0.3 * inch))
 
     # Premium breakdown
-    results = data.get("results") or {}
-    sa = results.get("estimated_sum_assured") or data.get("input", {}).get("sumAssured")
+    sa = results.get("estimated_sum_assured") or inputs.get("sumAssured")
     premium_data = [["Description", "Amount (KSh)"], ["Sum Assured", format_currency(sa)], ["Basic Premium", format_currency(results.get("basic_premium", 0))]]
     if results.get("dab", 0) > 0:
         premium_data.append(["Double Accident Benefit (DAB)", format_currency(results.get("dab"))])
     if results.get("wp", 0) > 0:
         premium_data.append(["Waiver of Premium (WP)", format_currency(results.get("wp"))])
-
-    premium_table = Table(premium_data, colWidths=[3.5 * inch, 2.5 * inch])
-    premium_table.setStyle(TableStyle([
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('BOX', (0, 0), (-1, -1), 1, colors.black),
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f3f6fb')),
-        ('LEFTPADDING', (0, 0), (-1, -1), 6),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-    ]))
-    story.append(premium_table)
+    story.append(Table(premium_data, colWidths=[3.5 * inch, 2.5 * inch], style=AMOUNT_TABLE_STYLE))
     story.append(Spacer(1, 0.3 * inch))
 
     # Benefits
@@ -187,20 +212,24 @@ def render_pdf_to_bytes(data):
         benefits_table_data = [["Benefit", "Amount (KSh)"]]
         for k, v in results.get("benefits").items():
             benefits_table_data.append([k, format_currency(v)])
-        benefits_table = Table(benefits_table_data, colWidths=[3.5 * inch, 2.5 * inch])
-        benefits_table.setStyle(TableStyle([
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-            ('BOX', (0, 0), (-1, -1), 1, colors.black),
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f3f6fb')),
-            ('LEFTPADDING', (0, 0), (-1, -1), 6),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-        ]))
         story.append(Paragraph("Benefits", styles["Heading3"]))
-        story.append(benefits_table)
+        story.append(Table(benefits_table_data, colWidths=[3.5 * inch, 2.5 * inch], style=AMOUNT_TABLE_STYLE))
+    return story
+
+
+def create_pdf(data, filename="quotation.pdf"):
+    """Create a PDF file at `filename` from the provided `data` dict.
+
+    For server-side streaming, prefer `render_pdf_to_bytes(data)` which returns bytes.
+    """
+    get_template().build(filename, build_story(data))
 
-    story.append(Spacer(1, 0.5 * inch))
-    story.append(Paragraph("This quotation is indicative and subject to underwriting. For official confirmation contact Kenindia Assurance.", styles["Italic"]))
 
-    doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
\ No newline at end of file
+def render_pdf_to_bytes(data):
+    """Render the same PDF into bytes (BytesIO) so it can be returned from Django views.
+
+    This function builds the document into an in-memory buffer and returns the bytes.
+    """
+    buffer = BytesIO()
+    get_template().build(buffer, build_story(data))
+    return buffer.getvalue()
@@ -0,0 +1,107 @@
+# backend/calculator/utils/pdf_pool.py
+"""
+Render quotation PDFs for web requests in a small per-worker process pool.
+
+ReportLab is pure CPU, so rendering inline ties up the web worker (and, under
+ASGI, its whole event loop). `render_pdf` serves cache hits directly and sends
+misses to PDF_RENDER_WORKERS spawned processes, which write into the PDF cache.
+At most PDF_RENDER_QUEUE_MAX renders may be running or waiting per web worker;
+beyond that it raises RenderPoolBusy so the view can answer 503 instead of
+piling up requests.
+
+Background renders (generate_pdf_task) run on their own "pdf" Celery queue
+instead; see CELERY_TASK_ROUTES.
+"""
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import pdf_generator
+from .pdf_cache import pdf_cache, pdf_key
+
+
+class RenderPoolBusy(Exception):
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = 0
+
+
+def _warm_up():
+    pdf_generator.get_template()  # decode the logo once per render process, not per PDF
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.PDF_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),  # don't fork a running event loop
+                initializer=_warm_up,
+            )
+        return _executor
+
+
+def _discard_executor():
+    global _executor
+    with _executor_lock:
+        broken, _executor = _executor, None
+    if broken is not None:
+        broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _reserve():
+    global _in_flight
+    with _executor_lock:
+        if _in_flight >= settings.PDF_RENDER_QUEUE_MAX:
+            raise RenderPoolBusy(f"{_in_flight} PDF renders already queued")
+        _in_flight += 1
+
+
+def _release():
+    global _in_flight
+    with _executor_lock:
+        _in_flight -= 1
+
+
+async def render_pdf(payload, key=None):
+    """
+    Path of the cached PDF for ``payload``. On a miss a pool process renders it
+    straight into a file in the cache, so the PDF never passes through this process.
+    """
+    key = key or pdf_key(payload)
+    path = await sync_to_async(pdf_cache.get, thread_sensitive=False)(key)
+    if path is not None:
+        return path
+
+    _reserve()
+    tmp = None
+    try:
+        tmp = pdf_cache.reserve(key)
+        future = get_executor().submit(pdf_generator.create_pdf, payload, tmp)
+    except BaseException as e:
+        _release()
+        if tmp is not None:
+            pdf_cache.discard(tmp)
+        if isinstance(e, BrokenProcessPool):
+            _discard_executor()
+        raise
+    # A cancelled request can't stop a render that has already started: the process
+    # keeps writing to ``tmp``, so the slot and the file are only given back once it's done.
+    future.add_done_callback(lambda _: _release())
+    try:
+        await asyncio.wrap_future(future)
+    except BaseException as e:
+        future.add_done_callback(lambda _: pdf_cache.discard(tmp))
+        if isinstance(e, BrokenProcessPool):
+            _discard_executor()  # a render process died; start a fresh pool on the next request
+        raise
+    return await sync_to_async(pdf_cache.commit, thread_sensitive=False)(key, tmp)
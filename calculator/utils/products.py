@@ -0,0 +1,171 @@
+# backend/calculator/utils/products.py
+"""
+Product registry: one declarative entry per plan.
+
+Rates loading, pricing, request validation and the PDF all read from PRODUCTS,
+so adding a plan means adding an entry here (plus its rate workbook) rather
+than new functions and if/elif branches. This module is pure data and must not
+import the rest of the calculator.
+"""
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+
+@dataclass(frozen=True)
+class RateBlock:
+    """Where one plan's rates sit on its sheet of the master workbook (0-based cells)."""
+    sheet: str
+    key: str                # rate-table key; matches the Product key for registered plans
+    header_row: int         # row holding the term labels
+    age_col: int            # column holding the (discounted) age of each row
+    first_rate_col: int     # rate columns run right from here while the header is numeric
+    layout: str = "by_term"  # "by_age" blocks have a single rate column and no term axis
+
+
+@dataclass(frozen=True)
+class AgeRule:
+    basis: str          # "actual" or "next_birthday"
+    min_age: int
+    max_age: int
+    message: str
+    sum_assured_message: Optional[str] = None  # premium -> SA wording, when it differs
+
+
+@dataclass(frozen=True)
+class Payout:
+    """A survival benefit as a fraction of SA. ``label`` may use {term} and {year}."""
+    label: str
+    fraction: float
+    years_before_maturity: int = 0
+
+
+@dataclass(frozen=True)
+class Product:
+    key: str
+    name: str
+    rate_file: Optional[str]            # standalone workbook in calculator/data/; None to use the master
+    rate_layout: str                    # "by_term" (age x term grid) or "by_age" (age -> rate)
+    wp_rate: float                      # Waiver of Premium, fraction of basic premium
+    maturity_label: str
+    maturity_fraction: float
+    payouts: Tuple[Payout, ...] = field(default_factory=tuple)
+    bonus_rate: float = 0.10            # accrued bonus per year, fraction of SA
+    dab_rate: float = 0.001             # Double Accident Benefit, fraction of SA
+    fixed_term: Optional[int] = None    # products sold for a single term only
+    min_sum_assured: Optional[int] = None
+    age_rule: Optional[AgeRule] = None
+
+    def eligibility_error(self, direction, amount, actual_age, age_next_birthday):
+        """Return an error message if the client/amount isn't eligible, else None."""
+        if direction == "premium" and self.min_sum_assured and amount < self.min_sum_assured:
+            return f"Min SA: KES {self.min_sum_assured:,}"
+        rule = self.age_rule
+        if rule:
+            age = actual_age if rule.basis == "actual" else age_next_birthday
+            if not (rule.min_age <= age <= rule.max_age):
+                return (direction == "sum_assured" and rule.sum_assured_message) or rule.message
+        return None
+
+
+PRODUCTS = {p.key: p for p in (
+    Product(
+        key="education_endowment",
+        name="Education Endowment Policy Plan",
+        rate_file="EDUCATION ENDOWMENT POLICY PLAN.xlsx",
+        rate_layout="by_term",
+        wp_rate=0.0,
+        payouts=(
+            Payout("Grade 9", 0.15),
+            Payout("Grade 10", 0.15),
+            Payout("Grade 11", 0.15),
+            Payout("Grade 12", 0.15),
+        ),
+        maturity_label="1st Year University/College (Maturity)",
+        maturity_fraction=0.50,
+    ),
+    Product(
+        key="academic_advantage",
+        name="Academic Advantage Plan",
+        rate_file="ACADEMIC ADVANTAGE PLAN.xlsx",
+        rate_layout="by_term",
+        wp_rate=0.02,
+        min_sum_assured=100000,
+        payouts=(
+            Payout("Year {year}", 0.20, 3),
+            Payout("Year {year}", 0.20, 2),
+            Payout("Year {year}", 0.30, 1),
+        ),
+        maturity_label="Year {term} (Maturity)",
+        maturity_fraction=0.30,
+    ),
+    Product(
+        key="money_back_15",
+        name="15 Years Money Back Plan",
+        rate_file="15 YEARS MONEY BACK PLAN.xlsx",
+        rate_layout="by_age",
+        wp_rate=0.01,
+        fixed_term=15,
+        min_sum_assured=50000,
+        age_rule=AgeRule("actual", 18, 45, "Age 18–45 required", sum_assured_message="Age 18–45"),
+        payouts=(
+            Payout("End of 3rd Year", 0.15),
+            Payout("End of 6th Year", 0.15),
+            Payout("End of 9th Year", 0.15),
+            Payout("End of 12th Year", 0.15),
+        ),
+        maturity_label="Maturity (15th Year)",
+        maturity_fraction=1.00,
+    ),
+    Product(
+        key="money_back_10",
+        name="10 Years Money Back Plan (Kumi Bora)",
+        rate_file="10 YEARS MONEY BACK PLAN.xlsx",
+        rate_layout="by_age",
+        wp_rate=0.01,
+        fixed_term=10,
+        min_sum_assured=50000,
+        age_rule=AgeRule("next_birthday", 18, 50, "Age Next Birthday 18–50"),
+        payouts=(
+            Payout("End of 4th Year", 0.10),
+            Payout("End of 6th Year", 0.10),
+            Payout("End of 8th Year", 0.10),
+        ),
+        maturity_label="Maturity (10th Year)",
+        maturity_fraction=1.00,
+    ),
+)}
+
+
+def get_product(key):
+    """O(1) registry lookup; None for unknown products."""
+    if not key:
+        return None
+    return PRODUCTS.get(str(key).lower())
+
+
+# The actuaries' master workbook holds every plan's rate block side by side with
+# its premium calculator. Registered products prefer their standalone workbook
+# when it exists; every other block is still compiled so a new plan only needs a
+# Product entry (with ``rate_file=None``) to become quotable. The ANNUITY sheet
+# is a per-mode payout table rather than premium rates and is not listed.
+MASTER_RATE_FILE = "PREMIUM CALCULATOR ALL PLANS (1).xlsx"
+
+RATE_BLOCKS = {b.key: b for b in (
+    RateBlock("TERM", "term_assurance", header_row=0, age_col=17, first_rate_col=18),
+    RateBlock("EAP", "whole_life_endowment", header_row=0, age_col=21, first_rate_col=23),
+    RateBlock("DAP", "dynamic_advantage", header_row=0, age_col=21, first_rate_col=22),
+    RateBlock("KUMI", "money_back_10", header_row=0, age_col=17, first_rate_col=18, layout="by_age"),
+    RateBlock("MBP", "money_back_15", header_row=0, age_col=17, first_rate_col=18, layout="by_age"),
+    RateBlock("EEP", "education_endowment", header_row=1, age_col=19, first_rate_col=20),
+    RateBlock("CBP", "christmas_bonus", header_row=0, age_col=17, first_rate_col=18, layout="by_age"),
+    RateBlock("AAP", "academic_advantage", header_row=0, age_col=20, first_rate_col=21),
+    RateBlock("MAP12", "multiple_advantage_12", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("MAP15", "multiple_advantage_15", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("MAP20", "multiple_advantage_20", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("MAP25", "multiple_advantage_25", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("AWP9", "anticipated_endowment_9", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("AWP12", "anticipated_endowment_12", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("AWP15", "anticipated_endowment_15", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("AWP20", "anticipated_endowment_20", header_row=0, age_col=19, first_rate_col=20),
+    RateBlock("AWP25", "anticipated_endowment_25", header_row=0, age_col=19, first_rate_col=20),
+)}
@@ -0,0 +1,144 @@
+# backend/calculator/utils/quote_cache.py
+"""
+Two-level cache in front of the pricing kernel.
+
+Level 1 is a bounded in-process LRU, level 2 the shared Django cache (Redis).
+Keys are a hash of the normalized quote inputs plus the rate-table version, so
+publishing new rates changes every key and stale quotes are never served; old
+entries simply age out (the LRU is also cleared when the version changes).
+
+Cached results are shared between callers and must be treated as read-only.
+"""
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+QUOTE_KEY = "quote:{version}:{digest}"
+
+
+def normalize(params):
+    """Canonical form of a quote: only the inputs that change the price, in fixed types."""
+    return (
+        params["product"],
+        params["direction"],
+        int(params["term"]),
+        str(params["mode"]).lower(),
+        round(float(params["amount"]), 2),
+        int(params["age_next_birthday"]),
+        "female" if str(params["gender"]).lower() == "female" else "male",
+        bool(params["dab_included"]),
+    )
+
+
+def quote_key(params, version):
+    digest = hashlib.sha1(json.dumps(normalize(params)).encode()).hexdigest()
+    return QUOTE_KEY.format(version=version, digest=digest)
+
+
+class QuoteCache:
+    def __init__(self, maxsize=None, timeout=None):
+        self.maxsize = maxsize if maxsize is not None else getattr(settings, "QUOTE_CACHE_SIZE", 10000)
+        self.timeout = timeout if timeout is not None else getattr(settings, "QUOTE_CACHE_TIMEOUT", 86400)
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _local_get(self, key):
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+        return result
+
+    def _local_set(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _check_version(self, version):
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def get_many(self, params_list, version):
+        """Return ({index: result}, {index: key}) for the hits and the misses respectively."""
+        keys = [quote_key(p, version) for p in params_list]
+        found, missing = {}, {}
+        with self._lock:
+            self._check_version(version)
+            for i, key in enumerate(keys):
+                result = self._local_get(key)
+                if result is not None:
+                    found[i] = result
+                else:
+                    missing[i] = key
+
+        shared = {}
+        if missing:
+            try:
+                shared = cache.get_many(list(missing.values()))
+            except Exception as e:
+                logger.warning(f"Shared quote cache unavailable: {e}")
+
+        with self._lock:
+            self.local_hits += len(found)
+            for i, key in list(missing.items()):
+                if key in shared:
+                    found[i] = shared[key]
+                    self._local_set(key, shared[key])
+                    del missing[i]
+                    self.shared_hits += 1
+            self.misses += len(missing)
+        return found, missing
+
+    def set_many(self, items, version):
+        """Store {key: result} in both levels."""
+        if not items:
+            return
+        with self._lock:
+            self._check_version(version)
+            for key, result in items.items():
+                self._local_set(key, result)
+        try:
+            cache.set_many(items, timeout=self.timeout)
+        except Exception as e:
+            logger.warning(f"Shared quote cache unavailable: {e}")
+
+    def get_or_compute(self, params, version, compute):
+        """Single-quote helper: cached result or ``compute()`` (errors are not cached)."""
+        found, missing = self.get_many([params], version)
+        if found:
+            return found[0]
+        result = compute()
+        self.set_many({missing[0]: result}, version)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.local_hits + self.shared_hits + self.misses
+            return {
+                "version": self._version,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else None,
+            }
+
+
+quote_cache = QuoteCache()
@@ -0,0 +1,95 @@
+# backend/calculator/utils/rate_store.py
+"""
+Hot-swappable rate tables.
+
+`manage.py publish_rates` stores a compiled artifact in the shared cache (Redis)
+under its version and then bumps RATES_VERSION_KEY. Every worker asks the cache
+for the current version at most once per RATES_CHECK_INTERVAL seconds and, when
+it changed, loads the new artifact and swaps it in with a single assignment.
+
+Callers take a snapshot with `current_rates()` at the start of a request and
+price the whole request with it, so in-flight requests finish on the table they
+started with while new requests pick up the new one.
+"""
+import io
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .rates_loader import RateTable
+
+logger = logging.getLogger(__name__)
+
+RATES_VERSION_KEY = "rates:version"
+RATES_ARTIFACT_KEY = "rates:artifact:{version}"
+
+
+class RateStore:
+    def __init__(self, check_interval=None):
+        self.check_interval = (
+            check_interval if check_interval is not None
+            else getattr(settings, "RATES_CHECK_INTERVAL", 30)
+        )
+        self._table = RateTable()
+        self._next_check = 0.0
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._table.version
+
+    def current(self):
+        """The live RateTable, refreshed from the cache when the check interval has passed."""
+        if time.monotonic() >= self._next_check:
+            self.refresh()
+        return self._table
+
+    def refresh(self):
+        # Only one thread per process polls; others keep using the current table.
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                published = cache.get(RATES_VERSION_KEY)
+            except Exception as e:
+                logger.warning(f"Rate version check failed, keeping {self._table.version}: {e}")
+                return False
+            if not published or published == self._table.version:
+                return False
+
+            data = cache.get(RATES_ARTIFACT_KEY.format(version=published))
+            if data is None:
+                logger.error(f"Rates {published} are published but the artifact is missing")
+                return False
+            try:
+                table = RateTable.from_artifact(data)
+            except Exception as e:
+                logger.error(f"Failed to load published rates {published}: {e}")
+                return False
+
+            previous, self._table = self._table.version, table
+            logger.info(f"Rate tables swapped {previous} -> {table.version}")
+            return True
+        finally:
+            self._refresh_lock.release()
+
+
+def publish(table):
+    """Store a loaded RateTable's artifact in the cache and make it the live version."""
+    buffer = io.BytesIO()
+    meta = table.dump_compiled(buffer)
+    cache.set(RATES_ARTIFACT_KEY.format(version=meta["version"]), buffer.getvalue(), timeout=None)
+    cache.set(RATES_VERSION_KEY, meta["version"], timeout=None)
+    return meta
+
+
+rate_store = RateStore()
+
+
+def current_rates():
+    """Snapshot of the live rate tables; use one snapshot for a whole request."""
+    return rate_store.current()
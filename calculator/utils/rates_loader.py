@@ -1,87 +1,475 @@
 # backend/calculator/utils/rates_loader.py
-import pandas as pd
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import numpy as np
 from pathlib import Path
 import warnings
 
+from .products import MASTER_RATE_FILE, PRODUCTS, RATE_BLOCKS
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+# Binary artifact written by `manage.py compile_rates`. Bump the format number
+# whenever the layout of the arrays inside the .npz changes.
+COMPILED_RATES_PATH = DATA_DIR / "rates.npz"
+COMPILED_RATES_FORMAT = 3
+
+_hash_cache = {}
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file, read in chunks (memoized on path, size and mtime)."""
+    stat = os.stat(path)
+    cache_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if cache_key not in _hash_cache:
+        digest = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 16), b""):
+                digest.update(chunk)
+        _hash_cache[cache_key] = digest.hexdigest()
+    return _hash_cache[cache_key]
+
+
+def rate_keys():
+    """Every rate-table key we know how to load: registered products plus master blocks."""
+    return list(dict.fromkeys([*PRODUCTS, *RATE_BLOCKS]))
+
+
+def rate_source(key):
+    """
+    Workbook a rate table is read from: the product's standalone workbook when it
+    exists, otherwise the master workbook if it has a block for ``key``. None if neither.
+    """
+    product = PRODUCTS.get(key)
+    if product and product.rate_file:
+        path = DATA_DIR / product.rate_file
+        if path.exists():
+            return path
+    master = DATA_DIR / MASTER_RATE_FILE
+    if key in RATE_BLOCKS and master.exists():
+        return master
+    return None
+
+
+def source_hash(key):
+    """SHA-256 of a rate table's source workbook, or None if it has no source."""
+    path = rate_source(key)
+    return file_sha256(path) if path else None
+
+
+def source_version():
+    """Content-addressed version of the local workbooks: same rates, same version."""
+    sources = {key: source_hash(key) for key in rate_keys()}
+    return hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()[:12]
+
+
+# ----------------------------------------------------------------------
+# Streaming workbook parsing (openpyxl read-only; one pass per sheet)
+# ----------------------------------------------------------------------
+def _number(value):
+    """Numeric cell value as float, or None for blanks, text and booleans."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except ValueError:
+        return None
+
+
+def _cell(row, col):
+    return row[col] if col < len(row) else None
+
+
+def _open_workbook(path):
+    import openpyxl  # only needed when (re)parsing the workbooks
+
+    return openpyxl.load_workbook(path, read_only=True, data_only=True)
+
+
+def _parse_standalone_sheet(rows, layout):
+    """
+    Parse a per-product workbook sheet.
+
+    "by_term": row 2 holds term headers in columns B..L and each later row an age in
+    column A followed by its rates. "by_age": any row with a numeric age in column A
+    and a numeric rate in column B.
+    """
+    ages, rates, terms = [], [], []
+    for i, row in enumerate(rows):
+        if layout == "by_term":
+            if i == 1:
+                terms = [int(t) for t in (_number(_cell(row, j)) for j in range(1, 12)) if t is not None]
+                if not terms:
+                    return None
+                continue
+            if i < 2:
+                continue
+            age = _number(_cell(row, 0))
+            if age is None:
+                continue
+            values = [_number(_cell(row, 1 + j)) for j in range(len(terms))]
+            rates.append([np.nan if v is None or v == 0.0 else v for v in values])
+        else:
+            age, rate = _number(_cell(row, 0)), _number(_cell(row, 1))
+            if age is None or rate is None:
+                continue
+            rates.append(rate)
+        ages.append(int(age))
+
+    if not ages:
+        return None
+    return DenseRates.from_labels(ages, terms, rates)
+
+
+def _parse_master_block(rows, block):
+    """Parse one plan's rate block from its sheet of the master workbook."""
+    ages, rates, terms = [], [], []
+    width = 1
+    for i, row in enumerate(rows):
+        if i < block.header_row:
+            continue
+        if i == block.header_row:
+            if block.layout == "by_term":
+                col = block.first_rate_col
+                while (term := _number(_cell(row, col))) is not None:
+                    terms.append(int(term))
+                    col += 1
+                if not terms:
+                    return None
+                width = len(terms)
+            continue
+
+        age = _number(_cell(row, block.age_col))
+        if age is None:
+            continue
+        values = [_number(_cell(row, block.first_rate_col + j)) for j in range(width)]
+        if all(v is None for v in values):
+            continue
+        if block.layout == "by_term":
+            values = [np.nan if v is None or v == 0.0 else v for v in values]
+            rates.append(values)
+        else:
+            rates.append(np.nan if values[0] is None else values[0])
+        ages.append(int(age))
+
+    if not ages:
+        return None
+    return DenseRates.from_labels(ages, terms, rates)
+
+
+def read_standalone_workbook(path, layout):
+    """Parse a per-product workbook, reading each sheet once. The first usable sheet wins."""
+    wb = _open_workbook(path)
+    try:
+        table = None
+        for ws in wb.worksheets:
+            parsed = _parse_standalone_sheet(ws.iter_rows(values_only=True), layout)
+            if parsed is None:
+                warnings.warn(f"No rate table found in sheet '{ws.title}' of {path.name}")
+            elif table is None:
+                table = parsed
+            else:
+                warnings.warn(f"Ignoring extra rate sheet '{ws.title}' in {path.name}")
+        return table
+    finally:
+        wb.close()
+
+
+def read_master_workbook(keys=None, path=None):
+    """
+    Stream the master workbook and return {key: DenseRates} for the requested blocks
+    (all of RATE_BLOCKS by default). Each sheet is read once; cells are never held
+    beyond the row being parsed.
+    """
+    path = Path(path) if path else DATA_DIR / MASTER_RATE_FILE
+    blocks = [RATE_BLOCKS[k] for k in (keys if keys is not None else RATE_BLOCKS) if k in RATE_BLOCKS]
+    tables = {}
+    wb = _open_workbook(path)
+    try:
+        for block in blocks:
+            if block.sheet not in wb.sheetnames:
+                warnings.warn(f"Sheet '{block.sheet}' not found in {path.name}")
+                continue
+            try:
+                table = _parse_master_block(wb[block.sheet].iter_rows(values_only=True), block)
+            except Exception as e:
+                warnings.warn(f"Failed to parse sheet '{block.sheet}' in {path.name}: {e}")
+                continue
+            if table is None:
+                warnings.warn(f"No rate block found in sheet '{block.sheet}' of {path.name}")
+            else:
+                tables[block.key] = table
+    finally:
+        wb.close()
+    return tables
+
+
+class DenseRates:
+    """One product's rates as a dense (age x term) float array.
+
+    Row ``i`` holds discounted age ``min_age + i``; ``terms`` lists the term of
+    each column. Fixed-term products have a single column and an empty
+    ``terms`` array (the term is ignored on lookup). NaN means "not offered".
+    """
+
+    def __init__(self, rates, min_age, terms):
+        self.rates = np.ascontiguousarray(rates, dtype=np.float64)
+        if self.rates.ndim == 1:
+            self.rates = self.rates.reshape(-1, 1)
+        self.min_age = int(min_age)
+        self.terms = np.asarray(terms, dtype=np.int64)
+        self.term_columns = {int(t): i for i, t in enumerate(self.terms)}
+
+        # term -> column as an array as well, for vectorized lookups
+        if self.terms.size:
+            self.min_term = int(self.terms.min())
+            self.term_lookup = np.full(int(self.terms.max()) - self.min_term + 1, -1, dtype=np.int64)
+            self.term_lookup[self.terms - self.min_term] = np.arange(self.terms.size)
+        else:
+            self.min_term = 0
+            self.term_lookup = None
+
+    @classmethod
+    def from_labels(cls, ages, terms, rates):
+        """Build from possibly gappy age labels, filling missing ages with NaN."""
+        ages = np.asarray(ages, dtype=np.int64)
+        rates = np.asarray(rates, dtype=np.float64)
+        if rates.ndim == 1:
+            rates = rates.reshape(-1, 1)
+        min_age = int(ages.min())
+        dense = np.full((int(ages.max()) - min_age + 1, rates.shape[1]), np.nan)
+        dense[ages - min_age] = rates
+        return cls(dense, min_age, terms)
+
+    @property
+    def max_age(self):
+        return self.min_age + self.rates.shape[0] - 1
+
+    def lookup(self, discounted_age, term):
+        row = int(discounted_age) - self.min_age
+        if row < 0 or row >= self.rates.shape[0]:
+            return None
+        if self.term_lookup is None:
+            col = 0
+        else:
+            col = self.term_columns.get(term)
+            if col is None:
+                return None
+        rate = self.rates[row, col]
+        if rate != rate:  # NaN: not offered
+            return None
+        return float(rate)
+
+    def lookup_many(self, ages, terms):
+        ages, terms = np.broadcast_arrays(np.asarray(ages, dtype=np.int64), np.asarray(terms, dtype=np.int64))
+        rows = ages - self.min_age
+        valid = (rows >= 0) & (rows < self.rates.shape[0])
+        if self.term_lookup is None:
+            cols = np.zeros(ages.shape, dtype=np.int64)
+        else:
+            offsets = terms - self.min_term
+            valid &= (offsets >= 0) & (offsets < self.term_lookup.size)
+            cols = np.full(ages.shape, -1, dtype=np.int64)
+            cols[valid] = self.term_lookup[offsets[valid]]
+            valid &= cols >= 0
+
+        out = np.full(ages.shape, np.nan)
+        out[valid] = self.rates[rows[valid], cols[valid]]
+        return out
+
+
 class RateTable:
-    def __init__(self):
+    """
+    Rate tables for every registered product, loaded lazily on first use.
+
+    A product's table comes from the compiled artifact when its recorded source
+    hash still matches the workbook, otherwise from parsing the workbook itself.
+    A worker therefore only pays for the plans it actually prices.
+    """
+
+    def __init__(self, compiled_path=COMPILED_RATES_PATH):
+        self.compiled_path = Path(compiled_path) if compiled_path else None
         self.tables = {}
-        self._load_all_tables()
-
-    def _load_all_tables(self):
-        product_paths = {
-            "education_endowment": "EDUCATION ENDOWMENT POLICY PLAN.xlsx",
-            "academic_advantage": "ACADEMIC ADVANTAGE PLAN.xlsx",
-            "money_back_15": "15 YEARS MONEY BACK PLAN.xlsx",
-            "money_back_10": "10 YEARS MONEY BACK PLAN.xlsx",
-        }
+        self.sources = {}  # product -> "compiled", "excel" or "published", for diagnostics
+        self._version = None
+        self._compiled_meta = None
+        self._unavailable = set()
+        self._lock = threading.Lock()
 
-        for product, file_name in product_paths.items():
-            path = Path(__file__).resolve().parent.parent / "data" / file_name
-            if not path.exists():
-                warnings.warn(f"File not found for {product}: {path}")
-                continue
+    @classmethod
+    def from_artifact(cls, data):
+        """
+        Build a fully loaded table from published artifact bytes. Published rates are
+        authoritative: they aren't checked against (or backfilled from) local workbooks.
+        """
+        table = cls(compiled_path=None)
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+            meta = json.loads(str(npz["__meta__"]))
+            if meta.get("format") != COMPILED_RATES_FORMAT:
+                raise ValueError(f"Unsupported rates artifact format {meta.get('format')}")
+            for key in meta["products"]:
+                table.tables[key] = DenseRates(
+                    npz[f"{key}__rates"], int(npz[f"{key}__min_age"]), npz[f"{key}__terms"],
+                )
+                table.sources[key] = "published"
+        table._version = meta["version"]
+        table._unavailable = {k for k in rate_keys() if k not in table.tables}
+        return table
 
-            xls = pd.ExcelFile(path, engine="openpyxl")
-            for sheet_name in xls.sheet_names:
-                df = pd.read_excel(path, sheet_name=sheet_name, header=None, engine="openpyxl")
+    @property
+    def version(self):
+        """Identifier of the rates this table prices with (recorded on every calculation)."""
+        if self._version is None:
+            self._version = source_version()
+        return self._version
+
+    def table(self, product_key):
+        """The DenseRates for a product, loading it on first access (None if unavailable)."""
+        key = product_key.lower()
+        table = self.tables.get(key)
+        if table is not None or key in self._unavailable:
+            return table
+        if key not in PRODUCTS and key not in RATE_BLOCKS:
+            return None
+
+        with self._lock:
+            if key in self.tables:
+                return self.tables[key]
+            table = self._load_compiled(key)
+            if table is not None:
+                self.sources[key] = "compiled"
+            else:
+                table = self._parse_workbook(key)
+                self.sources[key] = "excel"
+            if table is None:
+                self._unavailable.add(key)
+            else:
+                self.tables[key] = table
+        return table
+
+    def load_all(self):
+        """
+        Eagerly load every known rate table (used when compiling). Tables that come
+        from the master workbook are parsed together in a single pass over it.
+        """
+        master = DATA_DIR / MASTER_RATE_FILE
+        pending = [k for k in rate_keys() if k not in self.tables and k not in self._unavailable]
+        from_master = [k for k in pending if rate_source(k) == master]
+        with self._lock:
+            for key in from_master:
+                table = self._load_compiled(key)
+                if table is not None:
+                    self.tables[key] = table
+                    self.sources[key] = "compiled"
+            parsed = read_master_workbook([k for k in from_master if k not in self.tables])
+            for key in from_master:
+                if key in parsed:
+                    self.tables[key] = parsed[key]
+                    self.sources[key] = "excel"
+                elif key not in self.tables:
+                    self._unavailable.add(key)
+        for key in pending:
+            self.table(key)
+        return self.tables
+
+    # ------------------------------------------------------------------
+    # Compiled artifact
+    # ------------------------------------------------------------------
+    def _read_compiled_meta(self):
+        if self._compiled_meta is None:
+            meta = {}
+            path = self.compiled_path
+            if path and path.exists():
                 try:
-                    if product in ["education_endowment", "academic_advantage"]:
-                        # 2D table parsing: attempt to coerce headers/ages to numeric and drop non-numeric rows
-                        raw_terms = df.iloc[1, 1:12]
-                        terms_numeric = pd.to_numeric(raw_terms, errors="coerce").dropna()
-                        if terms_numeric.empty:
-                            warnings.warn(f"No numeric term headers found in sheet '{sheet_name}' of {file_name}")
-                            continue
-                        terms = terms_numeric.astype(int).values
-
-                        raw_ages = df.iloc[2:, 0]
-                        ages_numeric = pd.to_numeric(raw_ages, errors="coerce").dropna()
-                        if ages_numeric.empty:
-                            warnings.warn(f"No numeric ages found in sheet '{sheet_name}' of {file_name}")
-                            continue
-                        ages = ages_numeric.astype(int).values
-
-                        # slice rates matrix using lengths found (safe bounds)
-                        rates_block = df.iloc[2: 2 + len(ages), 1: 1 + len(terms)]
-                        # coerce to numeric and replace non-numeric with NaN
-                        rates_data = rates_block.apply(pd.to_numeric, errors="coerce").values
-
-                        rate_df = pd.DataFrame(rates_data, index=ages, columns=terms)
-                        rate_df = rate_df.replace(0.0, float("nan"))
-                    else:
-                        # 1D table parsing for fixed-term products - first column ages, second column rates
-                        # Coerce both columns together and drop rows where either is non-numeric to keep alignment
-                        two_col = df.iloc[:, 0:2].copy()
-                        two_col.columns = ["age", "rate"]
-                        two_col["age"] = pd.to_numeric(two_col["age"], errors="coerce")
-                        two_col["rate"] = pd.to_numeric(two_col["rate"], errors="coerce")
-                        two_col = two_col.dropna(subset=["age", "rate"])  # keep only rows with both values
-                        if two_col.empty:
-                            warnings.warn(f"No numeric age-rate pairs found in sheet '{sheet_name}' of {file_name}")
-                            continue
-                        ages = two_col["age"].astype(int).values
-                        rates = two_col["rate"].astype(float).values
-                        rate_df = pd.Series(rates, index=ages)
-
-                    # store lowercase product key -> rate table (DataFrame or Series)
-                    self.tables[product.lower()] = rate_df
+                    with np.load(path, allow_pickle=False) as npz:
+                        meta = json.loads(str(npz["__meta__"]))
                 except Exception as e:
-                    warnings.warn(f"Failed to parse sheet '{sheet_name}' in {file_name}: {e}")
+                    warnings.warn(f"Failed to read compiled rates at {path}: {e}")
+                if meta and meta.get("format") != COMPILED_RATES_FORMAT:
+                    warnings.warn(f"Compiled rates at {path} use format {meta.get('format')}; re-parsing Excel")
+                    meta = {}
+            self._compiled_meta = meta
+        return self._compiled_meta
 
-    def get_rate(self, product_key, discounted_age, term):
-        df = self.tables.get(product_key.lower())
-        if df is None:
+    def _load_compiled(self, key):
+        """One product's table from the .npz artifact; None if missing or stale."""
+        meta = self._read_compiled_meta()
+        if key not in meta.get("products", ()):
+            return None
+        if meta.get("sources", {}).get(key) != source_hash(key):
+            warnings.warn(f"Compiled rates for {key} are stale; run `manage.py compile_rates`")
             return None
 
         try:
-            if isinstance(df, pd.DataFrame):  # 2D table
-                rate = df.at[discounted_age, term]
-            else:  # 1D Series, ignore term
-                rate = df.at[discounted_age]
-            if pd.isna(rate):
-                return None
-            return float(rate)
-        except KeyError:
+            with np.load(self.compiled_path, allow_pickle=False) as npz:
+                return DenseRates(
+                    npz[f"{key}__rates"],
+                    int(npz[f"{key}__min_age"]),
+                    npz[f"{key}__terms"],
+                )
+        except Exception as e:
+            warnings.warn(f"Failed to read compiled rates for {key}: {e}")
             return None
-        
+
+    def dump_compiled(self, fh):
+        """Write the loaded tables as a versioned .npz artifact to a binary file object."""
+        arrays = {}
+        for product, table in self.tables.items():
+            arrays[f"{product}__rates"] = table.rates
+            arrays[f"{product}__min_age"] = np.int64(table.min_age)
+            arrays[f"{product}__terms"] = table.terms
+
+        meta = {
+            "format": COMPILED_RATES_FORMAT,
+            "version": self.version,
+            "products": sorted(self.tables),
+            "sources": {product: source_hash(product) for product in self.tables},
+        }
+        arrays["__meta__"] = np.array(json.dumps(meta, sort_keys=True))
+        np.savez(fh, **arrays)
+        return meta
+
+    def save_compiled(self, path=COMPILED_RATES_PATH):
+        """Write the loaded tables to a versioned .npz artifact (atomic replace)."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                meta = self.dump_compiled(fh)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return meta
+
+    # ------------------------------------------------------------------
+    # Excel parsing (fallback when no fresh artifact exists)
+    # ------------------------------------------------------------------
+    def _parse_workbook(self, key):
+        path = rate_source(key)
+        if path is None:
+            warnings.warn(f"No rate workbook found for {key}")
+            return None
+        if path.name == MASTER_RATE_FILE:
+            return read_master_workbook([key], path).get(key)
+        return read_standalone_workbook(path, PRODUCTS[key].rate_layout)
+
+    def get_rate(self, product_key, discounted_age, term):
+        table = self.table(product_key)
+        if table is None:
+            return None
+        return table.lookup(discounted_age, term)
+
+    def get_rates(self, product_key, ages, terms):
+        """Vectorized get_rate: float array shaped like ``ages``, NaN where no rate exists."""
+        table = self.table(product_key)
+        if table is None:
+            return np.full(np.shape(ages), np.nan)
+        return table.lookup_many(ages, terms)
@@ -0,0 +1,249 @@
+# backend/calculator/utils/write_behind.py
+"""
+Optional write-behind for CalculationResult inserts (CALCULATION_WRITE_BEHIND).
+
+When enabled, the quote views don't touch the database: each result gets a
+time-ordered ID from this process, is written to Redis (one key per row plus a
+queue of IDs) and the response goes out immediately. The
+`flush_calculation_results` Celery task drains the queue with bulk_create.
+
+A row that hasn't been flushed yet is still readable: get_calculation() inserts
+it on demand, and the STK push view goes through it so a payment never
+references a calculation the database doesn't have.
+
+Each process leases its worker ID in Redis (renewed while it is in use), so no
+two live processes share one. A process that can't get a lease doesn't use
+write-behind and inserts directly.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+from ..models import CalculationResult
+
+logger = logging.getLogger(__name__)
+
+PENDING_QUEUE_KEY = "calc:pending"
+PENDING_ROW_KEY = "calc:pending:{id}"
+WORKER_ID_KEY = "calc:worker-id"
+WORKER_LEASE_KEY = "calc:worker-lease:{id}"
+WORKER_LEASE_TTL = 60  # seconds; renewed every WORKER_LEASE_TTL / 3 while IDs are handed out
+FLUSH_LOCK_KEY = "calc:flush-lock"
+
+# IDs fit in 53 bits so browsers can hold them as plain JS numbers:
+# 38 bits of 10 ms ticks since ID_EPOCH (~87 years) | 8 bits worker | 7 bits sequence.
+ID_EPOCH = datetime(2025, 1, 1).timestamp()
+TICK_SECONDS = 0.01
+WORKER_BITS = 8
+SEQUENCE_BITS = 7
+
+
+def enabled():
+    return getattr(settings, "CALCULATION_WRITE_BEHIND", False)
+
+
+def _redis():
+    from django_redis import get_redis_connection
+    return get_redis_connection("default")
+
+
+class WorkerIdUnavailable(Exception):
+    pass
+
+
+class IdGenerator:
+    """Snowflake-style IDs: unique across workers, increasing within one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token = uuid.uuid4().hex
+        self._worker_id = None
+        self._renew_at = 0.0
+        self._last_tick = -1
+        self._sequence = 0
+
+    def _claim(self, redis, worker_id):
+        key = WORKER_LEASE_KEY.format(id=worker_id)
+        if redis.set(key, self._token, nx=True, ex=WORKER_LEASE_TTL):
+            return True
+        held_by = redis.get(key)
+        return held_by is not None and held_by.decode() == self._token and bool(redis.expire(key, WORKER_LEASE_TTL))
+
+    def _lease(self):
+        """Keep (or take) a leased worker ID; raises WorkerIdUnavailable when none can be had."""
+        now = time.monotonic()
+        if self._worker_id is not None and now < self._renew_at:
+            return self._worker_id
+        try:
+            redis = _redis()
+            if self._worker_id is None or not self._claim(redis, self._worker_id):
+                if self._worker_id is not None:
+                    logger.warning(f"Lost lease on worker ID {self._worker_id}; taking another")
+                self._worker_id = None
+                start = redis.incr(WORKER_ID_KEY)  # spread processes over the ID space
+                for offset in range(1 << WORKER_BITS):
+                    candidate = (start + offset) % (1 << WORKER_BITS)
+                    if self._claim(redis, candidate):
+                        self._worker_id = candidate
+                        break
+                else:
+                    raise WorkerIdUnavailable(f"All {1 << WORKER_BITS} worker IDs are leased")
+        except WorkerIdUnavailable:
+            raise
+        except Exception as e:
+            self._worker_id = None
+            raise WorkerIdUnavailable(f"Worker ID lease failed: {e}") from e
+        self._renew_at = now + WORKER_LEASE_TTL / 3
+        return self._worker_id
+
+    @property
+    def worker_id(self):
+        with self._lock:
+            return self._lease()
+
+    def next_id(self):
+        with self._lock:
+            worker_id = self._lease()
+            tick = int((time.time() - ID_EPOCH) / TICK_SECONDS)
+            if tick < self._last_tick:  # clock stepped back; keep IDs increasing
+                tick = self._last_tick
+            if tick == self._last_tick:
+                self._sequence += 1
+                if self._sequence >> SEQUENCE_BITS:
+                    while tick <= self._last_tick:
+                        time.sleep(TICK_SECONDS / 4)
+                        tick = int((time.time() - ID_EPOCH) / TICK_SECONDS)
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_tick = tick
+            return (tick << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | self._sequence
+
+
+id_generator = IdGenerator()
+
+
+def _serialize(calc):
+    return json.dumps({
+        "id": calc.id,
+        "product": calc.product,
+        "input_data": calc.input_data,
+        "result_data": calc.result_data,
+        "amount_due": str(calc.amount_due),
+        "rate_version": calc.rate_version,
+        "expires_at": calc.expires_at.isoformat(),
+    })
+
+
+def _deserialize(raw):
+    row = json.loads(raw)
+    row["amount_due"] = Decimal(row["amount_due"])
+    row["expires_at"] = datetime.fromisoformat(row["expires_at"])
+    return CalculationResult(paid=False, **row)
+
+
+def save_calculations(calcs):
+    """
+    Persist new (unsaved) CalculationResults and return them with IDs set:
+    bulk_create, or queue them in Redis when write-behind is enabled.
+    """
+    if not calcs:
+        return calcs
+    if not enabled():
+        return CalculationResult.objects.bulk_create(calcs)
+
+    ttl = getattr(settings, "CALCULATION_PENDING_TTL", 86400)
+    try:
+        for calc in calcs:
+            calc.id = id_generator.next_id()
+    except WorkerIdUnavailable as e:
+        logger.warning(f"Write-behind unavailable, inserting directly: {e}")
+        for calc in calcs:
+            calc.id = None
+        return CalculationResult.objects.bulk_create(calcs)
+    pipe = _redis().pipeline(transaction=False)
+    for calc in calcs:
+        pipe.set(PENDING_ROW_KEY.format(id=calc.id), _serialize(calc), ex=ttl)
+    pipe.rpush(PENDING_QUEUE_KEY, *[calc.id for calc in calcs])
+    pipe.execute()
+    return calcs
+
+
+def _same_row(a, b):
+    return (a.product, a.input_data, a.result_data) == (b.product, b.input_data, b.result_data)
+
+
+def _insert_one(row):
+    """Insert a queued row unless it's already there; log if the ID belongs to a different row."""
+    try:
+        with transaction.atomic():
+            row.save(force_insert=True)
+    except IntegrityError:
+        existing = CalculationResult.objects.filter(pk=row.pk).first()
+        if existing is None:
+            raise
+        if not _same_row(existing, row):
+            logger.error(f"Calculation ID collision on {row.pk}: queued row for {row.product} not inserted")
+
+
+def _insert(rows):
+    """Insert queued rows, skipping those get_calculation() already inserted on demand."""
+    existing = CalculationResult.objects.in_bulk([row.pk for row in rows])
+    fresh = []
+    for row in rows:
+        if row.pk not in existing:
+            fresh.append(row)
+        elif not _same_row(existing[row.pk], row):
+            logger.error(f"Calculation ID collision on {row.pk}: queued row for {row.product} not inserted")
+    try:
+        with transaction.atomic():
+            CalculationResult.objects.bulk_create(fresh)
+    except IntegrityError:  # raced with an on-demand insert; go row by row
+        for row in fresh:
+            _insert_one(row)
+
+
+def flush(batch_size=None):
+    """Insert up to ``batch_size`` queued rows with one bulk_create; returns how many were taken."""
+    batch_size = batch_size or getattr(settings, "CALCULATION_FLUSH_BATCH", 1000)
+    redis = _redis()
+    with cache.lock(FLUSH_LOCK_KEY, timeout=60):
+        ids = [int(i) for i in redis.lrange(PENDING_QUEUE_KEY, 0, batch_size - 1)]
+        if not ids:
+            return 0
+        keys = [PENDING_ROW_KEY.format(id=i) for i in ids]
+        _insert([_deserialize(raw) for raw in redis.mget(keys) if raw is not None])
+        pipe = redis.pipeline()
+        pipe.ltrim(PENDING_QUEUE_KEY, len(ids), -1)
+        pipe.delete(*keys)
+        pipe.execute()
+    return len(ids)
+
+
+def persist(calc_id):
+    """Insert a still-queued row now. Returns False if there is no such pending row."""
+    if not enabled():
+        return False
+    raw = _redis().get(PENDING_ROW_KEY.format(id=calc_id))
+    if raw is None:
+        return False
+    _insert_one(_deserialize(raw))
+    return True
+
+
+def get_calculation(calc_id):
+    """CalculationResult.objects.get(pk=...) that also sees rows still waiting to be flushed."""
+    try:
+        return CalculationResult.objects.get(pk=calc_id)
+    except CalculationResult.DoesNotExist:
+        if not persist(calc_id):
+            raise
+    return CalculationResult.objects.get(pk=calc_id)
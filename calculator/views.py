@@ -1,27 +1,45 @@
 # backend/calculator/views.py
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from datetime import date, timedelta
 from decimal import Decimal
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST, require_safe
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from asgiref.sync import sync_to_async
 from django.utils.dateparse import parse_datetime
 from django.utils import timezone
+import json
+import logging
+import math
+import os
 import re
+import numpy as np
 
 from .utils.calculations import (
-    calculate_premium_logic,
-    calculate_sum_assured_logic,
-    calculate_premium_logic_academic_advantage,
-    calculate_sum_assured_logic_academic_advantage,
-    calculate_premium_logic_money_back_15,
-    calculate_sum_assured_logic_money_back_15,
-    calculate_premium_logic_money_back_10,
-    calculate_sum_assured_logic_money_back_10,
+    MAX_GRID_POINTS, MODE_FACTORS, quote, quote_batch, offered_terms, premium_grid, age_term_grid,
 )
-from .models import MpesaTransaction, CalculationResult
-from .utils.pdf_generator import render_pdf_to_bytes
-from .tasks import process_mpesa_callback
+from .utils.rate_store import current_rates
+from .utils.quote_cache import quote_cache
+from .utils.write_behind import save_calculations, get_calculation
+from .utils.payment_events import subscribe_payment_status
+from .utils.callback_queue import enqueue_callback
+from .utils.products import get_product
+from .models import MpesaTransaction, CalculationResult, CALCULATION_TTL
+from .utils.pdf_cache import pdf_cache, pdf_key
+from .utils.pdf_pool import RenderPoolBusy, render_pdf
+from .tasks import process_mpesa_callback, send_stk_push, export_pdf_bundle, pdf_bundle_path, quotation_payload
+from .utils.circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
 
 
 # --------------------------------------------------------------------
@@ -65,74 +83,91 @@ def clean_phone_number(phone_number):
     return phone if re.match(r"^254[17]\d{8}$", phone) else None
 
 
-# --------------------------------------------------------------------
-# Premium Calculation (SA → Premium)
-# --------------------------------------------------------------------
-@api_view(["POST"])
-def calculate_premium(request):
-    data = request.data
-    product = data.get("product", "").lower()
+# The premium and sum-assured endpoints have always worded these differently
+_QUOTE_ERRORS = {
+    "premium": {"missing": "Missing required fields.", "invalid": "Invalid date or number."},
+    "sum_assured": {"missing": "Missing fields.", "invalid": "Invalid input."},
+}
+
+
+def _validate_quote(data, direction):
+    """
+    Normalize one quote request against the product registry.
+
+    ``direction`` is "premium" (SA given) or "sum_assured" (premium given).
+    Returns (quote, None) or (None, error message).
+    """
+    if not isinstance(data, dict):
+        return None, "Each quote must be an object."
+
+    amount_field = "sumAssured" if direction == "premium" else "premium"
+    product = get_product(data.get("product"))
     dob_str = data.get("dob")
     term = data.get("term")
-    mode = data.get("mode", "yearly").lower()
-    sum_assured = data.get("sumAssured")
-    gender = data.get("gender", "male").lower()
-    smoker = data.get("smoker", "non-smoker").lower()
-    dab_included = _coerce_bool(data.get("dabIncluded", True))
+    amount = data.get(amount_field)
 
-    # Validation
-    if not product or not dob_str or sum_assured in (None, ""):
-        return Response({"error": "Missing required fields."}, status=400)
+    if not data.get("product") or not dob_str or amount in (None, ""):
+        return None, _QUOTE_ERRORS[direction]["missing"]
     if not term or not str(term).isdigit():
-        return Response({"error": "Invalid term."}, status=400)
+        return None, "Invalid term."
 
     try:
         dob = date.fromisoformat(dob_str)
         term = int(term)
-        sum_assured = float(sum_assured)
-    except ValueError:
-        return Response({"error": "Invalid date or number."}, status=400)
+        amount = float(amount)
+    except (TypeError, ValueError):
+        return None, _QUOTE_ERRORS[direction]["invalid"]
+    if not math.isfinite(amount) or amount <= 0:
+        return None, "Amount must be a positive number."
 
     actual_age, age_next_birthday = get_age_next_birthday(dob)
 
-    # Product rules
-    if product == "money_back_15":
-        if sum_assured < 50000:
-            return Response({"error": "Min SA: KES 50,000"}, status=400)
-        if not (18 <= actual_age <= 45):
-            return Response({"error": "Age 18–45 required"}, status=400)
-        term = 15
-    elif product == "money_back_10":
-        if sum_assured < 50000:
-            return Response({"error": "Min SA: KES 50,000"}, status=400)
-        if not (18 <= age_next_birthday <= 50):
-            return Response({"error": "Age Next Birthday 18–50"}, status=400)
-        term = 10
-    elif product == "academic_advantage" and sum_assured < 100000:
-        return Response({"error": "Min SA: KES 100,000"}, status=400)
-
-    # Calculate
+    if product is None:
+        return None, "Unsupported product"
+    error = product.eligibility_error(direction, amount, actual_age, age_next_birthday)
+    if error:
+        return None, error
+    if product.fixed_term is not None:
+        term = product.fixed_term
+
+    return {
+        "product": product.key,
+        "direction": direction,
+        "term": term,
+        "mode": str(data.get("mode", "yearly")).lower(),
+        "amount": amount,
+        "age_next_birthday": age_next_birthday,
+        "actual_age": actual_age,
+        "gender": str(data.get("gender", "male")).lower(),
+        "dab_included": _coerce_bool(data.get("dabIncluded", True)),
+        "data": data,
+    }, None
+
+
+def _calculate_single(data, direction):
+    """Shared body of the premium and sum-assured endpoints."""
+    params, error = _validate_quote(data, direction)
+    if error:
+        return Response({"error": error}, status=400)
+
     try:
-        if product == "education_endowment":
-            result = calculate_premium_logic(product, term, mode, sum_assured, age_next_birthday, gender, smoker, dab_included)
-        elif product == "academic_advantage":
-            result = calculate_premium_logic_academic_advantage(product, term, mode, sum_assured, age_next_birthday, gender, smoker, dab_included)
-        elif product == "money_back_15":
-            result = calculate_premium_logic_money_back_15(product, term, mode, sum_assured, age_next_birthday, gender, smoker, dab_included)
-        elif product == "money_back_10":
-            result = calculate_premium_logic_money_back_10(product, term, mode, sum_assured, age_next_birthday, gender, smoker, dab_included)
-        else:
-            return Response({"error": "Unsupported product"}, status=400)
+        rate_table = current_rates()
+        result = quote_cache.get_or_compute(params, rate_table.version, lambda: quote(
+            params["product"], direction, params["term"], params["mode"], params["amount"],
+            params["age_next_birthday"], params["gender"], params["dab_included"],
+            rate_table=rate_table,
+        ))
 
         amount_due = Decimal("5.00")
-        calc = CalculationResult.objects.create(
-            product=product,
-            input_data={**data, "actualAge": actual_age, "ageNextBirthday": age_next_birthday},
+        calc, = save_calculations([CalculationResult(
+            product=params["product"],
+            input_data={**data, "actualAge": params["actual_age"], "ageNextBirthday": params["age_next_birthday"]},
             result_data=result,
             amount_due=amount_due,
             paid=False,
-            
-        )
+            expires_at=timezone.now() + CALCULATION_TTL,
+            rate_version=rate_table.version,
+        )])
 
         return Response({
             "message": "Pay to download",
@@ -144,77 +179,192 @@ def calculate_premium(request):
         return Response({"error": str(e)}, status=500)
 
 
+# --------------------------------------------------------------------
+# Premium Calculation (SA → Premium)
+# --------------------------------------------------------------------
+@api_view(["POST"])
+def calculate_premium(request):
+    return _calculate_single(request.data, "premium")
+
+
 # --------------------------------------------------------------------
 # Sum Assured Calculation (Premium → SA)
 # --------------------------------------------------------------------
 @api_view(["POST"])
 def calculate_sum_assured(request):
-    # Same structure as above, just reversed
-    data = request.data
-    product = data.get("product", "").lower()
-    dob_str = data.get("dob")
-    term = data.get("term")
-    mode = data.get("mode", "yearly").lower()
-    premium = data.get("premium")
-    gender = data.get("gender", "male").lower()
-    smoker = data.get("smoker", "non-smoker").lower()
-    dab_included = _coerce_bool(data.get("dabIncluded", True))
+    return _calculate_single(request.data, "sum_assured")
 
-    if not product or not dob_str or premium in (None, ""):
-        return Response({"error": "Missing fields."}, status=400)
-    if not term or not str(term).isdigit():
-        return Response({"error": "Invalid term."}, status=400)
 
-    try:
-        dob = date.fromisoformat(dob_str)
-        term = int(term)
-        premium = float(premium)
-    except ValueError:
-        return Response({"error": "Invalid input."}, status=400)
+# --------------------------------------------------------------------
+# Batch Quoting (many clients, mixed products/directions)
+# --------------------------------------------------------------------
+MAX_BATCH_QUOTES = 5000
 
-    actual_age, age_next_birthday = get_age_next_birthday(dob)
 
-    if product == "money_back_15":
-        if not (18 <= actual_age <= 45):
-            return Response({"error": "Age 18–45"}, status=400)
-        term = 15
-    elif product == "money_back_10":
-        if not (18 <= age_next_birthday <= 50):
-            return Response({"error": "Age Next Birthday 18–50"}, status=400)
-        term = 10
+def _price_cached(params_list, rate_table):
+    """quote_batch() for the quote-cache misses only; returns (result, error) tuples in order."""
+    version = rate_table.version
+    found, missing = quote_cache.get_many(params_list, version)
+    priced = [(found[i], None) if i in found else None for i in range(len(params_list))]
+    if missing:
+        todo = list(missing)
+        fresh = {}
+        for i, (result, error) in zip(todo, quote_batch([params_list[i] for i in todo], rate_table)):
+            priced[i] = (result, error)
+            if error is None:
+                fresh[missing[i]] = result
+        quote_cache.set_many(fresh, version)
+    return priced
 
-    try:
-        if product == "education_endowment":
-            result = calculate_sum_assured_logic(product, term, mode, premium, age_next_birthday, gender, smoker, dab_included)
-        elif product == "academic_advantage":
-            result = calculate_sum_assured_logic_academic_advantage(product, term, mode, premium, age_next_birthday, gender, smoker, dab_included)
-        elif product == "money_back_15":
-            result = calculate_sum_assured_logic_money_back_15(product, term, mode, premium, age_next_birthday, gender, smoker, dab_included)
-        elif product == "money_back_10":
-            result = calculate_sum_assured_logic_money_back_10(product, term, mode, premium, age_next_birthday, gender, smoker, dab_included)
-        else:
-            return Response({"error": "Unsupported product"}, status=400)
 
-        amount_due = Decimal("5.00")
-        calc = CalculationResult.objects.create(
-            product=product,
-            input_data={**data, "actualAge": actual_age, "ageNextBirthday": age_next_birthday},
+@api_view(["POST"])
+def calculate_batch(request):
+    """Quote many clients in one request; per-item errors don't fail the batch."""
+    data = request.data
+    items = data.get("quotes") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return Response({"error": "Provide a non-empty 'quotes' list."}, status=400)
+    if len(items) > MAX_BATCH_QUOTES:
+        return Response({"error": f"At most {MAX_BATCH_QUOTES} quotes per batch."}, status=400)
+
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        direction = str(item.get("direction", "premium") if isinstance(item, dict) else "premium")
+        direction = direction.lower().replace("-", "_")
+        if direction not in ("premium", "sum_assured"):
+            results[index] = {"index": index, "error": "Invalid direction."}
+            continue
+        params, error = _validate_quote(item, direction)
+        if error:
+            results[index] = {"index": index, "error": error}
+        else:
+            valid.append((index, params))
+
+    amount_due = Decimal("5.00")
+    expires_at = timezone.now() + CALCULATION_TTL  # save_calculations() skips save()
+    rate_table = current_rates()
+    priced = _price_cached([p for _, p in valid], rate_table)
+    rows, row_indexes = [], []
+    for (index, params), (result, error) in zip(valid, priced):
+        if error:
+            results[index] = {"index": index, "error": error}
+            continue
+        rows.append(CalculationResult(
+            product=params["product"],
+            input_data={**params["data"], "actualAge": params["actual_age"], "ageNextBirthday": params["age_next_birthday"]},
             result_data=result,
             amount_due=amount_due,
             paid=False,
-            
+            expires_at=expires_at,
+            rate_version=rate_table.version,
+        ))
+        row_indexes.append(index)
+
+    created = save_calculations(rows)
+    for index, calc in zip(row_indexes, created):
+        results[index] = {"index": index, "calculation_id": calc.id, "amount_due": float(amount_due)}
+
+    return Response({
+        "message": "Pay to download",
+        "count": len(items),
+        "succeeded": len(created),
+        "failed": len(items) - len(created),
+        "results": results,
+    })
+
+
+# --------------------------------------------------------------------
+# Quote Grids (premium curves for the interactive calculator)
+# --------------------------------------------------------------------
+GRID_SA_STEPS = 100
 
 
+@api_view(["POST"])
+def calculate_grid(request):
+    """
+    Whole premium surface in one response, as columnar JSON.
+
+    kind="premium" (default): term × mode × SA grid for one client (``dob`` required);
+    ``saMin``/``saMax``/``saStep`` set the SA axis, ``terms``/``modes`` narrow the others.
+    kind="age": age-next-birthday × term grid for one ``sumAssured`` and ``mode``.
+    ``installment_premium`` is flattened row-major over ``shape``; null means not offered.
+    """
+    data = request.data
+    product = get_product(data.get("product"))
+    if product is None:
+        return Response({"error": "Unsupported product"}, status=400)
+    gender = str(data.get("gender", "male")).lower()
+    dab_included = _coerce_bool(data.get("dabIncluded", True))
+    kind = str(data.get("kind", "premium")).lower()
+    rate_table = current_rates()
+
+    try:
+        if kind == "age":
+            sum_assured = float(data.get("sumAssured", product.min_sum_assured or 100000))
+            if not math.isfinite(sum_assured) or sum_assured <= 0:
+                return Response({"error": "Invalid sum assured."}, status=400)
+            grid = age_term_grid(
+                product, gender, dab_included, sum_assured, str(data.get("mode", "yearly")).lower(),
+                rate_table=rate_table,
+            )
+            grid["rate_version"] = rate_table.version
+            return Response(grid)
+        if kind != "premium":
+            return Response({"error": "Invalid kind."}, status=400)
+
+        if not data.get("dob"):
+            return Response({"error": "Missing required fields."}, status=400)
+        actual_age, age_next_birthday = get_age_next_birthday(date.fromisoformat(data["dob"]))
+        error = product.eligibility_error("sum_assured", 0, actual_age, age_next_birthday)
+        if error:
+            return Response({"error": error}, status=400)
+
+        sa_min = max(float(data.get("saMin", product.min_sum_assured or 50000)), float(product.min_sum_assured or 0))
+        sa_max = float(data.get("saMax", sa_min * 20))
+        sa_step = float(data.get("saStep") or (sa_max - sa_min) / GRID_SA_STEPS or 1)
+        if not all(map(math.isfinite, (sa_min, sa_max, sa_step))) or not 0 < sa_min <= sa_max or sa_step <= 0:
+            return Response({"error": "Invalid SA range."}, status=400)
+
+        modes = [str(m).lower() for m in data.get("modes") or MODE_FACTORS]
+        if any(m not in MODE_FACTORS for m in modes):
+            return Response({"error": "Invalid mode."}, status=400)
+        discounted_age = age_next_birthday - (4 if gender == "female" else 2)
+        offered = offered_terms(product, discounted_age, rate_table)
+        terms = [int(t) for t in data.get("terms") or offered if int(t) in offered]
+        if not terms:
+            return Response({"error": "No terms offered at this age."}, status=400)
+
+        # Size the SA axis before allocating it; a huge saMax/saStep ratio must not reach numpy
+        sa_span = (sa_max - sa_min) / sa_step
+        if sa_span >= MAX_GRID_POINTS or (math.floor(sa_span) + 1) * len(terms) * len(modes) > MAX_GRID_POINTS:
+            return Response({"error": f"Grid too large: at most {MAX_GRID_POINTS} points."}, status=400)
+        sa_points = math.floor(sa_span) + 1
+        sums_assured = sa_min + sa_step * np.arange(sa_points)
+
+        grid = premium_grid(
+            product, age_next_birthday, gender, dab_included, sums_assured, terms, modes, rate_table=rate_table,
         )
+    except (TypeError, ValueError) as e:
+        return Response({"error": str(e)}, status=400)
 
-        return Response({
-            "message": "Pay to download",
-            "calculation_id": calc.id,
-            "amount_due": float(amount_due),
-        })
+    grid["age_next_birthday"] = age_next_birthday
+    grid["rate_version"] = rate_table.version
+    return Response(grid)
 
-    except Exception as e:
-        return Response({"error": str(e)}, status=500)
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def quote_cache_stats(request):
+    """Hit/miss counters of this worker's quote cache."""
+    return Response(quote_cache.stats())
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def pdf_cache_stats(request):
+    """Hit/miss and eviction counters of this worker's PDF cache."""
+    return Response(pdf_cache.stats())
 
 
 # --------------------------------------------------------------------
@@ -224,31 +374,97 @@ def calculate_sum_assured(request):
 
 
 
-@api_view(["GET"])
-def check_calculation_status(request, calc_id):
+MAX_STATUS_WAIT = 60
+
+
+def _calculation_status(calc):
+    # EXPIRE IF 60 SECONDS PASSED
+    if calc.is_expired() and not calc.paid:
+        return {
+            "paid": False,
+            "expired": True,
+            "message": "Retry — you delayed paying."
+        }
+    return {"paid": calc.paid, "expired": False}
+
+
+@require_safe
+async def check_calculation_status(request, calc_id):
+    """
+    Payment status of a calculation. With ``?wait=N`` (seconds, at most
+    MAX_STATUS_WAIT) an unpaid, unexpired calculation is long-polled: the request
+    parks on the payment pub/sub channel, without holding a thread, until it is
+    paid, it expires or N seconds pass.
+    """
     try:
-        calc = CalculationResult.objects.get(pk=calc_id)
-        
-        # EXPIRE IF 60 SECONDS PASSED
-        if calc.is_expired() and not calc.paid:
-            calc.paid = False  # just in case
-            return Response({
-                "paid": False,
-                "expired": True,
-                "message": "Retry — you delayed paying."
-            }, status=200)
-
-        return Response({"paid": calc.paid, "expired": False})
+        calc = await sync_to_async(get_calculation)(calc_id)
     except CalculationResult.DoesNotExist:
-        return Response({"error": "Not found"}, status=404)
+        return JsonResponse({"error": "Not found"}, status=404)
+
+    try:
+        wait = float(request.GET.get("wait", 0))
+    except ValueError:
+        wait = 0
+    wait = min(max(wait, 0), MAX_STATUS_WAIT) if math.isfinite(wait) else 0
+
+    if wait and not calc.paid and not calc.is_expired():
+        async with subscribe_payment_status(calc_id) as next_message:
+            # Read after subscribing so a payment landing in between isn't missed
+            calc.paid = await CalculationResult.objects.filter(pk=calc_id, paid=True).aexists()
+            remaining = (calc.expires_at - timezone.now()).total_seconds()
+            if not calc.paid and remaining > 0:
+                message = await next_message(min(wait, remaining))
+                calc.paid = bool(message and message.get("paid"))
+
+    return JsonResponse(_calculation_status(calc))
 
 
 
 
+# --------------------------------------------------------------------
+# Payment Status Stream (Server-Sent Events; serve under ASGI)
+# --------------------------------------------------------------------
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def _sse(data, event="status"):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@require_safe
+async def payment_status_stream(request, calc_id):
+    """
+    Push replacement for polling check_calculation_status: the client subscribes
+    once and gets a single "status" event when the calculation is paid or expires.
+    """
+    try:
+        calc = await sync_to_async(get_calculation)(calc_id)
+    except CalculationResult.DoesNotExist:
+        return JsonResponse({"error": "Not found"}, status=404)
+
+    async def events():
+        async with subscribe_payment_status(calc_id) as next_message:
+            # Read after subscribing so a payment landing in between isn't missed
+            calc.paid = await CalculationResult.objects.filter(pk=calc_id, paid=True).aexists()
+            while not calc.paid and not calc.is_expired():
+                remaining = (calc.expires_at - timezone.now()).total_seconds()
+                message = await next_message(min(remaining, SSE_KEEPALIVE_SECONDS))
+                if message is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    calc.paid = bool(message.get("paid"))
+            yield _sse(_calculation_status(calc))
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # don't let nginx buffer the stream
+    return response
+
+
 @api_view(["GET"])
 def download_result(request, calc_id):
     try:
-        calc = CalculationResult.objects.get(pk=calc_id)
+        calc = get_calculation(calc_id)
     except CalculationResult.DoesNotExist:
         return Response({"error": "Not found"}, status=404)
 
@@ -264,15 +480,70 @@ def download_result(request, calc_id):
     })
 
 
-@api_view(["POST"])
-def generate_pdf_quotation(request):
-    data = request.data
+PDF_CHUNK_SIZE = 64 * 1024
+
+
+async def _file_chunks(f):
+    """Async iterator over an open file, so ASGI streams it rather than reading it whole first."""
+    try:
+        while chunk := await sync_to_async(f.read, thread_sensitive=False)(PDF_CHUNK_SIZE):
+            yield chunk
+    finally:
+        f.close()
+
+
+def _file_response(request, f, content_type, filename):
+    """
+    Attachment response for an open file, streamed in the server's own style. Under
+    WSGI an async iterator is read whole before the first byte goes out, so the file
+    itself is handed over (wsgi.file_wrapper / sync chunks); under ASGI a sync one
+    would be, so it is read in async chunks.
+    """
+    if not isinstance(request, ASGIRequest):
+        return FileResponse(f, as_attachment=True, filename=filename, content_type=content_type)
+    response = StreamingHttpResponse(_file_chunks(f), content_type=content_type)
+    response["Content-Length"] = os.fstat(f.fileno()).st_size
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+async def _render_pdf_response(request, payload, key):
+    """
+    Serve the cached PDF for ``payload``, rendering it first on a miss: handed to
+    nginx with X-Accel-Redirect when PDF_ACCEL_REDIRECT_PREFIX is set, otherwise
+    streamed from disk (_file_response).
+    """
+    try:
+        path = await render_pdf(payload, key)
+    except RenderPoolBusy:
+        response = JsonResponse({"error": "PDF service is busy. Please retry shortly."}, status=503)
+        response["Retry-After"] = "5"
+        return response
+
+    if settings.PDF_ACCEL_REDIRECT_PREFIX:
+        response = HttpResponse(content_type="application/pdf")
+        response["X-Accel-Redirect"] = f"{settings.PDF_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{key[:2]}/{key}.pdf"
+        response["Content-Disposition"] = 'attachment; filename="kenindia_quotation.pdf"'
+    else:
+        response = _file_response(request, open(path, "rb"), "application/pdf", "kenindia_quotation.pdf")
+    response["ETag"] = f'"{key}"'
+    patch_cache_control(response, private=True, no_cache=True)  # browsers revalidate -> 304
+    return response
+
+
+@csrf_exempt
+@require_POST
+async def generate_pdf_quotation(request):
+    """Async so the worker keeps serving while the PDF renders in the render pool."""
+    data = _request_data(request)
+    if data is None:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
     calc = None
     if data.get("calculation_id"):
         try:
-            calc = CalculationResult.objects.get(pk=int(data["calculation_id"]))
+            calc = await sync_to_async(get_calculation)(int(data["calculation_id"]))
         except CalculationResult.DoesNotExist:
-            return Response({"error": "Not found"}, status=404)
+            return JsonResponse({"error": "Not found"}, status=404)
 
     payload = {
         "product": calc.product if calc else data.get("product"),
@@ -281,53 +552,180 @@ def generate_pdf_quotation(request):
         "customerName": data.get("customerName"),
     }
 
-    pdf_bytes = render_pdf_to_bytes(payload)
-    response = HttpResponse(pdf_bytes, content_type="application/pdf")
-    response["Content-Disposition"] = 'attachment; filename="kenindia_quotation.pdf"'
-    return response
+    return await _render_pdf_response(request, payload, pdf_key(payload))
+
+
+@require_safe
+async def download_pdf(request, calc_id):
+    """
+    A paid calculation's quotation PDF. The ETag is the PDF's content hash, so a
+    repeat download with If-None-Match gets a 304 without touching the renderer.
+    """
+    try:
+        calc = await sync_to_async(get_calculation)(calc_id)
+    except CalculationResult.DoesNotExist:
+        return JsonResponse({"error": "Not found"}, status=404)
+    if not calc.paid:
+        return JsonResponse({"error": "Payment required"}, status=402)
+
+    payload = quotation_payload(calc)
+    key = pdf_key(payload)
+    etag = f'"{key}"'
+    if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+    if etag in if_none_match or "*" in if_none_match:
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+    return await _render_pdf_response(request, payload, key)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def create_pdf_bundle(request):
+    """
+    Agents: export the quotations of many paid calculations as one ZIP.
+    Rendering runs on the "pdf" Celery workers; poll status_url until it returns the file.
+    """
+    ids = request.data.get("calculation_ids")
+    if not isinstance(ids, list) or not ids:
+        return Response({"error": "calculation_ids must be a non-empty list"}, status=400)
+    if len(ids) > settings.PDF_BUNDLE_MAX:
+        return Response({"error": f"At most {settings.PDF_BUNDLE_MAX} calculations per bundle"}, status=400)
+    try:
+        ids = sorted({int(i) for i in ids})
+    except (TypeError, ValueError):
+        return Response({"error": "calculation_ids must be integers"}, status=400)
+
+    paid = set(CalculationResult.objects.filter(id__in=ids, paid=True).values_list("id", flat=True))
+    if not paid:
+        return Response({"error": "None of these calculations are paid"}, status=402)
+
+    bundle_id = export_pdf_bundle(sorted(paid))
+    return Response({
+        "bundle_id": bundle_id,
+        "status_url": reverse("pdf_bundle", args=[bundle_id]),
+        "calculations": len(paid),
+        "skipped": [i for i in ids if i not in paid],
+    }, status=202)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def download_pdf_bundle(request, bundle_id):
+    """202 while the bundle renders, then the ZIP streamed from disk in the server's own style."""
+    if not re.fullmatch(r"[0-9a-f]{32}", bundle_id):
+        return Response({"error": "Not found"}, status=404)
+    path = pdf_bundle_path(bundle_id)
+    try:
+        bundle = open(path, "rb")
+    except FileNotFoundError:
+        from celery.result import AsyncResult
+        if AsyncResult(bundle_id).failed():
+            return Response({"status": "failed"}, status=500)
+        return Response({"status": "pending"}, status=202)
+    return _file_response(request._request, bundle, "application/zip", "kenindia_quotations.zip")
 
 
 # --------------------------------------------------------------------
 # M-Pesa STK Push
 # --------------------------------------------------------------------
-@api_view(["POST"])
-def stk_push_view(request):
-    phone_number = request.data.get("phone_number")
-    amount = request.data.get("amount")
-    calculation_id = request.data.get("calculation_id")
+def _request_data(request):
+    """JSON or form body of a plain (non-DRF) Django view; None if the JSON is malformed."""
+    if request.content_type == "application/json":
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+
+def _mpesa_unavailable(retry_after):
+    response = JsonResponse({"error": "M-Pesa is temporarily unavailable. Please retry shortly."}, status=503)
+    response["Retry-After"] = str(int(retry_after))
+    return response
+
+
+async def _queue_stk_push(phone_number, amount, calc):
+    """MPESA_STK_QUEUE mode: hand the push to the "mpesa" Celery queue and answer 202."""
+    # Rows older than MPESA_STK_QUEUE_TTL are past send_stk_push's retries, not waiting to be sent
+    queued = MpesaTransaction.objects.filter(
+        status="Queued", created_at__gte=timezone.now() - timedelta(seconds=settings.MPESA_STK_QUEUE_TTL),
+    )
+    if await queued.acount() >= settings.MPESA_STK_QUEUE_MAX:
+        return _mpesa_unavailable(settings.MPESA_BREAKER_RESET)
+
+    tx = await MpesaTransaction.objects.acreate(
+        phone_number=phone_number,
+        amount=amount,
+        status="Queued",
+        calculation=calc,
+    )
+    await sync_to_async(send_stk_push.delay, thread_sensitive=False)(tx.id)
+    return JsonResponse({
+        "message": "Payment request queued. Check your phone and await the payment status.",
+        "transaction_id": tx.id,
+        "calculation_id": calc.id if calc else None,
+    }, status=202)
+
+
+@csrf_exempt
+@require_POST
+async def stk_push_view(request):
+    """Async so an ASGI worker can hold many pushes waiting on Safaricom at once."""
+    data = _request_data(request)
+    if data is None:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    phone_number = data.get("phone_number")
+    amount = data.get("amount")
+    calculation_id = data.get("calculation_id")
 
     if not phone_number or not amount:
-        return Response({"error": "Phone and amount required"}, status=400)
+        return JsonResponse({"error": "Phone and amount required"}, status=400)
 
     phone_number = clean_phone_number(phone_number)
     if not phone_number:
-        return Response({"error": "Invalid phone format"}, status=400)
+        return JsonResponse({"error": "Invalid phone format"}, status=400)
+
+    # Resolve the calculation first so the transaction is inserted with it in one query
+    calc = None
+    if calculation_id:
+        try:
+            calc = await sync_to_async(get_calculation)(int(calculation_id))
+        except (CalculationResult.DoesNotExist, TypeError, ValueError):
+            pass
+
+    if settings.MPESA_STK_QUEUE:
+        return await _queue_stk_push(phone_number, amount, calc)
 
-    from .utils.mpesa import initiate_stk_push
-    mpesa_response = initiate_stk_push(phone_number, amount)
+    from .utils.mpesa_async import initiate_stk_push
+    try:
+        mpesa_response = await initiate_stk_push(phone_number, amount)
+    except CircuitOpenError as e:
+        return _mpesa_unavailable(e.retry_after)
+    except Exception as e:
+        logger.error(f"STK push failed: {e}")
+        return JsonResponse({"error": "M-Pesa request failed. Please try again."}, status=502)
 
-    tx = MpesaTransaction.objects.create(
+    await MpesaTransaction.objects.acreate(
         phone_number=phone_number,
         amount=amount,
         status="Pending",
         merchant_request_id=mpesa_response.get("MerchantRequestID"),
         checkout_request_id=mpesa_response.get("CheckoutRequestID"),
+        calculation=calc,
     )
 
-    if calculation_id:
-        try:
-            calc = CalculationResult.objects.get(pk=int(calculation_id))
-            tx.calculation = calc
-            tx.save()
-        except CalculationResult.DoesNotExist:
-            pass
-
-    return Response(mpesa_response)
+    return JsonResponse(mpesa_response)
 
 
 # --------------------------------------------------------------------
 # M-Pesa Callback (Celery)
 # --------------------------------------------------------------------
+CALLBACK_SEEN_KEY = "mpesa:callback-seen:{checkout_id}"
+CALLBACK_SEEN_TTL = 86400
+
+
 @api_view(["POST"])
 def stk_callback_view(request):
     data = request.data
@@ -336,6 +734,31 @@ def stk_callback_view(request):
     result_code = callback.get("ResultCode", -1)
     metadata = callback.get("CallbackMetadata", {}).get("Item", [])
 
-    process_mpesa_callback.delay(checkout_id, result_code, metadata)
+    if not checkout_id:
+        # Nothing to match a transaction against (and no key to dedupe on)
+        logger.warning(f"M-Pesa callback without CheckoutRequestID ignored: {callback}")
+        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
+
+    # Safaricom redelivers callbacks: SETNX so only the first delivery is enqueued.
+    # The task's conditional update is the real guard; this just saves the Celery trip.
+    seen_key = CALLBACK_SEEN_KEY.format(checkout_id=checkout_id)
+    try:
+        first_delivery = cache.add(seen_key, 1, timeout=CALLBACK_SEEN_TTL)
+    except Exception:
+        first_delivery = True
+    if not first_delivery:
+        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
+
+    try:
+        if settings.MPESA_CALLBACK_BATCHING:
+            enqueue_callback(checkout_id, result_code, metadata)
+        else:
+            process_mpesa_callback.delay(checkout_id, result_code, metadata)
+    except Exception:
+        try:
+            cache.delete(seen_key)  # let Safaricom's retry through
+        except Exception:
+            pass
+        raise
 
     return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
\ No newline at end of file
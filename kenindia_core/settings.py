@@ -186,6 +186,13 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Africa/Nairobi'
 CELERY_ENABLE_UTC = False
 
+# --- Write-behind for calculation results ---
+# When on, quote views queue CalculationResult rows in Redis and the
+# flush_calculation_results task inserts them in batches
+CALCULATION_WRITE_BEHIND = config('CALCULATION_WRITE_BEHIND', default=False, cast=bool)
+CALCULATION_FLUSH_BATCH = config('CALCULATION_FLUSH_BATCH', default=1000, cast=int)
+CALCULATION_PENDING_TTL = 86400  # seconds a queued row survives if it's never flushed
+
 # --- Django Redis Cache (for sessions) ---
 CACHES = {
     "default": {
@@ -204,10 +211,103 @@ SESSION_COOKIE_AGE = 60 * 30  # 30 minutes
 SESSION_SAVE_EVERY_REQUEST = True
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# --- M-Pesa resilience ---
+# Circuit breaker: open after this many consecutive provider failures, probe again after MPESA_BREAKER_RESET s
+MPESA_BREAKER_THRESHOLD = config('MPESA_BREAKER_THRESHOLD', default=5, cast=int)
+MPESA_BREAKER_RESET = config('MPESA_BREAKER_RESET', default=30, cast=float)
+# Queued mode: stk_push_view answers 202 and a worker on the "mpesa" queue sends the push.
+# Bound concurrency with e.g. `celery -A kenindia_core worker -Q mpesa --concurrency 4`
+MPESA_STK_QUEUE = config('MPESA_STK_QUEUE', default=False, cast=bool)
+MPESA_STK_QUEUE_MAX = config('MPESA_STK_QUEUE_MAX', default=500, cast=int)  # queued pushes before 503s
+# A queued push still Queued after this many seconds has outlived send_stk_push's
+# retries: it stops counting toward MPESA_STK_QUEUE_MAX and expire_queued_stk_pushes fails it
+MPESA_STK_QUEUE_TTL = config('MPESA_STK_QUEUE_TTL', default=300, cast=int)
+# Reconciliation sleeps to pace its STK queries, so it runs there too rather than
+# holding a default-queue worker (callbacks, write-behind flushes) for the whole run.
+CELERY_TASK_ROUTES = {
+    "calculator.tasks.send_stk_push": {"queue": "mpesa"},
+    "calculator.tasks.reconcile_pending_payments": {"queue": "mpesa"},
+    "calculator.tasks.generate_pdf_task": {"queue": "pdf"},
+    "calculator.tasks.build_pdf_bundle": {"queue": "pdf"},
+}
+
+# Batched callbacks: the callback view queues raw callbacks in Redis and
+# `manage.py consume_callbacks` applies them in batches instead of one task each
+MPESA_CALLBACK_BATCHING = config('MPESA_CALLBACK_BATCHING', default=False, cast=bool)
+MPESA_CALLBACK_BATCH_SIZE = config('MPESA_CALLBACK_BATCH_SIZE', default=200, cast=int)
+MPESA_CALLBACK_BATCH_WAIT_MS = config('MPESA_CALLBACK_BATCH_WAIT_MS', default=200, cast=int)
+
+# Reconciliation of Pending payments whose callback never arrived (STK Query)
+MPESA_RECONCILE_STALE_AFTER = config('MPESA_RECONCILE_STALE_AFTER', default=120, cast=int)  # seconds
+MPESA_RECONCILE_MAX_AGE = config('MPESA_RECONCILE_MAX_AGE', default=86400, cast=int)  # then mark Failed
+MPESA_RECONCILE_PAGE_SIZE = config('MPESA_RECONCILE_PAGE_SIZE', default=100, cast=int)
+MPESA_RECONCILE_MAX_ROWS = config('MPESA_RECONCILE_MAX_ROWS', default=2000, cast=int)  # per run
+MPESA_RECONCILE_CONCURRENCY = config('MPESA_RECONCILE_CONCURRENCY', default=8, cast=int)
+MPESA_RECONCILE_RATE = config('MPESA_RECONCILE_RATE', default=20, cast=float)  # STK queries per second
+MPESA_RECONCILE_LOCK_TIMEOUT = 600
+
+# --- Celery beat ---
+CELERY_BEAT_SCHEDULE = {
+    "flush-calculation-results": {
+        "task": "calculator.tasks.flush_calculation_results",
+        "schedule": config('CALCULATION_FLUSH_INTERVAL', default=2.0, cast=float),
+    },
+    "reconcile-pending-payments": {
+        "task": "calculator.tasks.reconcile_pending_payments",
+        "schedule": config('MPESA_RECONCILE_INTERVAL', default=60.0, cast=float),
+    },
+    "expire-queued-stk-pushes": {
+        "task": "calculator.tasks.expire_queued_stk_pushes",
+        "schedule": 60.0,
+    },
+    "cleanup-pdf-bundles": {
+        "task": "calculator.tasks.cleanup_pdf_bundles",
+        "schedule": 3600.0,
+    },
+}
+
+# --- Payment status push ---
+# "redis" (pub/sub on REDIS_URL) or "memory" (single process / tests)
+PAYMENT_EVENTS_BROKER = config('PAYMENT_EVENTS_BROKER', default='redis')
+
+# --- Rate tables ---
+# How often (seconds) each worker checks the cache for rates published with
+# `manage.py publish_rates`
+RATES_CHECK_INTERVAL = config('RATES_CHECK_INTERVAL', default=30, cast=int)
+
+# --- Quote cache ---
+# In-process LRU entries per worker, and how long (seconds) quotes live in Redis
+QUOTE_CACHE_SIZE = config('QUOTE_CACHE_SIZE', default=10000, cast=int)
+QUOTE_CACHE_TIMEOUT = config('QUOTE_CACHE_TIMEOUT', default=86400, cast=int)
+
 # --- MEDIA (for PDFs) ---
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# --- PDF cache ---
+# Rendered quotations keyed by content hash; least recently used files are
+# evicted down to PDF_CACHE_LOW_WATER of the cap once it is exceeded
+PDF_CACHE_DIR = config('PDF_CACHE_DIR', default=os.path.join(MEDIA_ROOT, 'pdf-cache'))
+PDF_CACHE_MAX_BYTES = config('PDF_CACHE_MAX_BYTES', default=512 * 1024 * 1024, cast=int)
+PDF_CACHE_LOW_WATER = config('PDF_CACHE_LOW_WATER', default=0.9, cast=float)
+# Temporary render files older than this (seconds) are removed on eviction
+PDF_CACHE_TMP_MAX_AGE = config('PDF_CACHE_TMP_MAX_AGE', default=3600, cast=int)
+
+# --- PDF rendering ---
+# /api/generate-pdf/ renders cache misses in a process pool of PDF_RENDER_WORKERS
+# per web worker and answers 503 once PDF_RENDER_QUEUE_MAX renders are in flight.
+# generate_pdf_task runs on the "pdf" Celery queue, away from payment tasks:
+# `celery -A kenindia_core worker -Q pdf --concurrency 2 --prefetch-multiplier 1`
+PDF_RENDER_WORKERS = config('PDF_RENDER_WORKERS', default=2, cast=int)
+PDF_RENDER_QUEUE_MAX = config('PDF_RENDER_QUEUE_MAX', default=32, cast=int)
+# Let nginx send cached PDFs: set to an internal location aliased to PDF_CACHE_DIR,
+# e.g. `location /protected/pdf-cache/ { internal; alias /app/media/pdf-cache/; }`
+PDF_ACCEL_REDIRECT_PREFIX = config('PDF_ACCEL_REDIRECT_PREFIX', default='')
+# Bulk export (/api/generate-pdf/bundle/): calculations per bundle, and how long
+# (seconds) finished ZIPs are kept. pdf workers must share MEDIA_ROOT.
+PDF_BUNDLE_MAX = config('PDF_BUNDLE_MAX', default=200, cast=int)
+PDF_BUNDLE_TTL = config('PDF_BUNDLE_TTL', default=3600, cast=int)
+
 # --- Default Auto Field ---
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 